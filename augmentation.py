@@ -0,0 +1,129 @@
+"""
+Batched augmentation on uint8 tensors
+
+Same augmentation as image.load_shanghai_data (random crop with crop_ratio between 0.5 and 1.0,
+random horizontal flip, count preserving down sample of the density) but done for a whole batch
+in a few tensor ops, on whatever device the batch lives on. With crop=False the samples are already
+cropped (mydataset.raw_crop) and only flip, scale jitter and normalization run on the batch.
+"""
+import random
+
+import torch
+import torch.nn.functional as F
+
+from utils import IMAGENET_MEAN, IMAGENET_STD
+
+
+class BatchAugment(object):
+    """
+    img: uint8 tensor (N, 3, H, W) in RGB order
+    density: float tensor (N, 1, H, W) at full resolution, with crop=False (N, 1, H, W) / 2 ** down_sample
+        and W a multiple of 2 ** down_sample
+    returns the normalized float image and the density down sampled by 2 ** down_sample
+    """
+
+    def __init__(self,
+                 crop_ratio: tuple = (0.5, 1.0),
+                 flip_prob: float = 0.2,
+                 scale_jitter: tuple = None,
+                 down_sample: int = 3,
+                 mean: list = IMAGENET_MEAN,
+                 std: list = IMAGENET_STD,
+                 crop: bool = True):
+        self.crop = crop
+        self.crop_ratio = crop_ratio
+        self.flip_prob = flip_prob
+        self.scale_jitter = scale_jitter
+        self.down_sample = down_sample
+        self.mean = mean
+        self.std = std
+
+    def __call__(self, img, density, train: bool = True):
+        if train:
+            img, density = self.crop_flip(img, density) if self.crop else self.flip(img, density)
+
+        scale = 1.0
+        if train and self.scale_jitter is not None:
+            scale = random.uniform(*self.scale_jitter)
+
+        img = self.normalize(img)
+        if scale != 1.0:
+            size = (max(int(img.shape[2] * scale), 1), max(int(img.shape[3] * scale), 1))
+            img = F.interpolate(img, size=size, mode='bilinear', align_corners=False)
+
+        if self.crop:
+            density = self.reshape_target(density, img.shape[2], img.shape[3], scale)
+        else:
+            density = self.resample_target(density, img.shape[2], img.shape[3])
+        return img, density
+
+    def flip(self, img, density):
+        """
+        Horizontal flip drawn per sample, the density flips over whole cells
+        """
+        flip = torch.rand(img.shape[0], device=img.device) < self.flip_prob
+        img = torch.where(flip[:, None, None, None], img.flip(-1), img)
+        density = torch.where(flip[:, None, None, None], density.flip(-1), density)
+        return img, density
+
+    def crop_flip(self, img, density):
+        """
+        One crop size per batch so the result stacks, crop offsets and flips are drawn per sample
+        """
+        n, _, height, width = img.shape
+        device = img.device
+
+        crop_ratio = random.uniform(*self.crop_ratio)
+        crop_h = int(crop_ratio * height)
+        crop_w = int(crop_ratio * width)
+        dy = (torch.rand(n, device=device) * (height - crop_h)).long()
+        dx = (torch.rand(n, device=device) * (width - crop_w)).long()
+        flip = torch.rand(n, device=device) < self.flip_prob
+
+        rows = dy[:, None] + torch.arange(crop_h, device=device)[None, :]
+        cols = torch.arange(crop_w, device=device)[None, :]
+        # flip is folded into the column index so crop and flip are one gather
+        cols = torch.where(flip[:, None], crop_w - 1 - cols, cols) + dx[:, None]
+
+        batch_idx = torch.arange(n, device=device)[:, None, None]
+        rows = rows[:, :, None]
+        cols = cols[:, None, :]
+        # advanced indices around a slice move to the front: (N, crop_h, crop_w, C)
+        img = img[batch_idx, :, rows, cols].permute(0, 3, 1, 2)
+        density = density[batch_idx, :, rows, cols].permute(0, 3, 1, 2)
+        return img, density
+
+    def normalize(self, img):
+        """
+        ToTensor and Normalize folded into one multiply-subtract
+        """
+        std = torch.tensor(self.std, dtype=torch.float32, device=img.device).view(1, -1, 1, 1)
+        mean = torch.tensor(self.mean, dtype=torch.float32, device=img.device).view(1, -1, 1, 1)
+        return img.float().mul_(1. / (255. * std)).sub_(mean / std)
+
+    def reshape_target(self, density, img_h: int, img_w: int, scale: float = 1.0):
+        """
+        Down sample to the model output size, same count preserving rescale as image.reshape_target
+        """
+        height, width = img_h, img_w
+        # ceil_mode=True for nn.MaxPool2d in model
+        for i in range(self.down_sample):
+            height = int((height + 1) / 2)
+            width = int((width + 1) / 2)
+        density = F.interpolate(density.float(), size=(height, width), mode='bicubic', align_corners=False)
+        return density * (2 ** (self.down_sample * 2) / (scale * scale))
+
+    def resample_target(self, density, img_h: int, img_w: int):
+        """
+        Density already at the output size of the crop to the output size of the (rescaled) image, count
+        preserving
+        """
+        height, width = img_h, img_w
+        for i in range(self.down_sample):
+            height = int((height + 1) / 2)
+            width = int((width + 1) / 2)
+        if (height, width) == tuple(density.shape[2:]):
+            return density.float()
+        cells = density.shape[2] * density.shape[3]
+        density = F.interpolate(density.float(), size=(height, width), mode='bicubic', align_corners=False)
+        return density * (cells / (height * width))
@@ -0,0 +1,287 @@
+"""
+CPU deployment autotuner: intra-op / inter-op threads, batch size and backend for one model and input size
+
+eager: the checkpoint model with the input normalization folded into its first conv
+torchscript: the folded model traced and frozen (torch.jit.script can not compile the student's forward,
+    which returns a list while training)
+quantized: static int8 (FX graph mode, calibrated on the tuning images) of the unfolded model, traced and
+    frozen, it takes normalized input
+exported: the folded model as a torch.export program with dynamic batch, height and width
+
+Every (backend, threads, interop threads) runs in its own process, the inter-op pool can only be sized once
+per process. Each process times every batch size on the same images, input preparation included, and
+checks the counts against the eager model. The tuned config is the highest throughput whose p95 batch
+latency is within --slo_ms and whose count error is within --max_count_error; when nothing meets the SLO
+the lowest latency accurate one is written and marked as such, when nothing is accurate enough no config
+is written. server.py and test.py load it with --tuned_config.
+
+python autotune.py -c CSRNet_models_weights/partA_student.pth.tar --size 576 864 -o tuned_config.json
+python autotune.py -c CSRNet_models_weights/partA_student.pth.tar --backends eager quantized --slo_ms 300
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import warnings
+
+import cv2
+import numpy as np
+import torch
+
+from inference import run_frames, to_input_batch
+from model_registry import load_model
+from models import build_model, load_checkpoint
+
+BACKENDS = ('eager', 'torchscript', 'quantized', 'exported')
+
+parser = argparse.ArgumentParser(description='CSRNet CPU deployment autotuner')
+parser.add_argument('--checkpoint', '-c', metavar='CHECKPOINT', default='CSRNet_models_weights/partA_student.pth.tar',
+                    type=str,
+                    help='path to the checkpoint')
+parser.add_argument('--version', '-v', default='quarter_vgg', type=str,
+                    help='vgg/quarter_vgg')
+parser.add_argument('--transform', '-t', default=True, type=bool,
+                    help='1x1 conv transform')
+parser.add_argument('--size', type=int, nargs=2, default=[576, 864], metavar=('HEIGHT', 'WIDTH'),
+                    help='input resolution the deployment runs at')
+parser.add_argument('--test_json', '-tj', metavar='TEST', default='',
+                    help='tuning / calibration images resized to --size, random images when empty')
+parser.add_argument('--images', default=8, type=int,
+                    help='number of tuning images')
+parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=list(BACKENDS),
+                    help='backends to try')
+parser.add_argument('--threads', type=int, nargs='+', default=None,
+                    help='intra-op thread counts, powers of 2 up to the core count and the core count by default')
+parser.add_argument('--interop', type=int, nargs='+', default=[1, 2],
+                    help='inter-op thread counts')
+parser.add_argument('--batch', type=int, nargs='+', default=[1, 2, 4, 8],
+                    help='batch sizes')
+parser.add_argument('--runs', default=10, type=int,
+                    help='timed batches per batch size')
+parser.add_argument('--warmup', default=2, type=int,
+                    help='untimed batches per batch size')
+parser.add_argument('--slo_ms', default=500., type=float,
+                    help='p95 latency of one batch the tuned config has to stay within')
+parser.add_argument('--max_count_error', default=0.05, type=float,
+                    help='mean relative count error against the eager model a backend may have')
+parser.add_argument('--work_dir', default='./autotune', type=str,
+                    help='compiled / quantized / exported models and tuning images')
+parser.add_argument('--out', '-o', default='tuned_config.json', type=str,
+                    help='tuned config file')
+parser.add_argument('--worker', default='', type=str,
+                    help=argparse.SUPPRESS)
+
+
+def load_tuned_config(path: str) -> dict:
+    """
+    Tuned config written by autotune.py, its thread counts are applied to this process
+    """
+    with open(path, 'r') as f:
+        tuned = json.load(f)
+    torch.set_num_threads(int(tuned['threads']))
+    try:
+        torch.set_num_interop_threads(int(tuned['interop_threads']))
+    except RuntimeError:
+        # only possible before the first parallel work of the process
+        print("=> inter-op threads already set, keeping {}".format(torch.get_num_interop_threads()))
+    return tuned
+
+
+def default_threads() -> list:
+    cores = os.cpu_count() or 1
+    threads = {cores}
+    n = 1
+    while n < cores:
+        threads.add(n)
+        n *= 2
+    return sorted(threads)
+
+
+def tuning_frames(args) -> list:
+    height, width = args.size
+    if not args.test_json:
+        rng = np.random.RandomState(0)
+        return [rng.randint(0, 256, (height, width, 3), dtype=np.uint8) for _ in range(args.images)]
+    with open(args.test_json, 'r') as outfile:
+        test_list = json.load(outfile)
+    frames = []
+    for path in test_list[:args.images]:
+        img = cv2.imread(path)
+        if img is None:
+            raise FileNotFoundError("can not read image '{}'".format(path))
+        frames.append(cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA))
+    while len(frames) < args.images:
+        frames.append(frames[len(frames) % len(test_list)])
+    return frames
+
+
+def build_backend(backend: str, args, frames: list) -> dict:
+    """
+    Model spec (model_registry.load_model) of a backend, compiled artifacts are written to args.work_dir
+    """
+    checkpoint = os.path.abspath(args.checkpoint)
+    spec = {'version': args.version, 'ratio': 4, 'transform': args.transform, 'checkpoint': checkpoint}
+    if backend == 'eager':
+        return spec
+
+    height, width = args.size
+    path = os.path.abspath(os.path.join(args.work_dir, backend + ('.pt2' if backend == 'exported' else '.pt')))
+    if backend == 'quantized':
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+        engine = 'x86' if 'x86' in torch.backends.quantized.supported_engines else 'qnnpack'
+        torch.backends.quantized.engine = engine
+        # a fresh unfolded model, FX can not trace the folded first conv
+        model = build_model(args.version, ratio=4, transform=args.transform)
+        load_checkpoint(model, checkpoint, transform=args.transform)
+        model.eval()
+        example = to_input_batch(frames[:1])
+        prepared = prepare_fx(model, get_default_qconfig_mapping(engine), (example,))
+        with torch.no_grad():
+            for frame in frames:
+                prepared(to_input_batch([frame]))
+        model = convert_fx(prepared)
+        with torch.no_grad():
+            torch.jit.freeze(torch.jit.trace(model, example, check_trace=False)).save(path)
+        return {'format': 'torchscript', 'checkpoint': path, 'raw_input': False, 'quantized_engine': engine}
+
+    model, _ = load_model(spec)
+    if backend == 'torchscript':
+        example = torch.zeros((1, 3, height, width)).contiguous(memory_format=torch.channels_last)
+        with torch.no_grad():
+            torch.jit.freeze(torch.jit.trace(model, example, check_trace=False)).save(path)
+        return {'format': 'torchscript', 'checkpoint': path, 'raw_input': True}
+
+    # a batch of 1 would specialize the batch dimension
+    example = torch.zeros((2, 3, height, width))
+    dim = torch.export.Dim.AUTO
+    with torch.no_grad():
+        exported = torch.export.export(model, (example,), dynamic_shapes=({0: dim, 2: dim, 3: dim},))
+    torch.export.save(exported, path)
+    return {'format': 'exported', 'checkpoint': path, 'raw_input': True}
+
+
+def measure(task: dict) -> list:
+    """
+    Latency, throughput and count error of one backend at every batch size, run in a worker process
+    """
+    torch.set_num_threads(task['threads'])
+    torch.set_num_interop_threads(task['interop'])
+    model, _ = load_model(task['spec'])
+    frames = list(np.load(task['frames']))
+    reference = np.load(task['reference'])
+
+    counts = np.asarray([float(run_frames(model, [frame]).sum()) for frame in frames])
+    count_error = float(np.mean(np.abs(counts - reference) / np.maximum(np.abs(reference), 1.)))
+
+    results = []
+    for batch_size in task['batch']:
+        batches = [[frames[(i * batch_size + j) % len(frames)] for j in range(batch_size)]
+                   for i in range(task['warmup'] + task['runs'])]
+        seconds = []
+        for i, batch in enumerate(batches):
+            start = time.perf_counter()
+            run_frames(model, batch)
+            if i >= task['warmup']:
+                seconds.append(time.perf_counter() - start)
+        ms = 1000. * np.asarray(seconds)
+        results.append({'backend': task['backend'], 'threads': task['threads'], 'interop_threads': task['interop'],
+                        'batch': batch_size, 'p50_ms': float(np.percentile(ms, 50)),
+                        'p95_ms': float(np.percentile(ms, 95)), 'throughput': batch_size * len(ms) / ms.sum() * 1000.,
+                        'count_error': count_error})
+    return results
+
+
+def run_worker(task: dict) -> list:
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', json.dumps(task)],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if output.returncode != 0:
+        raise RuntimeError(output.stderr.strip().splitlines()[-1] if output.stderr.strip() else
+                           'worker exited with code {}'.format(output.returncode))
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def select(results: list, slo_ms: float, max_count_error: float) -> tuple:
+    """
+    (result, slo_met): best throughput within the SLO and the count error, otherwise the lowest latency
+    within the count error, RuntimeError when no result is accurate enough
+    """
+    accurate = [r for r in results if r['count_error'] <= max_count_error]
+    if not accurate:
+        raise RuntimeError('no result within a count error of {}, smallest {:.2%}'.format(
+            max_count_error, min(r['count_error'] for r in results)))
+    within = [r for r in accurate if r['p95_ms'] <= slo_ms]
+    if within:
+        return max(within, key=lambda r: (r['throughput'], -r['p95_ms'])), True
+    return min(accurate, key=lambda r: (r['p95_ms'], -r['throughput'])), False
+
+
+def main(args):
+    os.makedirs(args.work_dir, exist_ok=True)
+    threads = args.threads or default_threads()
+    frames = tuning_frames(args)
+    frames_path = os.path.abspath(os.path.join(args.work_dir, 'frames.npy'))
+    reference_path = os.path.abspath(os.path.join(args.work_dir, 'reference.npy'))
+    np.save(frames_path, np.stack(frames))
+    model, _ = load_model(build_backend('eager', args, frames))
+    np.save(reference_path, np.asarray([float(run_frames(model, [frame]).sum()) for frame in frames]))
+    del model
+
+    specs = {}
+    failed = {}
+    for backend in args.backends:
+        start = time.time()
+        try:
+            with warnings.catch_warnings():
+                # tracer and quantization deprecation warnings, the graphs are only run at --size
+                warnings.simplefilter('ignore')
+                specs[backend] = build_backend(backend, args, frames)
+            print('=> built {} in {:.1f}s'.format(backend, time.time() - start), file=sys.stderr)
+        except Exception as e:
+            failed[backend] = '{}: {}'.format(type(e).__name__, e)
+            print('=> {} not available: {}'.format(backend, failed[backend]), file=sys.stderr)
+
+    results = []
+    for backend, spec in specs.items():
+        for n_threads in threads:
+            for interop in args.interop:
+                task = {'backend': backend, 'spec': spec, 'threads': n_threads, 'interop': interop,
+                        'batch': args.batch, 'runs': args.runs, 'warmup': args.warmup,
+                        'frames': frames_path, 'reference': reference_path}
+                try:
+                    measured = run_worker(task)
+                except RuntimeError as e:
+                    failed['{} threads={} interop={}'.format(backend, n_threads, interop)] = str(e)
+                    continue
+                for r in measured:
+                    print('{backend:<12} threads {threads:>2} interop {interop_threads} batch {batch:>2}: '
+                          '{throughput:.2f} img/s, p50 {p50_ms:.1f} ms, p95 {p95_ms:.1f} ms, '
+                          'count error {count_error:.2%}'.format(**r), file=sys.stderr)
+                results.extend(measured)
+    if not results:
+        raise RuntimeError('no backend could be measured: {}'.format(failed))
+
+    best, slo_met = select(results, args.slo_ms, args.max_count_error)
+    tuned = {'machine': {'processor': platform.processor() or platform.machine(), 'cpu_count': os.cpu_count(),
+                         'torch': torch.__version__},
+             'size': args.size, 'slo_ms': args.slo_ms, 'slo_met': slo_met, 'max_count_error': args.max_count_error,
+             'accuracy_met': best['count_error'] <= args.max_count_error, 'spec': specs[best['backend']],
+             'backend': best['backend'], 'threads': best['threads'], 'interop_threads': best['interop_threads'],
+             'batch': best['batch'], 'metrics': best, 'results': results, 'failed': failed}
+    with open(args.out, 'w') as f:
+        json.dump(tuned, f, indent=2)
+    print('=> {} threads {} interop {} batch {}: {:.2f} img/s, p95 {:.1f} ms{}, written to {}'.format(
+        best['backend'], best['threads'], best['interop_threads'], best['batch'], best['throughput'],
+        best['p95_ms'], '' if slo_met else ' (SLO of {} ms not met)'.format(args.slo_ms), args.out))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.worker:
+        print(json.dumps(measure(json.loads(args.worker))))
+    else:
+        main(args)
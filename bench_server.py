@@ -0,0 +1,289 @@
+"""
+Load test of the counting server: throughput, latency percentiles, errors and server memory
+
+The server is started as a subprocess (or --url points to a running one) and the images of a test json are
+replayed as they are on disk, through /get_people_num (raw image/jpeg body) and / or /upload (multipart form).
+open loop: requests are sent at a fixed rate whatever the server does, latency is measured from the time a
+    request was due, so a server falling behind shows up as growing latency and not as a lower rate
+closed loop: a fixed number of clients each send the next request when the previous one returned
+Every rate / concurrency level runs for --duration seconds, the server RSS is sampled meanwhile. The report
+is printed and written as json so runs before and after a change can be compared.
+
+python bench_server.py -c CSRNet_models_weights/partA_student.pth.tar -tj preprocess/A_test.json --rates 1 2 4
+python bench_server.py -c CSRNet_models_weights/partA_student.pth.tar --mode closed --concurrency 1 4 8
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import shlex
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+parser = argparse.ArgumentParser(description='CSRNet server load test')
+parser.add_argument('--checkpoint', '-c', metavar='CHECKPOINT', default='CSRNet_models_weights/partA_student.pth.tar',
+                    type=str,
+                    help='checkpoint of the started server')
+parser.add_argument('--test_json', '-tj', metavar='TEST', default='preprocess/A_test.json',
+                    help='images replayed in order, cycled')
+parser.add_argument('--endpoints', nargs='+', choices=['get_people_num', 'upload'], default=['get_people_num'],
+                    help='endpoints under test, each level runs once per endpoint')
+parser.add_argument('--mode', choices=['open', 'closed'], default='open',
+                    help='open loop at --rates or closed loop at --concurrency')
+parser.add_argument('--rates', type=float, nargs='+', default=[1., 2., 4.],
+                    help='open loop request rates (requests / s)')
+parser.add_argument('--poisson', action='store_true',
+                    help='exponential inter-arrival times instead of a fixed interval in open loop')
+parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4],
+                    help='closed loop client counts')
+parser.add_argument('--duration', '-d', type=float, default=30.,
+                    help='seconds per level')
+parser.add_argument('--warmup', type=int, default=3,
+                    help='requests sent before the first level, not measured')
+parser.add_argument('--max_inflight', type=int, default=256,
+                    help='open loop client threads, requests beyond wait on the client')
+parser.add_argument('--timeout', type=float, default=60.,
+                    help='seconds before a request counts as an error')
+parser.add_argument('--port', default=24633, type=int,
+                    help='port of the started server')
+parser.add_argument('--server_args', default='', type=str,
+                    help='extra server.py arguments, e.g. "--decode_threads 2"')
+parser.add_argument('--url', default='', type=str,
+                    help='base url of a running server, nothing is started and RSS is not sampled')
+parser.add_argument('--seed', default=0, type=int,
+                    help='seed of the poisson arrivals')
+parser.add_argument('--out', '-o', default='', type=str,
+                    help='also write the json report to this file')
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def start_server(args, timeout: float = 120.):
+    """
+    server.py subprocess on args.port, returned once it answers
+    """
+    command = [sys.executable, 'server.py', '-c', args.checkpoint, '--port', str(args.port)]
+    server = subprocess.Popen(command + shlex.split(args.server_args), cwd=ROOT,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if server.poll() is not None:
+            raise RuntimeError('server exited with code {}'.format(server.returncode))
+        try:
+            urllib.request.urlopen('http://127.0.0.1:{}/'.format(args.port), timeout=timeout).read()
+            return server
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError('server not up within {}s'.format(timeout))
+
+
+def rss_bytes(pid: int) -> tuple:
+    """
+    (current, peak) resident memory of a process from /proc, (None, None) where it is not available
+    """
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+        return int(fields['VmRSS'].split()[0]) * 1024, int(fields['VmHWM'].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+class RssSampler(object):
+    def __init__(self, pid: int = None, interval: float = 0.2):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        if self.pid is not None:
+            self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            rss, _ = rss_bytes(self.pid)
+            if rss is not None:
+                self.samples.append(rss)
+
+    def summary(self) -> dict:
+        if self.pid is None:
+            return {}
+        rss, peak = rss_bytes(self.pid)
+        samples = self.samples or [rss or 0]
+        return {'rss_mb_mean': np.mean(samples) / 2 ** 20, 'rss_mb_max': max(samples) / 2 ** 20,
+                'rss_mb_end': (rss or 0) / 2 ** 20, 'rss_mb_high_water': (peak or 0) / 2 ** 20}
+
+
+def make_request(base_url: str, endpoint: str, data: bytes):
+    if endpoint == 'get_people_num':
+        return urllib.request.Request(base_url + '/get_people_num', data=data,
+                                      headers={'Content-Type': 'image/jpeg'})
+    boundary = uuid.uuid4().hex
+    body = b''.join([
+        '--{}\r\n'.format(boundary).encode(),
+        b'Content-Disposition: form-data; name="file"; filename="bench.jpg"\r\n',
+        b'Content-Type: image/jpeg\r\n\r\n', data,
+        '\r\n--{}--\r\n'.format(boundary).encode()])
+    return urllib.request.Request(base_url + '/upload', data=body,
+                                  headers={'Content-Type': 'multipart/form-data; boundary=' + boundary})
+
+
+def send(request, timeout: float) -> str:
+    """
+    None on success, the error (http status or exception name) otherwise
+    """
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+        return None
+    except urllib.error.HTTPError as e:
+        return str(e.code)
+    except Exception as e:
+        return type(e).__name__
+
+
+class Recorder(object):
+    def __init__(self):
+        self.latencies = []
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def record(self, seconds: float, error: str):
+        with self.lock:
+            if error is None:
+                self.latencies.append(seconds)
+            else:
+                self.errors[error] = self.errors.get(error, 0) + 1
+
+    def summary(self, elapsed: float) -> dict:
+        ok = len(self.latencies)
+        failed = sum(self.errors.values())
+        result = {'requests': ok + failed, 'ok': ok, 'errors': self.errors,
+                  'error_rate': failed / max(ok + failed, 1), 'throughput': ok / elapsed, 'seconds': elapsed}
+        if ok:
+            ms = 1000. * np.asarray(self.latencies)
+            result.update({'p50_ms': float(np.percentile(ms, 50)), 'p95_ms': float(np.percentile(ms, 95)),
+                           'p99_ms': float(np.percentile(ms, 99)), 'mean_ms': float(ms.mean()),
+                           'max_ms': float(ms.max())})
+        return result
+
+
+def open_loop(base_url: str, endpoint: str, images: list, rate: float, args) -> dict:
+    recorder = Recorder()
+    rng = random.Random(args.seed)
+    payloads = itertools.cycle(images)
+
+    def task(due: float, data: bytes):
+        error = send(make_request(base_url, endpoint, data), args.timeout)
+        # from the time the request was due, a backlog on the client is latency too
+        recorder.record(time.perf_counter() - due, error)
+
+    start = time.perf_counter()
+    due = start
+    with ThreadPoolExecutor(args.max_inflight) as pool:
+        while due < start + args.duration:
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(task, due, next(payloads))
+            due += rng.expovariate(rate) if args.poisson else 1. / rate
+        # requests still in flight count, the level ends when they return
+    elapsed = max(time.perf_counter() - start, args.duration)
+    return dict(recorder.summary(elapsed), target_rate=rate)
+
+
+def closed_loop(base_url: str, endpoint: str, images: list, concurrency: int, args) -> dict:
+    recorder = Recorder()
+    payloads = itertools.cycle(images)
+    payload_lock = threading.Lock()
+    start = time.perf_counter()
+
+    def client():
+        while time.perf_counter() - start < args.duration:
+            with payload_lock:
+                data = next(payloads)
+            sent = time.perf_counter()
+            error = send(make_request(base_url, endpoint, data), args.timeout)
+            recorder.record(time.perf_counter() - sent, error)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return dict(recorder.summary(elapsed), concurrency=concurrency)
+
+
+def main(args):
+    with open(args.test_json, 'r') as outfile:
+        test_list = json.load(outfile)
+    images = []
+    for path in test_list:
+        with open(path, 'rb') as f:
+            images.append(f.read())
+
+    server = None
+    if args.url:
+        base_url = args.url.rstrip('/')
+    else:
+        server = start_server(args)
+        base_url = 'http://127.0.0.1:{}'.format(args.port)
+    pid = server.pid if server is not None else None
+
+    report = {'config': {'mode': args.mode, 'endpoints': args.endpoints, 'duration': args.duration,
+                         'images': len(images), 'poisson': args.poisson, 'server_args': args.server_args,
+                         'checkpoint': None if args.url else args.checkpoint},
+              'server_start': {}, 'levels': []}
+    try:
+        if pid is not None:
+            rss, peak = rss_bytes(pid)
+            report['server_start'] = {'rss_mb': (rss or 0) / 2 ** 20, 'rss_mb_high_water': (peak or 0) / 2 ** 20}
+        for endpoint, data in zip(itertools.cycle(args.endpoints), images[:max(args.warmup, 0)]):
+            send(make_request(base_url, endpoint, data), args.timeout)
+
+        levels = args.rates if args.mode == 'open' else args.concurrency
+        for endpoint in args.endpoints:
+            for level in levels:
+                with RssSampler(pid) as sampler:
+                    if args.mode == 'open':
+                        result = open_loop(base_url, endpoint, images, level, args)
+                    else:
+                        result = closed_loop(base_url, endpoint, images, level, args)
+                result = dict(result, endpoint=endpoint, **sampler.summary())
+                report['levels'].append(result)
+                print('{} {} {}: {:.2f} req/s, p50 {} ms, p99 {} ms, errors {:.1%}'.format(
+                    endpoint, args.mode, level, result['throughput'], round(result.get('p50_ms', float('nan')), 1),
+                    round(result.get('p99_ms', float('nan')), 1), result['error_rate']), file=sys.stderr)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text)
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,115 @@
+"""
+Startup benchmark: import time of the entry modules, checkpoint load time and server time-to-first-request
+
+Every import is measured in a fresh interpreter, the server is started as a subprocess and polled with a
+real /get_people_num request until it answers. Results are printed as json.
+
+python bench_startup.py -c CSRNet_models_weights/partA_student.pth.tar --weights partA_student.weights.pth
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+parser = argparse.ArgumentParser(description='CSRNet startup benchmark')
+parser.add_argument('--checkpoint', '-c', metavar='CHECKPOINT', default='CSRNet_models_weights/partA_student.pth.tar',
+                    type=str,
+                    help='train.py checkpoint')
+parser.add_argument('--weights', '-w', default='', type=str,
+                    help='export_weights.py output to compare with the checkpoint')
+parser.add_argument('--modules', nargs='+', default=['utils', 'inference', 'models', 'train', 'test', 'server'],
+                    help='modules whose import time is measured')
+parser.add_argument('--repeat', '-r', default=5, type=int,
+                    help='runs per measurement, the median is reported')
+parser.add_argument('--image', '-i', default='', type=str,
+                    help='image posted to the server, a blank 576x864 jpeg by default')
+parser.add_argument('--port', default=24533, type=int,
+                    help='port of the benchmarked server')
+parser.add_argument('--timeout', default=120., type=float,
+                    help='seconds to wait for the first response')
+parser.add_argument('--out', '-o', default='', type=str,
+                    help='also write the json report to this file')
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def _python(code: str) -> str:
+    return subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True, capture_output=True,
+                          text=True).stdout.strip().splitlines()[-1]
+
+
+def import_seconds(module: str, repeat: int) -> dict:
+    code = 'import time; t = time.perf_counter(); import {}; print(time.perf_counter() - t)'.format(module)
+    runs = [float(_python(code)) for _ in range(repeat)]
+    # a module pulling in flask or matplotlib shows up here
+    heavy = _python('import json, sys, {}; print(json.dumps([m for m in ("flask", "matplotlib", "h5py") '
+                    'if m in sys.modules]))'.format(module))
+    return {'median': statistics.median(runs), 'min': min(runs), 'heavy_modules': json.loads(heavy)}
+
+
+def load_seconds(path: str, repeat: int) -> dict:
+    code = ('import time, torch; from models import build_model, load_checkpoint; m = build_model(); '
+            't = time.perf_counter(); load_checkpoint(m, {!r}); print(time.perf_counter() - t)').format(path)
+    runs = [float(_python(code)) for _ in range(repeat)]
+    return {'median': statistics.median(runs), 'min': min(runs), 'size_mb': os.path.getsize(path) / 2 ** 20}
+
+
+def _image_bytes(path: str) -> bytes:
+    if path:
+        with open(path, 'rb') as f:
+            return f.read()
+    import cv2
+    import numpy as np
+    return cv2.imencode('.jpg', np.full((576, 864, 3), 127, dtype=np.uint8))[1].tobytes()
+
+
+def first_request_seconds(checkpoint: str, data: bytes, port: int, timeout: float) -> dict:
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, 'server.py', '-c', checkpoint, '--port', str(port)], cwd=ROOT,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = 'http://127.0.0.1:{}/get_people_num'.format(port)
+    try:
+        while time.perf_counter() - start < timeout:
+            if server.poll() is not None:
+                raise RuntimeError('server exited with code {}'.format(server.returncode))
+            request = urllib.request.Request(url, data=data, headers={'Content-Type': 'image/jpeg'})
+            try:
+                sent = time.perf_counter()
+                urllib.request.urlopen(request, timeout=timeout).read()
+                done = time.perf_counter()
+                return {'ready': sent - start, 'first_request': done - start, 'first_request_latency': done - sent}
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.05)
+        raise RuntimeError('no response within {}s'.format(timeout))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main(args):
+    report = {'imports': {}, 'checkpoint_load': {}, 'server': {}}
+    for module in args.modules:
+        report['imports'][module] = import_seconds(module, args.repeat)
+        print('import {}: {:.3f}s'.format(module, report['imports'][module]['median']), file=sys.stderr)
+
+    data = _image_bytes(args.image)
+    for path in filter(None, [args.checkpoint, args.weights]):
+        report['checkpoint_load'][path] = load_seconds(path, args.repeat)
+        report['server'][path] = first_request_seconds(path, data, args.port, args.timeout)
+        print('{}: load {:.3f}s, first request after {:.2f}s'.format(
+            path, report['checkpoint_load'][path]['median'], report['server'][path]['first_request']), file=sys.stderr)
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text)
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,129 @@
+"""
+Resolution buckets: every image runs at one of a few fixed input shapes
+
+pad: the image is padded (inference.padded_batch) to the smallest bucket it fits in,
+    images larger than every bucket are scaled down into the bucket that keeps the most of them
+resize: the image is scaled, aspect ratio kept, into the bucket whose shape is closest to its own and the
+    rest is padded
+The density is cropped to the image's cells. A scaled image's density is resampled back to the cells of the
+original image with its sum kept, the count of a scene does not change with the scale it is seen at.
+
+BucketedModel traces and freezes one graph per bucket shape and runs every shape at load time, so no request
+pays for allocation, kernel selection or compilation of a new shape. Other shapes run the eager model.
+"""
+import math
+import time
+import warnings
+
+import cv2
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from inference import OUTPUT_STRIDE, is_raw_input, padded_batch, run_density
+
+
+class ResolutionBuckets(object):
+    def __init__(self, sizes: list, mode: str = 'pad'):
+        """
+        :param sizes: [(height, width), ...], rounded up to the output stride
+        """
+        if mode not in ('pad', 'resize'):
+            raise ValueError('bucket mode must be pad or resize')
+        if not sizes:
+            raise ValueError('at least one bucket size is needed')
+        sizes = {(-(-int(h) // OUTPUT_STRIDE) * OUTPUT_STRIDE, -(-int(w) // OUTPUT_STRIDE) * OUTPUT_STRIDE)
+                 for h, w in sizes}
+        self.sizes = sorted(sizes, key=lambda size: (size[0] * size[1], size))
+        self.mode = mode
+
+    @classmethod
+    def parse(cls, spec: str, mode: str = 'pad'):
+        """
+        Buckets from '576x864,768x1024' (height x width)
+        """
+        sizes = []
+        for item in spec.split(','):
+            height, width = item.lower().split('x')
+            sizes.append((int(height), int(width)))
+        return cls(sizes, mode)
+
+    def pick(self, height: int, width: int) -> tuple:
+        """
+        (bucket_height, bucket_width, scale) for an image of height x width
+        """
+        if self.mode == 'pad':
+            for bucket_h, bucket_w in self.sizes:
+                if height <= bucket_h and width <= bucket_w:
+                    return bucket_h, bucket_w, 1.
+            # too large for every bucket, keep as much resolution as possible
+            return max(((h, w, min(h / height, w / width)) for h, w in self.sizes), key=lambda b: b[2])
+
+        aspect = math.log(height / width)
+        bucket_h, bucket_w = min(self.sizes, key=lambda s: (abs(math.log(s[0] / s[1]) - aspect),
+                                                            abs(math.log(s[0] * s[1] / (height * width)))))
+        return bucket_h, bucket_w, min(bucket_h / height, bucket_w / width)
+
+
+def run_bucketed(model, img, buckets: ResolutionBuckets, device='cpu'):
+    """
+    Density (1, 1, H/8, W/8) of a BGR image of height H and width W run at its bucket's shape
+    """
+    height, width = img.shape[:2]
+    bucket_h, bucket_w, scale = buckets.pick(height, width)
+    frame = img
+    if scale != 1.:
+        size = (min(max(int(round(width * scale)), 1), bucket_w), min(max(int(round(height * scale)), 1), bucket_h))
+        frame = cv2.resize(img, size, interpolation=cv2.INTER_AREA if scale < 1. else cv2.INTER_LINEAR)
+    batch = padded_batch(model, [frame], bucket_h, bucket_w, device)
+    density = run_density(model, batch)
+    density = density[:, :, :-(-frame.shape[0] // OUTPUT_STRIDE), :-(-frame.shape[1] // OUTPUT_STRIDE)]
+    if scale != 1.:
+        total = density.sum()
+        density = F.interpolate(density, size=(-(-height // OUTPUT_STRIDE), -(-width // OUTPUT_STRIDE)),
+                                mode='bilinear', align_corners=False)
+        if density.sum() > 0:
+            density = density * (total / density.sum())
+    return density
+
+
+class BucketedModel(nn.Module):
+    """
+    Model running the precompiled graph of its input shape when there is one, the eager model otherwise
+    """
+
+    def __init__(self, model, buckets: ResolutionBuckets):
+        super(BucketedModel, self).__init__()
+        self.model = model
+        self.buckets = buckets
+        self.raw_input = is_raw_input(model)
+        self.graphs = {}
+
+    def forward(self, x):
+        graph = self.graphs.get(tuple(x.shape))
+        if graph is not None:
+            return graph(x)
+        return self.model(x)
+
+    def prepare(self, device='cpu', compile: bool = True, runs: int = 2) -> dict:
+        """
+        Trace and freeze (compile=True, torchscript and exported models are already compiled) and warm up one graph per
+        bucket with batch size 1, returns the seconds of the last warm-up run per bucket
+        """
+        seconds = {}
+        for bucket_h, bucket_w in self.buckets.sizes:
+            example = torch.zeros((1, 3, bucket_h, bucket_w), device=device).contiguous(
+                memory_format=torch.channels_last)
+            if compile and not isinstance(self.model, (torch.jit.ScriptModule, torch.fx.GraphModule)):
+                with torch.no_grad(), warnings.catch_warnings():
+                    # shape dependent python branches are fixed on purpose, the graph only sees this shape
+                    warnings.simplefilter('ignore')
+                    graph = torch.jit.freeze(torch.jit.trace(self.model.eval(), example, check_trace=False))
+                self.graphs[tuple(example.shape)] = graph
+            for _ in range(runs):
+                start = time.time()
+                run_density(self, example)
+                if str(device).startswith('cuda'):
+                    torch.cuda.synchronize()
+                seconds['{}x{}'.format(bucket_h, bucket_w)] = round(time.time() - start, 4)
+        return seconds
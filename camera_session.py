@@ -0,0 +1,134 @@
+"""
+Incremental counting for static cameras
+
+A session keeps the last density map of a camera. Each new frame is split into tiles, tiles whose
+mean absolute difference to the reference exceeds a threshold are marked as changed. A changed pixel moves
+every output cell within the receptive field, so the changed tiles are grown by `spread` tiles (by default
+enough to cover the halo, which keeps the result equal to a full pass), merged into rectangles and re-run
+with their receptive field halo. The new cells replace those of the cached density map.
+"""
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from inference import OUTPUT_STRIDE, RECEPTIVE_HALO, CvImgType, crop_densities, run_frames
+
+
+class CameraSession(object):
+    def __init__(self, model, tile_size: int = 128, threshold: float = 6.0, spread: int = None, device='cpu'):
+        """
+        :param tile_size: tile side in pixels, multiple of the output stride (8)
+        :param threshold: mean absolute gray level difference that marks a tile as changed
+        :param spread: neighbour tiles recomputed around a changed tile, None covers the receptive
+            field (exact), 0 only recomputes the changed tiles (approximate, cheapest)
+        """
+        if tile_size % OUTPUT_STRIDE:
+            raise ValueError('tile_size must be a multiple of {}'.format(OUTPUT_STRIDE))
+        self.model = model
+        self.tile_size = tile_size
+        self.threshold = threshold
+        self.spread = -(-RECEPTIVE_HALO // tile_size) if spread is None else spread
+        self.device = device
+        self.reference = None
+        self.density = None
+        self.lock = threading.Lock()
+
+    def _tiles(self, height: int, width: int) -> list:
+        t = self.tile_size
+        return [(x0, y0, min(x0 + t, width), min(y0 + t, height))
+                for y0 in range(0, height, t) for x0 in range(0, width, t)]
+
+    def _changed_tiles(self, gray):
+        height, width = gray.shape
+        t = self.tile_size
+        diff = cv2.absdiff(gray, self.reference).astype(np.float32)
+        # pad to whole tiles so the per tile mean is one reshape
+        pad_h, pad_w = -height % t, -width % t
+        diff = np.pad(diff, ((0, pad_h), (0, pad_w)))
+        area = np.pad(np.ones((height, width), dtype=np.float32), ((0, pad_h), (0, pad_w)))
+        rows, cols = diff.shape[0] // t, diff.shape[1] // t
+        tile_diff = diff.reshape(rows, t, cols, t).sum(axis=(1, 3)) / area.reshape(rows, t, cols, t).sum(axis=(1, 3))
+        return tile_diff > self.threshold
+
+    def _recompute_boxes(self, changed, height: int, width: int) -> list:
+        """
+        Rectangles (x0, y0, x1, y1, n_tiles) covering the changed tiles grown by spread
+        """
+        mask = changed.astype(np.uint8)
+        if self.spread:
+            kernel = np.ones((2 * self.spread + 1, 2 * self.spread + 1), dtype=np.uint8)
+            mask = cv2.dilate(mask, kernel)
+        n, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+        t = self.tile_size
+        boxes = []
+        for i in range(1, n):
+            col, row, cols, rows = stats[i, :4]
+            boxes.append((col * t, row * t, min((col + cols) * t, width), min((row + rows) * t, height),
+                          int(rows * cols)))
+        return boxes
+
+    def update(self, img: CvImgType) -> dict:
+        """
+        Count a new frame, returns count, recomputed_tiles and total_tiles
+        """
+        height, width = img.shape[:2]
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        tiles = self._tiles(height, width)
+
+        with self.lock:
+            if self.reference is None or self.reference.shape != gray.shape:
+                density = run_frames(self.model, [img], self.device)
+                self.density = density[0, 0].cpu().numpy()
+                self.reference = gray
+                return {'count': float(self.density.sum()),
+                        'recomputed_tiles': len(tiles),
+                        'total_tiles': len(tiles)}
+
+            changed = self._changed_tiles(gray)
+            boxes = self._recompute_boxes(changed, height, width) if changed.any() else []
+            if boxes:
+                results = crop_densities(self.model, img, [box[:4] for box in boxes], RECEPTIVE_HALO, self.device)
+                for cell_x, cell_y, d in results:
+                    self.density[cell_y:cell_y + d.shape[0], cell_x:cell_x + d.shape[1]] = d
+                # only changed tiles move the reference, slow drift still adds up to a change
+                t = self.tile_size
+                for row, col in zip(*np.nonzero(changed)):
+                    y0, x0 = row * t, col * t
+                    self.reference[y0:y0 + t, x0:x0 + t] = gray[y0:y0 + t, x0:x0 + t]
+
+            return {'count': float(self.density.sum()),
+                    'recomputed_tiles': sum(box[4] for box in boxes),
+                    'total_tiles': len(tiles)}
+
+
+class SessionStore(object):
+    """
+    Sessions by camera id, least recently used sessions are dropped beyond max_sessions
+    """
+
+    def __init__(self, model, max_sessions: int = 64, **session_kwargs):
+        self.model = model
+        self.max_sessions = max_sessions
+        self.session_kwargs = session_kwargs
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def reset(self, model):
+        """
+        Drop all sessions and build new ones with model, cached density maps of the old model are stale
+        """
+        with self.lock:
+            self.model = model
+            self.sessions.clear()
+
+    def get(self, camera_id: str) -> CameraSession:
+        with self.lock:
+            session = self.sessions.pop(camera_id, None)
+            if session is None:
+                session = CameraSession(self.model, **self.session_kwargs)
+            self.sessions[camera_id] = session
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+            return session
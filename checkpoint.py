@@ -0,0 +1,184 @@
+"""
+Checkpoint writing off the training thread and a contiguous weight format
+
+AsyncCheckpointer.save() copies the state to CPU memory (a memcpy, the training loop can keep changing the
+model right after) and a background thread torch.saves it to a temporary file that is atomically renamed.
+Best MAE / MSE markers are hardlinks of the written file (a second write of the in-memory state on file
+systems without hardlinks), manifest.json records the latest and best epochs with their files.
+
+.weights files hold a state_dict as one json header followed by the raw tensors, 64 byte aligned:
+b'CSRW' | uint64 header length | header json | tensors
+Loading memory maps the file, tensors are read lazily by the page cache.
+"""
+import json
+import os
+import queue
+import struct
+import threading
+
+import numpy as np
+import torch
+
+WEIGHTS_MAGIC = b'CSRW'
+_ALIGN = 64
+
+
+def snapshot(obj):
+    """
+    Copy of a (nested) state with every tensor cloned to CPU memory
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def _atomic_save(state, path: str):
+    tmp = path + '.tmp'
+    torch.save(state, tmp)
+    os.replace(tmp, path)
+
+
+def _link(src: str, dst: str) -> bool:
+    tmp = dst + '.tmp'
+    try:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.link(src, tmp)
+        os.replace(tmp, dst)
+        return True
+    except OSError:
+        return False
+
+
+def update_manifest(path: str, **entries):
+    manifest_path = os.path.join(path, 'manifest.json')
+    manifest = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    manifest.update(entries)
+    tmp = manifest_path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, manifest_path)
+
+
+def write_checkpoint(state, mae_is_best: bool, mse_is_best: bool, path: str, filename='checkpoint.pth.tar'):
+    """
+    Atomically write state to path/filename, mark best epochs with hardlinks and manifest entries
+    """
+    target = os.path.join(path, filename)
+    _atomic_save(state, target)
+    epoch = state['epoch']
+    entries = {'latest': {'file': filename, 'epoch': epoch}}
+    for metric, is_best in (('mae', mae_is_best), ('mse', mse_is_best)):
+        if not is_best:
+            continue
+        marker = 'epoch' + str(epoch) + '_best_' + metric + '.pth.tar'
+        value = state.get(metric + '_best_prec1')
+        # train.py keeps the best MAE / MSE as 0-d tensors
+        entry = {'epoch': epoch, 'value': float(value) if value is not None else None}
+        if not _link(target, os.path.join(path, marker)):
+            # no hardlinks on this file system, serialize the in-memory state once more
+            _atomic_save(state, os.path.join(path, marker))
+        entry['file'] = marker
+        entries['best_' + metric] = entry
+    update_manifest(path, **entries)
+
+
+class AsyncCheckpointer(object):
+    def __init__(self, path: str, max_pending: int = 1):
+        """
+        :param max_pending: snapshots waiting to be written, save() blocks beyond it so at most this many
+            copies of the state sit in memory
+        """
+        self.path = path
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def save(self, state, mae_is_best: bool, mse_is_best: bool, filename='checkpoint.pth.tar'):
+        self._raise()
+        self.queue.put((snapshot(state), mae_is_best, mse_is_best, filename))
+
+    def wait(self):
+        """
+        Block until every queued checkpoint is on disk
+        """
+        self.queue.join()
+        self._raise()
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                state, mae_is_best, mse_is_best, filename = item
+                write_checkpoint(state, mae_is_best, mse_is_best, self.path, filename)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+
+def save_weights_file(state_dict: dict, path: str, meta: dict = None):
+    """
+    Write a state_dict (teacher or student) as a .weights file, meta is stored in the header
+    """
+    entries = []
+    offset = 0
+    arrays = []
+    for name, tensor in state_dict.items():
+        array = tensor.detach().cpu().contiguous().numpy()
+        entries.append({'name': name, 'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset})
+        arrays.append(array)
+        offset += -(-array.nbytes // _ALIGN) * _ALIGN
+    header = json.dumps({'tensors': entries, 'meta': meta or {}}).encode('utf-8')
+    data_start = -(-(len(WEIGHTS_MAGIC) + 8 + len(header)) // _ALIGN) * _ALIGN
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(WEIGHTS_MAGIC + struct.pack('<Q', len(header)) + header)
+        for entry, array in zip(entries, arrays):
+            f.seek(data_start + entry['offset'])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp, path)
+
+
+def load_weights_file(path: str) -> tuple:
+    """
+    (state_dict, meta) of a .weights file, tensors are copy-on-write views of the memory mapped file
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(WEIGHTS_MAGIC)) != WEIGHTS_MAGIC:
+            raise ValueError("'{}' is not a .weights file".format(path))
+        header_len, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    data_start = -(-(len(WEIGHTS_MAGIC) + 8 + header_len) // _ALIGN) * _ALIGN
+    size = os.path.getsize(path) - data_start
+    data = np.memmap(path, dtype=np.uint8, mode='c', offset=data_start, shape=(size,)) if size else None
+
+    state_dict = {}
+    for entry in header['tensors']:
+        dtype = np.dtype(entry['dtype'])
+        count = int(np.prod(entry['shape'], dtype=np.int64))
+        array = data[entry['offset']:entry['offset'] + count * dtype.itemsize].view(dtype).reshape(entry['shape'])
+        state_dict[entry['name']] = torch.from_numpy(array)
+    return state_dict, header['meta']
@@ -0,0 +1,152 @@
+"""
+Per-image metadata index for the train/val/test json lists
+
+One compact json file per list with width, height, head count, density checksum and the image / ground
+truth mtimes of every image. Re-running the builder only re-reads images whose files changed, consumers
+sort and shard by size without opening the images.
+
+python dataset_index.py --json preprocess/A_train.json
+"""
+import argparse
+import json
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from image import PointDensity, load_gt
+
+INDEX_VERSION = 1
+FIELDS = ['width', 'height', 'count', 'checksum', 'mtime', 'gt_mtime']
+
+
+def index_path_for(json_path: str) -> str:
+    return os.path.splitext(json_path)[0] + '.index.json'
+
+
+def gt_path_for(img_path: str) -> str:
+    return img_path.replace('images', 'ground-truth-h5').replace('.jpg', '.h5')
+
+
+def _mtime(path: str) -> int:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return 0
+
+
+def _make_entry(img_path: str) -> dict:
+    with Image.open(img_path) as img:
+        # only the header is read
+        width, height = img.size
+
+    gt_path = gt_path_for(img_path)
+    count, checksum = 0.0, 0
+    if os.path.exists(gt_path):
+        target = load_gt(gt_path)
+        if isinstance(target, PointDensity):
+            count = target.sum()
+            checksum = zlib.crc32(target.sigmas.tobytes(), zlib.crc32(target.points.tobytes()))
+        else:
+            count = float(target.sum())
+            checksum = zlib.crc32(np.ascontiguousarray(target).tobytes())
+
+    return {'width': width, 'height': height, 'count': round(count, 3), 'checksum': checksum,
+            'mtime': _mtime(img_path), 'gt_mtime': _mtime(gt_path)}
+
+
+def is_stale(entry: dict, img_path: str) -> bool:
+    """
+    An entry is stale once the image or its ground truth was modified after indexing
+    """
+    return entry is None or entry['mtime'] != _mtime(img_path) or entry['gt_mtime'] != _mtime(gt_path_for(img_path))
+
+
+def load_index(index_path: str) -> dict:
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path, 'r') as f:
+        data = json.load(f)
+    if data.get('version') != INDEX_VERSION:
+        return {}
+    fields = data['fields']
+    return {path: dict(zip(fields, values)) for path, values in data['entries'].items()}
+
+
+def save_index(index: dict, index_path: str):
+    data = {'version': INDEX_VERSION,
+            'fields': FIELDS,
+            'entries': {path: [entry[k] for k in FIELDS] for path, entry in index.items()}}
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.replace(tmp_path, index_path)
+
+
+def build_index(img_paths: list, index_path: str, workers: int = 8) -> dict:
+    """
+    Update the index at index_path for img_paths, only changed or new images are read
+    """
+    old_index = load_index(index_path)
+    index = {}
+    todo = []
+    for img_path in img_paths:
+        entry = old_index.get(img_path)
+        if is_stale(entry, img_path):
+            todo.append(img_path)
+        else:
+            index[img_path] = entry
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for img_path, entry in zip(todo, pool.map(_make_entry, todo)):
+            index[img_path] = entry
+
+    save_index(index, index_path)
+    print('index {}: {} images, {} updated, {} removed'.format(
+        index_path, len(index), len(todo), len(set(old_index) - set(index))))
+    return index
+
+
+def filter_stale(img_paths: list, index: dict) -> list:
+    """
+    Drop images that are missing from the index or changed since it was built
+    """
+    return [p for p in img_paths if not is_stale(index.get(p), p)]
+
+
+def pixels(index: dict, img_path: str) -> int:
+    entry = index.get(img_path)
+    return entry['width'] * entry['height'] if entry else 0
+
+
+def sort_by_size(img_paths: list, index: dict, descending: bool = True) -> list:
+    return sorted(img_paths, key=lambda p: pixels(index, p), reverse=descending)
+
+
+def balance_workers(img_paths: list, index: dict, num_workers: int) -> list:
+    """
+    Split img_paths into num_workers shards of similar total pixels (largest first greedy)
+    """
+    shards = [[] for _ in range(num_workers)]
+    loads = [0] * num_workers
+    for img_path in sort_by_size(img_paths, index):
+        idx = loads.index(min(loads))
+        shards[idx].append(img_path)
+        loads[idx] += max(pixels(index, img_path), 1)
+    return shards
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build dataset index')
+    parser.add_argument('--json', '-j', type=str, nargs='+', default=['preprocess/A_train.json'],
+                        help='train/val/test json files to index')
+    parser.add_argument('--workers', '-w', type=int, default=8,
+                        help='threads reading images and ground truth')
+    args = parser.parse_args()
+
+    for json_path in args.json:
+        with open(json_path, 'r') as f:
+            paths = json.load(f)
+        build_index(paths, index_path_for(json_path), args.workers)
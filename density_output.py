@@ -0,0 +1,92 @@
+"""
+Compact encodings of density maps and head locations for the API
+
+png16/png8: the density map quantized to uint16/uint8 with one scale factor (value = pixel * scale), lossless
+    PNG, base64 encoded
+sparse: [x, y, value] of the cells above a threshold, largest first
+Maps with more than max_cells cells are sum pooled by an integer factor first, so counts are preserved and
+the response stays bounded. cell_size is the input pixels covered by one cell.
+"""
+import base64
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from inference import OUTPUT_STRIDE
+
+DENSITY_FORMATS = ('png16', 'png8', 'sparse')
+
+
+def _pool_to(density: np.ndarray, max_cells: int) -> tuple:
+    """
+    Sum pool by the smallest integer factor that leaves at most max_cells cells, returns (density, factor)
+    """
+    height, width = density.shape
+    factor = 1
+    while -(-height // factor) * -(-width // factor) > max_cells:
+        factor += 1
+    if factor > 1:
+        pad_h, pad_w = -height % factor, -width % factor
+        density = np.pad(density, ((0, pad_h), (0, pad_w)))
+        density = density.reshape(density.shape[0] // factor, factor, density.shape[1] // factor, factor).sum(axis=(1, 3))
+    return density, factor
+
+
+def encode_density(density: np.ndarray, fmt: str = 'png16', max_cells: int = 65536, threshold: float = 0.001) -> dict:
+    """
+    density: (H/8, W/8) float map of one image
+    """
+    if fmt not in DENSITY_FORMATS:
+        raise ValueError('density format must be one of {}'.format(', '.join(DENSITY_FORMATS)))
+    density, factor = _pool_to(np.maximum(density.astype(np.float32), 0), max_cells)
+    result = {'format': fmt, 'shape': list(density.shape), 'cell_size': OUTPUT_STRIDE * factor}
+
+    if fmt == 'sparse':
+        ys, xs = np.nonzero(density > threshold)
+        values = density[ys, xs]
+        order = np.argsort(-values, kind='stable')[:max_cells]
+        result['threshold'] = threshold
+        result['cells'] = [[int(xs[i]), int(ys[i]), round(float(values[i]), 5)] for i in order]
+        return result
+
+    levels = 65535 if fmt == 'png16' else 255
+    peak = float(density.max())
+    scale = peak / levels if peak > 0 else 1.
+    quantized = np.round(density / scale).astype(np.uint16 if fmt == 'png16' else np.uint8)
+    result['scale'] = scale
+    result['data'] = base64.b64encode(cv2.imencode('.png', quantized)[1].tobytes()).decode('ascii')
+    return result
+
+
+def decode_density(encoded: dict) -> np.ndarray:
+    """
+    Inverse of encode_density, for clients and tests
+    """
+    height, width = encoded['shape']
+    if encoded['format'] == 'sparse':
+        density = np.zeros((height, width), dtype=np.float32)
+        for x, y, value in encoded['cells']:
+            density[y, x] = value
+        return density
+    data = np.frombuffer(base64.b64decode(encoded['data']), np.uint8)
+    return cv2.imdecode(data, cv2.IMREAD_UNCHANGED).astype(np.float32) * encoded['scale']
+
+
+def find_peaks(density, threshold: float = 0.05, max_points: int = 2000, window: int = 3) -> list:
+    """
+    Head locations [x, y, value] in input pixels, largest first
+
+    A cell is a peak when it is the maximum of its window x window neighbourhood (max pool NMS) and
+    above threshold.
+    """
+    density = torch.as_tensor(density, dtype=torch.float32).view(1, 1, *density.shape[-2:])
+    pooled = F.max_pool2d(density, window, stride=1, padding=window // 2)
+    keep = (density == pooled) & (density > threshold)
+    values = density[keep]
+    ys, xs = torch.nonzero(keep[0, 0], as_tuple=True)
+    order = torch.argsort(values, descending=True)[:max_points]
+    half = OUTPUT_STRIDE // 2
+    return [[int(xs[i]) * OUTPUT_STRIDE + half, int(ys[i]) * OUTPUT_STRIDE + half, round(float(values[i]), 5)]
+            for i in order.tolist()]
@@ -0,0 +1,145 @@
+"""
+Evaluate many checkpoints on one test split and rank them by MAE / MSE
+
+The test images are decoded once into a shared memory block as uint8 BGR. Worker processes map the block
+and read the images as numpy views, nothing is copied or decoded again per checkpoint. Models get the input
+normalization folded into their first conv (models.raw_input), so the shared frames are their input as is
+and the block is 4x smaller than normalized float tensors.
+
+python eval_checkpoints.py -tj preprocess/A_test.json -c save/epoch*_best_*.pth.tar --workers 4
+"""
+import argparse
+import glob
+import json
+import math
+import os
+import time
+from multiprocessing import Pool, shared_memory
+
+import cv2
+import numpy as np
+import torch
+
+from dataset_index import gt_path_for
+from image import load_gt
+from inference import run_frames
+from models import build_model, load_checkpoint
+from models.raw_input import fold_input_normalization
+
+parser = argparse.ArgumentParser(description='CSRNet multi-checkpoint evaluation')
+parser.add_argument('--test_json', '-tj', metavar='TEST', default='preprocess/A_test.json',
+                    help='path to test json')
+parser.add_argument('--checkpoints', '-c', nargs='+', required=True,
+                    help='checkpoint files or glob patterns')
+parser.add_argument('--version', '-v', default='quarter_vgg', type=str,
+                    help='vgg/quarter_vgg')
+parser.add_argument('--transform', '-t', default=True, type=bool,
+                    help='1x1 conv transform')
+parser.add_argument('--workers', '-w', default=2, type=int,
+                    help='checkpoints evaluated at the same time')
+parser.add_argument('--threads', default=0, type=int,
+                    help='torch threads per worker, 0 splits the cpu cores between the workers')
+parser.add_argument('--out', '-o', default='', type=str,
+                    help='also write the ranking as json')
+
+# per worker process, set by _attach
+_shm = None
+_frames = None
+_version = None
+_transform = None
+
+
+def decode_to_shared(img_paths: list) -> tuple:
+    """
+    Decode images into one shared memory block, returns (block, layout) with layout [(offset, shape), ...]
+    """
+    frames = [cv2.imread(path) for path in img_paths]
+    for path, frame in zip(img_paths, frames):
+        if frame is None:
+            raise FileNotFoundError("can not read image '{}'".format(path))
+    layout = []
+    offset = 0
+    for frame in frames:
+        layout.append((offset, frame.shape))
+        offset += frame.nbytes
+    block = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for (offset, shape), frame in zip(layout, frames):
+        np.ndarray(shape, dtype=np.uint8, buffer=block.buf, offset=offset)[:] = frame
+    return block, layout
+
+
+def _attach(name: str, layout: list, threads: int, version: str, transform: bool):
+    global _shm, _frames, _version, _transform
+    torch.set_num_threads(threads)
+    _shm = shared_memory.SharedMemory(name=name)
+    _frames = [np.ndarray(shape, dtype=np.uint8, buffer=_shm.buf, offset=offset) for offset, shape in layout]
+    _version = version
+    _transform = transform
+
+
+def _evaluate(task: tuple) -> dict:
+    checkpoint_path, targets = task
+    start = time.time()
+    model = build_model(_version, transform=_transform)
+    try:
+        epoch = load_checkpoint(model, checkpoint_path, transform=_transform)
+    except (FileNotFoundError, KeyError, RuntimeError, ValueError) as e:
+        # one broken file should not cost the ranking of the others
+        return {'checkpoint': checkpoint_path, 'error': str(e).splitlines()[0]}
+    model.eval()
+    fold_input_normalization(model)
+
+    abs_sum = 0.
+    sq_sum = 0.
+    for frame, target in zip(_frames, targets):
+        error = float(run_frames(model, [frame]).sum()) - target
+        abs_sum += abs(error)
+        sq_sum += error ** 2
+    return {'checkpoint': checkpoint_path, 'epoch': epoch, 'mae': abs_sum / len(targets),
+            'mse': math.sqrt(sq_sum / len(targets)), 'seconds': round(time.time() - start, 2)}
+
+
+def expand_checkpoints(patterns: list) -> list:
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) or [pattern]
+        paths.extend(p for p in matches if p not in paths)
+    return paths
+
+
+def main(args):
+    checkpoints = expand_checkpoints(args.checkpoints)
+    with open(args.test_json, 'r') as outfile:
+        test_list = json.load(outfile)
+    targets = [float(load_gt(gt_path_for(path)).sum()) for path in test_list]
+
+    start = time.time()
+    block, layout = decode_to_shared(test_list)
+    print('decoded {} images ({:.1f} MB) in {:.2f}s'.format(len(test_list), block.size / 2 ** 20,
+                                                           time.time() - start))
+    workers = max(1, min(args.workers, len(checkpoints)))
+    threads = args.threads or max(1, (os.cpu_count() or 1) // workers)
+    try:
+        with Pool(workers, initializer=_attach,
+                  initargs=(block.name, layout, threads, args.version, args.transform)) as pool:
+            results = pool.map(_evaluate, [(path, targets) for path in checkpoints], chunksize=1)
+    finally:
+        block.close()
+        block.unlink()
+
+    failed = [r for r in results if 'error' in r]
+    results = sorted((r for r in results if 'error' not in r),
+                     key=lambda r: (math.isnan(r['mae']), r['mae'], r['mse']))
+    print('{:<4} {:<50} {:>6} {:>10} {:>10} {:>8}'.format('rank', 'checkpoint', 'epoch', 'MAE', 'MSE', 'time'))
+    for rank, r in enumerate(results, 1):
+        print('{:<4} {:<50} {:>6} {:>10.3f} {:>10.3f} {:>7.1f}s'.format(
+            rank, r['checkpoint'], str(r['epoch']), r['mae'], r['mse'], r['seconds']))
+    for r in failed:
+        print('failed {}: {}'.format(r['checkpoint'], r['error']))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results + failed, f, indent=2)
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
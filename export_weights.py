@@ -0,0 +1,33 @@
+"""
+Export the weights of a train.py checkpoint for serving
+
+The checkpoint also holds the optimizer state (twice the size of the weights for Adam), the exported file
+only keeps state_dict and epoch and loads memory mapped. An output ending in .weights uses the contiguous
+format of checkpoint.py, anything else the torch zip format.
+
+python export_weights.py -c CSRNet_models_weights/partA_student.pth.tar -o partA_student.weights.pth
+"""
+import argparse
+import os
+
+from models import save_weights
+
+parser = argparse.ArgumentParser(description='Export CSRNet weights')
+parser.add_argument('--checkpoint', '-c', metavar='CHECKPOINT', default='CSRNet_models_weights/partA_student.pth.tar',
+                    type=str,
+                    help='path to the train.py checkpoint')
+parser.add_argument('--out', '-o', default='', type=str,
+                    help='output path, <checkpoint>.weights.pth by default')
+parser.add_argument('--no_transform', action='store_true',
+                    help='drop the 1x1 conv transform layers only used for distillation')
+
+
+def main(args):
+    out = args.out or args.checkpoint.replace('.pth.tar', '') + '.weights.pth'
+    epoch = save_weights(args.checkpoint, out, transform=not args.no_transform)
+    print('{} ({:.1f} MB) -> {} ({:.1f} MB), epoch {}'.format(
+        args.checkpoint, os.path.getsize(args.checkpoint) / 2 ** 20, out, os.path.getsize(out) / 2 ** 20, epoch))
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -4,6 +4,7 @@ import numpy as np
 import h5py
 from PIL import ImageStat
 import cv2
+from scipy.special import ndtr
 
 
 def load_shanghai_data(img_path: str, train: bool = True):
@@ -11,26 +12,54 @@ def load_shanghai_data(img_path: str, train: bool = True):
     Load data
     Use crop_ratio between 0.5 and 1.0 for random crop
     """
+    img, target = load_shanghai_raw(img_path)
+    if train:
+        img, target = random_crop_flip(img, target)
+    return make_sample(img, target)
+
+
+def load_shanghai_raw(img_path: str):
+    """
+    Decode image and full resolution density without any augmentation
+    """
     gt_path = img_path.replace('images', 'ground-truth-h5').replace('.jpg', '.h5')
     img = Image.open(img_path).convert('RGB')
-    gt_file = h5py.File(gt_path)
-    target = np.asarray(gt_file['density'])
-    if train:
-        # 随机裁剪
-        crop_ratio = random.uniform(0.5, 1.0)
-        crop_size = (int(crop_ratio * img.size[0]), int(crop_ratio * img.size[1]))
-        dx = int(random.random() * (img.size[0] - crop_size[0]))
-        dy = int(random.random() * (img.size[1] - crop_size[1]))
+    target = load_gt(gt_path)
+    return img, target
+
+
+def random_crop_flip(img, target):
+    """
+    Random crop with crop_ratio between 0.5 and 1.0, then random horizontal flip
+    """
+    # 随机裁剪
+    crop_ratio = random.uniform(0.5, 1.0)
+    crop_size = (int(crop_ratio * img.size[0]), int(crop_ratio * img.size[1]))
+    dx = int(random.random() * (img.size[0] - crop_size[0]))
+    dy = int(random.random() * (img.size[1] - crop_size[1]))
 
-        img = img.crop((dx, dy, crop_size[0] + dx, crop_size[1] + dy))
+    img = img.crop((dx, dy, crop_size[0] + dx, crop_size[1] + dy))
+    if isinstance(target, PointDensity):
+        target = target.crop(dx, dy, crop_size[0], crop_size[1])
+    else:
         target = target[dy:crop_size[1] + dy, dx:crop_size[0] + dx]
 
-        if random.random() > 0.8:
-            # 左右翻转图片
-            target = np.fliplr(target)
-            img = img.transpose(Image.FLIP_LEFT_RIGHT)
+    if random.random() > 0.8:
+        # 左右翻转图片
+        target = target.fliplr() if isinstance(target, PointDensity) else np.fliplr(target)
+        img = img.transpose(Image.FLIP_LEFT_RIGHT)
+    return img, target
+
 
-    target = reshape_target(target, 3)
+def make_sample(img, target):
+    """
+    Down sample target to the model output resolution
+    """
+    if isinstance(target, PointDensity):
+        # rendered directly at 1/8, no full resolution map is built
+        target = target.render(3)
+    else:
+        target = reshape_target(target, 3)
     target = np.expand_dims(target, axis=0)
 
     img = img.copy()
@@ -44,8 +73,7 @@ def load_ucf_ori_data(img_path: str):
     """
     gt_path = img_path.replace('images', 'ground_truth').replace('.jpg', '.h5')
     img = Image.open(img_path).convert('RGB')
-    gt_file = h5py.File(gt_path)
-    target = np.asarray(gt_file['density'])
+    target = load_density(gt_path)
     return img, target
 
 
@@ -63,3 +91,86 @@ def reshape_target(target, down_sample: int = 3):
         # width = int(width/2)
     target = cv2.resize(target, (width, height), interpolation=cv2.INTER_CUBIC) * (2 ** (down_sample * 2))
     return target
+
+
+def output_size(height: int, width: int, down_sample: int = 3):
+    """
+    Size of the model output for an input of height x width (ceil_mode=True pooling)
+    """
+    for i in range(down_sample):
+        height = int((height + 1) / 2)
+        width = int((width + 1) / 2)
+    return height, width
+
+
+class PointDensity(object):
+    """
+    Density map kept as head points with a gaussian sigma per point
+
+    points are (x, y) pixel centres, shape is (height, width) of the full map. render() integrates
+    each gaussian over the output cells so the count is preserved at any resolution, mass falling
+    outside the map is dropped like gaussian_filter(mode='constant') in the GT scripts.
+    """
+
+    def __init__(self, points, sigmas, shape):
+        self.points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+        self.sigmas = np.maximum(np.asarray(sigmas, dtype=np.float32).reshape(-1), 1e-3)
+        self.shape = (int(shape[0]), int(shape[1]))
+
+    def crop(self, x: int, y: int, width: int, height: int):
+        points = self.points - np.array([x, y], dtype=np.float32)
+        # keep points whose gaussian still reaches into the crop
+        reach = 4 * self.sigmas
+        keep = ((points[:, 0] + reach > 0) & (points[:, 0] - reach < width) &
+                (points[:, 1] + reach > 0) & (points[:, 1] - reach < height))
+        return PointDensity(points[keep], self.sigmas[keep], (height, width))
+
+    def fliplr(self):
+        points = self.points.copy()
+        points[:, 0] = self.shape[1] - points[:, 0]
+        return PointDensity(points, self.sigmas, self.shape)
+
+    def render(self, down_sample: int = 0, chunk: int = 512):
+        height, width = self.shape
+        out_h, out_w = output_size(height, width, down_sample)
+        step = 2 ** down_sample
+        edges_y = np.minimum(np.arange(out_h + 1) * step, height).astype(np.float64)
+        edges_x = np.minimum(np.arange(out_w + 1) * step, width).astype(np.float64)
+
+        density = np.zeros((out_h, out_w), dtype=np.float32)
+        for start in range(0, len(self.points), chunk):
+            pts = self.points[start:start + chunk].astype(np.float64)
+            sig = self.sigmas[start:start + chunk, None].astype(np.float64)
+            # mass of every point in every row / column of cells
+            mass_y = np.diff(ndtr((edges_y[None, :] - pts[:, 1:2]) / sig), axis=1)
+            mass_x = np.diff(ndtr((edges_x[None, :] - pts[:, 0:1]) / sig), axis=1)
+            density += (mass_y.T @ mass_x).astype(np.float32)
+        return density
+
+    def sum(self):
+        return float(self.render(3).sum())
+
+
+def load_gt(gt_path: str):
+    """
+    Read a ground truth h5, either a dense 'density' map or 'points'/'sigmas' written by
+    preprocess/compact_gt.py (returned as a PointDensity)
+    """
+    with h5py.File(gt_path, 'r') as gt_file:
+        if 'points' in gt_file:
+            return PointDensity(gt_file['points'][:], gt_file['sigmas'][:],
+                                (gt_file.attrs['height'], gt_file.attrs['width']))
+        # float16 maps are widened, cv2.resize does not take float16
+        return np.asarray(gt_file['density'], dtype=np.float32)
+
+
+def load_density(gt_path: str, down_sample: int = 0):
+    """
+    Dense density map of a ground truth h5 of either format
+    """
+    target = load_gt(gt_path)
+    if isinstance(target, PointDensity):
+        return target.render(down_sample)
+    if down_sample:
+        return reshape_target(target, down_sample)
+    return target
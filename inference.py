@@ -0,0 +1,337 @@
+"""
+Inference helpers shared by test.py, server.py and video_count.py
+"""
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+import torch
+
+from utils import IMAGENET_MEAN, IMAGENET_STD
+
+CvImgType = np.ndarray
+
+# output cell i of CSRNet / 1/n-CSRNet only sees input pixels [8i - 138, 8i + 7 + 138]
+OUTPUT_STRIDE = 8
+RECEPTIVE_HALO = 144
+
+
+def to_input_batch(frames: list, device='cpu'):
+    """
+    Equal sized BGR uint8 images -> normalized RGB float batch (N, 3, H, W)
+
+    Same result as cvtColor(BGR2RGB) + ToTensor + Normalize per image, done once for the batch.
+    """
+    batch = torch.from_numpy(np.stack(frames))
+    if batch.dim() == 3:
+        # gray images
+        batch = batch.unsqueeze(-1).expand(-1, -1, -1, 3)
+    batch = batch.to(device).flip(-1).permute(0, 3, 1, 2)
+    std = torch.tensor(IMAGENET_STD, dtype=torch.float32, device=batch.device).view(1, -1, 1, 1)
+    mean = torch.tensor(IMAGENET_MEAN, dtype=torch.float32, device=batch.device).view(1, -1, 1, 1)
+    return batch.float().mul_(1. / (255. * std)).sub_(mean / std)
+
+
+class InputPool(object):
+    """
+    Preallocated float input batches per (n, h, w, device) for models taking raw input
+
+    A buffer is handed to one caller at a time and returned afterwards, at most max_buffers idle buffers
+    are kept, the least recently used shapes go first.
+    """
+
+    def __init__(self, max_buffers: int = 16):
+        self.max_buffers = max_buffers
+        self.free = OrderedDict()
+        self.idle = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def acquire(self, n: int, height: int, width: int, device='cpu'):
+        key = (n, height, width, str(device))
+        with self.lock:
+            buffers = self.free.get(key)
+            buf = buffers.pop() if buffers else None
+            if buf is not None:
+                self.idle -= 1
+        if buf is None:
+            # channels_last matches the HWC layout of the frames, filling it is a plain converting copy
+            buf = torch.empty((n, 3, height, width), dtype=torch.float32, device=device,
+                              memory_format=torch.channels_last)
+        try:
+            yield buf
+        finally:
+            with self.lock:
+                self.free.setdefault(key, []).append(buf)
+                self.free.move_to_end(key)
+                self.idle += 1
+                while self.idle > self.max_buffers:
+                    old_key, old = next(iter(self.free.items()))
+                    old.pop(0)
+                    if not old:
+                        del self.free[old_key]
+                    self.idle -= 1
+
+
+INPUT_POOL = InputPool()
+
+
+def is_raw_input(model) -> bool:
+    """
+    True for models folded by models.raw_input, they take raw 0-255 BGR input
+    """
+    return getattr(model, 'raw_input', False)
+
+
+def fill_raw_batch(batch, frames: list):
+    """
+    Copy equal sized BGR uint8 images into a float (N, 3, H, W) batch, one pass per image
+    """
+    for i, frame in enumerate(frames):
+        frame = torch.from_numpy(np.ascontiguousarray(frame))
+        if frame.dim() == 2:
+            frame = frame.unsqueeze(-1).expand(-1, -1, 3)
+        batch[i].copy_(frame.to(batch.device, non_blocking=True).permute(2, 0, 1))
+    return batch
+
+
+def to_raw_batch(frames: list, device='cpu'):
+    """
+    Equal sized BGR uint8 images -> unpooled raw float batch (N, 3, H, W) for folded models
+    """
+    height, width = frames[0].shape[:2]
+    batch = torch.empty((len(frames), 3, height, width), dtype=torch.float32, device=device,
+                        memory_format=torch.channels_last)
+    return fill_raw_batch(batch, frames)
+
+
+@contextmanager
+def input_batch(model, frames: list, device='cpu'):
+    """
+    Model input of equal sized BGR uint8 images: a pooled raw batch for folded models, a normalized
+    batch (to_input_batch) for the others
+    """
+    if is_raw_input(model):
+        height, width = frames[0].shape[:2]
+        with INPUT_POOL.acquire(len(frames), height, width, device) as batch:
+            yield fill_raw_batch(batch, frames)
+    else:
+        yield to_input_batch(frames, device)
+
+
+def run_frames(model, frames: list, device='cpu'):
+    """
+    Density maps (N, 1, H/8, W/8) of equal sized BGR uint8 images
+    """
+    with input_batch(model, frames, device) as batch:
+        return run_density(model, batch)
+
+
+def run_density(model, batch):
+    """
+    Density maps (N, 1, H/8, W/8) for a normalized input batch
+    """
+    with torch.no_grad():
+        return model(batch)
+
+
+def padded_batch(model, frames: list, height: int, width: int, device='cpu'):
+    """
+    Model input (N, 3, height, width) of BGR uint8 images of at most height x width, each padded at the bottom
+    and right with the mean colour (0 after normalization)
+    """
+    batch = torch.zeros((len(frames), 3, height, width), dtype=torch.float32, device=device)
+    batch = batch.contiguous(memory_format=torch.channels_last)
+    if is_raw_input(model):
+        batch[:] = torch.tensor(IMAGENET_MEAN[::-1], device=device).view(1, 3, 1, 1) * 255.
+    for row, frame in enumerate(frames):
+        frame_h, frame_w = frame.shape[:2]
+        if is_raw_input(model):
+            fill_raw_batch(batch[row:row + 1, :, :frame_h, :frame_w], [frame])
+        else:
+            batch[row, :, :frame_h, :frame_w] = to_input_batch([frame], device)[0]
+    return batch
+
+
+def count_batch(model, frames: list, device='cpu') -> list:
+    density = run_frames(model, frames, device)
+    return density.sum(dim=(1, 2, 3)).tolist()
+
+
+def _align_box(box: tuple, height: int, width: int) -> tuple:
+    x0, y0, x1, y1 = box
+    x0 = max(int(x0) // OUTPUT_STRIDE * OUTPUT_STRIDE, 0)
+    y0 = max(int(y0) // OUTPUT_STRIDE * OUTPUT_STRIDE, 0)
+    x1 = min(-(-int(x1) // OUTPUT_STRIDE) * OUTPUT_STRIDE, width)
+    y1 = min(-(-int(y1) // OUTPUT_STRIDE) * OUTPUT_STRIDE, height)
+    return x0, y0, x1, y1
+
+
+def crop_densities(model, img: CvImgType, boxes: list, halo: int = RECEPTIVE_HALO, device='cpu',
+                   batch_size: int = 8) -> list:
+    """
+    Density of boxes (x0, y0, x1, y1) of a BGR image without running the full image
+
+    Boxes are aligned to the output stride and computed on a crop padded by the receptive field halo,
+    so the cells match a full image pass. Returns (cell_x, cell_y, density) per box where density is
+    a float32 array and (cell_x, cell_y) is its top left cell in the full output.
+    Crops of the same size are run as one batch.
+    """
+    height, width = img.shape[:2]
+    crops = []
+    for box in boxes:
+        x0, y0, x1, y1 = _align_box(box, height, width)
+        cx0, cy0 = max(x0 - halo, 0), max(y0 - halo, 0)
+        cx1, cy1 = min(x1 + halo, width), min(y1 + halo, height)
+        cells = ((x0 - cx0) // OUTPUT_STRIDE, (y0 - cy0) // OUTPUT_STRIDE,
+                 -(-(x1 - x0) // OUTPUT_STRIDE), -(-(y1 - y0) // OUTPUT_STRIDE))
+        crops.append(((cx0, cy0, cx1, cy1), cells, (x0 // OUTPUT_STRIDE, y0 // OUTPUT_STRIDE)))
+
+    groups = {}
+    for idx, (crop, _, _) in enumerate(crops):
+        groups.setdefault((crop[3] - crop[1], crop[2] - crop[0]), []).append(idx)
+
+    results = [None] * len(crops)
+    for indices in groups.values():
+        for start in range(0, len(indices), batch_size):
+            chunk = indices[start:start + batch_size]
+            frames = [img[crops[i][0][1]:crops[i][0][3], crops[i][0][0]:crops[i][0][2]] for i in chunk]
+            density = run_frames(model, frames, device).cpu().numpy()
+            for i, d in zip(chunk, density):
+                ox, oy, nw, nh = crops[i][1]
+                results[i] = (crops[i][2][0], crops[i][2][1], d[0, oy:oy + nh, ox:ox + nw])
+    return results
+
+
+def _merge_boxes(boxes: list, halo: int) -> list:
+    """
+    Merge boxes whose union is cheaper to run than the two crops (each padded by halo) separately
+    """
+    def area(b):
+        return (b[2] - b[0] + 2 * halo) * (b[3] - b[1] + 2 * halo)
+
+    boxes = [tuple(b) for b in boxes]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                union = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                if area(union) <= area(a) + area(b):
+                    boxes[i] = union
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return boxes
+
+
+def count_rois(model, img: CvImgType, polygons: list, halo: int = RECEPTIVE_HALO, device='cpu') -> list:
+    """
+    Count inside each polygon [[x, y], ...] of a BGR image
+
+    Only the polygons' bounding boxes plus the receptive field halo go through the model, cells on
+    the polygon border are weighted by the fraction of their area inside the polygon.
+    """
+    height, width = img.shape[:2]
+    polygons = [np.asarray(p, dtype=np.float32).reshape(-1, 2) for p in polygons]
+    boxes = []
+    for p in polygons:
+        x0, y0 = np.floor(p.min(axis=0)).astype(int)
+        x1, y1 = np.ceil(p.max(axis=0)).astype(int) + 1
+        boxes.append((max(x0, 0), max(y0, 0), min(x1, width), min(y1, height)))
+
+    crops = _merge_boxes([b for b in boxes if b[2] > b[0] and b[3] > b[1]], halo)
+    results = crop_densities(model, img, crops, halo, device)
+
+    counts = []
+    for p, box in zip(polygons, boxes):
+        if box[2] <= box[0] or box[3] <= box[1]:
+            counts.append(0.)
+            continue
+        cell_x, cell_y, density = next(r for r, c in zip(results, crops)
+                                       if c[0] <= box[0] and c[1] <= box[1] and c[2] >= box[2] and c[3] >= box[3])
+        nh, nw = density.shape
+        # coverage of every output cell, rasterized at full resolution then averaged per cell
+        mask = np.zeros((nh * OUTPUT_STRIDE, nw * OUTPUT_STRIDE), dtype=np.uint8)
+        shifted = np.round(p - np.array([cell_x, cell_y]) * OUTPUT_STRIDE).astype(np.int32)
+        cv2.fillPoly(mask, [shifted], 1)
+        coverage = mask.reshape(nh, OUTPUT_STRIDE, nw, OUTPUT_STRIDE).mean(axis=(1, 3))
+        counts.append(float((density * coverage).sum()))
+    return counts
+
+
+def count_cascade(model, img: CvImgType, scale: float = 0.5, threshold: float = 0.01,
+                  max_region_fraction: float = 0.5, halo: int = RECEPTIVE_HALO, device='cpu') -> dict:
+    """
+    Coarse-to-fine counting of a BGR image
+
+    The image is first run downscaled by `scale`. Output cells (8x8 px at full resolution) whose coarse
+    density exceeds `threshold` are crowded:
+    coarse: no crowded cell, the coarse count is returned
+    regional: crowded regions are re-run at full resolution and replace the coarse estimate there
+    full: crowded regions cover more than max_region_fraction of the image, one full resolution pass
+    returns {'count', 'path', 'regions'}
+    """
+    height, width = img.shape[:2]
+    out_h, out_w = -(-height // OUTPUT_STRIDE), -(-width // OUTPUT_STRIDE)
+    small = cv2.resize(img, (max(int(width * scale), 1), max(int(height * scale), 1)), interpolation=cv2.INTER_AREA)
+    coarse = run_frames(model, [small], device)[0, 0].cpu().numpy()
+    # coarse density spread over the full resolution output cells, sum preserved
+    up = cv2.resize(coarse, (out_w, out_h), interpolation=cv2.INTER_LINEAR)
+    if up.sum() > 0:
+        up *= coarse.sum() / up.sum()
+
+    crowded = (up > threshold).astype(np.uint8)
+    if not crowded.any():
+        return {'count': float(coarse.sum()), 'path': 'coarse', 'regions': 0}
+    crowded = cv2.dilate(crowded, np.ones((3, 3), dtype=np.uint8))
+    if crowded.mean() > max_region_fraction:
+        density = run_frames(model, [img], device)
+        return {'count': float(density.sum()), 'path': 'full', 'regions': 0}
+
+    n, _, stats, _ = cv2.connectedComponentsWithStats(crowded, connectivity=8)
+    boxes = [(x * OUTPUT_STRIDE, y * OUTPUT_STRIDE, (x + w) * OUTPUT_STRIDE, (y + h) * OUTPUT_STRIDE)
+             for x, y, w, h in stats[1:n, :4]]
+    boxes = _merge_boxes(boxes, halo)
+
+    covered = np.zeros((out_h, out_w), dtype=bool)
+    count = 0.
+    for cell_x, cell_y, density in crop_densities(model, img, boxes, halo, device):
+        region = covered[cell_y:cell_y + density.shape[0], cell_x:cell_x + density.shape[1]]
+        # merged boxes may overlap, count every cell once
+        count += float(density[~region].sum())
+        region[:] = True
+    count += float(up[~covered].sum())
+    return {'count': count, 'path': 'regional', 'regions': len(boxes)}
+
+
+def count_images(model, images: list, device='cpu', batch_size: int = 8, bucket: int = 1) -> list:
+    """
+    Counts of BGR images of any sizes, in input order
+
+    Images of equal size are run as batches of at most batch_size, the counts are those of single image
+    passes. bucket > 1 is opt-in padding: sizes rounded up to a multiple of `bucket` are batched together
+    (padded_batch) and each density is cropped to the image's own cells, but every cell within the receptive
+    field of the padding sees it, so counts can be far off a single image pass.
+    """
+    groups = {}
+    for idx, img in enumerate(images):
+        height, width = img.shape[:2]
+        groups.setdefault((-(-height // bucket) * bucket, -(-width // bucket) * bucket), []).append(idx)
+
+    counts = [None] * len(images)
+    for (pad_h, pad_w), indices in groups.items():
+        for start in range(0, len(indices), batch_size):
+            chunk = indices[start:start + batch_size]
+            batch = padded_batch(model, [images[i] for i in chunk], pad_h, pad_w, device)
+            density = run_density(model, batch)
+            for row, i in enumerate(chunk):
+                height, width = images[i].shape[:2]
+                cells_h, cells_w = -(-height // OUTPUT_STRIDE), -(-width // OUTPUT_STRIDE)
+                counts[i] = float(density[row, 0, :cells_h, :cells_w].sum())
+    return counts
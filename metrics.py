@@ -0,0 +1,152 @@
+"""
+Minimal Prometheus metrics (text exposition format 0.0.4) for server.py
+
+Counter, Gauge and Histogram keep one value (or bucket row) per label combination and are thread safe.
+REGISTRY.render() returns the text served at /metrics.
+
+with STAGE_SECONDS.time(stage='decode'):
+    img = cv2.imdecode(...)
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+PIXEL_BUCKETS = (1e5, 3e5, 5e5, 1e6, 2e6, 4e6, 8e6, 1.6e7, 3.2e7, 6.4e7)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = ['{}="{}"'.format(n, _escape(v)) for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric(object):
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def remove(self, **labels):
+        with self.lock:
+            self.values.pop(self._key(labels), None)
+
+    def _samples(self) -> list:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.kind)]
+        with self.lock:
+            lines.extend(self._samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1., **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.) + amount
+
+    def _samples(self) -> list:
+        return ['{}{} {}'.format(self.name, _labels(self.labelnames, k), _number(v)) for k, v in self.values.items()]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount: float = 1., **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            row = self.values.get(key)
+            if row is None:
+                # per bucket counts (not cumulative), sum
+                row = self.values[key] = [[0] * len(self.buckets), 0.]
+            row[0][bisect.bisect_left(self.buckets, value)] += 1
+            row[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self) -> list:
+        lines = []
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = 'le="{}"'.format(_number(bound))
+                lines.append('{}_bucket{} {}'.format(self.name, _labels(self.labelnames, key, le), cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, _labels(self.labelnames, key), _number(total)))
+            lines.append('{}_count{} {}'.format(self.name, _labels(self.labelnames, key), cumulative))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.register(Counter(
+    'crowd_requests_total', 'HTTP requests by endpoint and status code', ('endpoint', 'code')))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'crowd_request_seconds', 'Request latency by endpoint', ('endpoint',)))
+IN_FLIGHT = REGISTRY.register(Gauge(
+    'crowd_requests_in_flight', 'Requests being handled by endpoint', ('endpoint',)))
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'crowd_stage_seconds', 'Latency of one serving stage: parse, base64, decode, input, forward, response',
+    ('stage',)))
+INPUT_PIXELS = REGISTRY.register(Histogram(
+    'crowd_input_pixels', 'Decoded input resolution in pixels', (), buckets=PIXEL_BUCKETS))
+MODEL_INFO = REGISTRY.register(Gauge(
+    'crowd_model_info', 'Loaded models, 1 for the default model, 0 for the others',
+    ('name', 'version', 'checkpoint', 'epoch')))
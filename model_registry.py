@@ -0,0 +1,142 @@
+"""
+Several models served side by side, loaded and swapped at runtime
+
+A spec describes one variant:
+{"version": "quarter_vgg", "ratio": 4, "transform": true, "checkpoint": "partA_student.pth.tar"}
+{"format": "torchscript", "checkpoint": "student_int8.pt"}   (exported or quantized artifacts)
+{"format": "exported", "checkpoint": "student.pt2", "raw_input": true}   (torch.export programs)
+Checkpoint models get the input normalization folded into their first conv ("fold_input": false keeps
+normalized input), torchscript and exported artifacts of a folded model need "raw_input": true. Quantized
+artifacts may name the "quantized_engine" (x86, fbgemm, qnnpack, ...) they were built for.
+
+load() builds, loads and warms up the model before it takes the name, so requests never see a cold or half
+loaded model. With resolution buckets the model is wrapped in a buckets.BucketedModel and every bucket shape is
+compiled and warmed up instead. Replacing the entry is a single dict assignment under the lock, requests already running keep
+the model object they picked up.
+"""
+import threading
+import time
+
+import torch
+
+from buckets import BucketedModel
+from inference import run_density
+from models import build_model, load_checkpoint
+from models.raw_input import fold_input_normalization
+
+
+def load_model(spec: dict, device='cpu'):
+    """
+    Model and its epoch (None for torchscript) from a spec, without a checkpoint the weights stay random
+    """
+    if spec.get('quantized_engine'):
+        torch.backends.quantized.engine = spec['quantized_engine']
+    if spec.get('format', 'checkpoint') == 'torchscript':
+        model = torch.jit.load(spec['checkpoint'], map_location=device)
+        model.raw_input = bool(spec.get('raw_input', False))
+        epoch = None
+    elif spec.get('format') == 'exported':
+        # exported in eval mode, the program has no train / eval switch
+        model = torch.export.load(spec['checkpoint']).module().to(device)
+        model.raw_input = bool(spec.get('raw_input', False))
+        return model, None
+    else:
+        model = build_model(spec.get('version', 'quarter_vgg'), ratio=int(spec.get('ratio', 4)),
+                            transform=spec.get('transform', True))
+        epoch = None
+        if spec.get('checkpoint'):
+            epoch = load_checkpoint(model, spec['checkpoint'], transform=spec.get('transform', True))
+        if spec.get('fold_input', True):
+            fold_input_normalization(model)
+        model = model.to(device)
+    model.eval()
+    return model, epoch
+
+
+def warm_up(model, size: tuple = (576, 864), runs: int = 2, device='cpu') -> float:
+    """
+    Run a blank image `runs` times (allocator, cudnn autotuning, lazy init), returns the last run's seconds
+    """
+    batch = torch.zeros((1, 3) + tuple(size), device=device)
+    elapsed = 0.
+    for _ in range(runs):
+        start = time.time()
+        run_density(model, batch)
+        if str(device).startswith('cuda'):
+            torch.cuda.synchronize()
+        elapsed = time.time() - start
+    return elapsed
+
+
+class ModelRegistry(object):
+    def __init__(self, device='cpu', warmup_size: tuple = (576, 864), buckets=None, compile_buckets: bool = True):
+        self.device = device
+        self.warmup_size = warmup_size
+        self.buckets = buckets
+        self.compile_buckets = compile_buckets
+        self.entries = {}
+        self.default = None
+        self.listeners = []
+        self.lock = threading.Lock()
+        # one load at a time, loads are slow and memory hungry
+        self.load_lock = threading.Lock()
+
+    def on_swap(self, callback):
+        """
+        callback(name, model, info) after a model takes a name, model is None when it is unloaded
+        """
+        self.listeners.append(callback)
+
+    def load(self, name: str, spec: dict, make_default: bool = False) -> dict:
+        with self.load_lock:
+            start = time.time()
+            model, epoch = load_model(spec, self.device)
+            bucket_seconds = None
+            if self.buckets is not None:
+                model = BucketedModel(model, self.buckets)
+                bucket_seconds = model.prepare(self.device, compile=self.compile_buckets)
+                warmup = max(bucket_seconds.values())
+            else:
+                warmup = warm_up(model, tuple(spec.get('warmup_size', self.warmup_size)), device=self.device)
+            info = {'name': name, 'spec': spec, 'epoch': epoch, 'loaded_at': time.time(),
+                    'load_seconds': round(time.time() - start, 3), 'warmup_seconds': round(warmup, 4)}
+            if bucket_seconds is not None:
+                info['bucket_warmup_seconds'] = bucket_seconds
+            with self.lock:
+                self.entries[name] = (model, info)
+                if make_default or self.default is None:
+                    self.default = name
+            self._notify(name, model, info)
+            return info
+
+    def unload(self, name: str):
+        with self.lock:
+            if name == self.default:
+                raise ValueError('can not unload the default model, set another default first')
+            if name not in self.entries:
+                raise KeyError(name)
+            _, info = self.entries.pop(name)
+        self._notify(name, None, info)
+
+    def set_default(self, name: str):
+        with self.lock:
+            if name not in self.entries:
+                raise KeyError(name)
+            self.default = name
+            model, info = self.entries[name]
+        self._notify(name, model, info)
+
+    def get(self, name: str = None):
+        """
+        Model registered as name, the default model for None, raises KeyError
+        """
+        with self.lock:
+            return self.entries[name or self.default][0]
+
+    def describe(self) -> dict:
+        with self.lock:
+            return {'default': self.default, 'models': [info for _, info in self.entries.values()]}
+
+    def _notify(self, name: str, model, info: dict):
+        for callback in self.listeners:
+            callback(name, model, info)
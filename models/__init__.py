@@ -0,0 +1,63 @@
+import os
+
+import torch
+
+from checkpoint import load_weights_file, save_weights_file
+from models.model_vgg import CSRNet as CSRNet_vgg
+from models.model_student_vgg import CSRNet as CSRNet_student
+
+
+def build_model(version: str = 'quarter_vgg', ratio: int = 4, transform: bool = True):
+    """
+    vgg: CSRNet, quarter_vgg: 1/ratio-CSRNet student
+    """
+    if version == 'vgg':
+        return CSRNet_vgg(pretrained=False)
+    elif version == 'quarter_vgg':
+        return CSRNet_student(ratio=ratio, transform=transform)
+    raise NotImplementedError(version)
+
+
+def _torch_load(checkpoint_path: str, map_location='cpu'):
+    if checkpoint_path.endswith('.weights'):
+        state_dict, meta = load_weights_file(checkpoint_path)
+        return dict(meta, state_dict=state_dict)
+    try:
+        # tensors stay in the mapped file until they are used, the optimizer state is never read
+        return torch.load(checkpoint_path, map_location=map_location, mmap=True)
+    except RuntimeError:
+        # legacy (non zip) checkpoints can not be memory mapped
+        return torch.load(checkpoint_path, map_location=map_location)
+
+
+def load_checkpoint(model, checkpoint_path: str, transform: bool = True, map_location='cpu'):
+    """
+    Load 'state_dict' of a train.py checkpoint, a save_weights file or a .weights file into model, returns
+    the epoch
+    """
+    if not os.path.isfile(checkpoint_path):
+        raise FileNotFoundError("no checkpoint found at '{}'".format(checkpoint_path))
+    checkpoint = _torch_load(checkpoint_path, map_location=map_location)
+    state_dict = checkpoint['state_dict']
+    if transform is False:
+        # remove 1x1 conv para
+        state_dict = {k: v for k, v in state_dict.items() if k[:9] != 'transform'}
+    model.load_state_dict(state_dict)
+    return checkpoint.get('epoch')
+
+
+def save_weights(checkpoint_path: str, weights_path: str, transform: bool = True) -> int:
+    """
+    Weights only copy of a train.py checkpoint: state_dict and epoch without the optimizer, as a contiguous
+    .weights file or in the zip format torch.load can memory map. Returns the epoch.
+    """
+    checkpoint = _torch_load(checkpoint_path)
+    state_dict = checkpoint['state_dict']
+    if transform is False:
+        state_dict = {k: v for k, v in state_dict.items() if k[:9] != 'transform'}
+    if weights_path.endswith('.weights'):
+        save_weights_file(state_dict, weights_path, meta={'epoch': checkpoint.get('epoch')})
+    else:
+        torch.save({'state_dict': {k: v.contiguous() for k, v in state_dict.items()},
+                    'epoch': checkpoint.get('epoch')}, weights_path)
+    return checkpoint.get('epoch')
@@ -1,3 +1,5 @@
+from contextlib import nullcontext
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -32,13 +34,12 @@ def gram(x, y):
     c2 = y.shape[1]
     h = x.shape[2]
     w = x.shape[3]
-    x = x.view(n, c1, -1, 1)[0, :, :, 0]
-    y = y.view(n, c2, -1, 1)[0, :, :, 0]
-    y = y.transpose(0, 1)
-    # print x.shape
-    # print y.shape
-    z = torch.mm(x, y) / (w*h)
-    return z
+    x = x.view(n, c1, -1)
+    y = y.view(n, c2, -1)
+    y = y.transpose(1, 2)
+    # FSP matrix of every sample of the batch, averaged
+    z = torch.bmm(x, y) / (w*h)
+    return z.mean(dim=0)
 
 
 def scale_process(features, scale=[3, 2, 1], ceil_mode=True):
@@ -51,4 +52,45 @@ def scale_process(features, scale=[3, 2, 1], ceil_mode=True):
         down_ratio = pow(2, scale[i])
         pool = nn.MaxPool2d(kernel_size=down_ratio, stride=down_ratio, ceil_mode=ceil_mode)
         new_features.append(pool(features[i]))
-    return new_features
\ No newline at end of file
+    return new_features
+
+
+def dense_fsp(features):
+    """
+    Multi-scale dense FSP matrices of one network's features
+    """
+    return cal_dense_fsp([scale_process(features)])
+
+
+def distillation_loss(student_features, teacher_features, target, criterion, lamb_fsp: float, lamb_cos: float,
+                      profiler=None):
+    """
+    SKT loss of a batch, both feature lists end with the density output
+
+    loss = MSE(student, gt) + MSE(student, teacher) + lamb_fsp * dense FSP loss + lamb_cos * cos loss
+    returns (loss, loss_h, loss_s, loss_fsp, loss_cos), terms with a zero weight are not computed
+    :param profiler: optional profiler.StepProfiler, times the 'mse', 'fsp' and 'cos' phases
+    """
+    phase = profiler.phase if profiler is not None else (lambda name: nullcontext())
+    student_output = student_features[-1]
+    teacher_output = teacher_features[-1]
+    with phase('mse'):
+        loss_h = criterion(student_output, target)
+        loss_s = criterion(student_output, teacher_output)
+
+    loss_fsp = student_output.new_zeros(())
+    if lamb_fsp:
+        with phase('fsp'), torch.no_grad():
+            teacher_fsp = dense_fsp(teacher_features)
+        with phase('fsp'):
+            student_fsp = dense_fsp(student_features)
+            assert len(teacher_fsp) == len(student_fsp)
+            loss_fsp = sum(criterion(t, s) for t, s in zip(teacher_fsp, student_fsp)) * lamb_fsp
+
+    loss_cos = student_output.new_zeros(())
+    if lamb_cos:
+        with phase('cos'):
+            pairs = zip(student_features[:-1], teacher_features[:-1])
+            loss_cos = sum(cosine_similarity(s, t) for s, t in pairs) * lamb_cos
+
+    return loss_h + loss_s + loss_fsp + loss_cos, loss_h, loss_s, loss_fsp, loss_cos
@@ -0,0 +1,76 @@
+"""
+Bounded feature capture for knowledge distillation.
+
+Forward hooks are registered on entering the context and removed on exit, captured tensors are
+kept in one preallocated slot per layer so repeated forward passes overwrite instead of growing.
+"""
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class FeatureCapture(object):
+    """Capture the outputs of named sub-modules during forward
+
+    with model.feature_capture() as capture:
+        output = model(img)
+        features = capture.features  # one tensor per layer, in the order of `layers`
+    """
+
+    def __init__(self, model: nn.Module, layers: list, down_sample: list = None, detach: bool = True):
+        """
+        :param model: the model to hook
+        :param layers: sub-module names as given by model.named_modules(), e.g. 'frontend.1'
+        :param down_sample: optional log2 max pool factor per layer (0/None keeps the resolution)
+        :param detach: detach captured tensors from the graph
+        """
+        if down_sample is not None and len(down_sample) != len(layers):
+            raise ValueError('down_sample must have one entry per layer')
+
+        modules = dict(model.named_modules())
+        for name in layers:
+            if name not in modules:
+                raise KeyError('no sub-module named {}'.format(name))
+
+        self.model = model
+        self.layers = list(layers)
+        self.down_sample = list(down_sample) if down_sample is not None else [None] * len(layers)
+        self.detach = detach
+        self.features = [None] * len(self.layers)
+        self._modules = [modules[name] for name in self.layers]
+        self._handles = []
+
+    def __enter__(self):
+        self.attach()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.detach_hooks()
+        self.clear()
+
+    def attach(self):
+        if self._handles:
+            return
+        for idx, module in enumerate(self._modules):
+            self._handles.append(module.register_forward_hook(self._make_hook(idx)))
+
+    def detach_hooks(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    def clear(self):
+        for idx in range(len(self.features)):
+            self.features[idx] = None
+
+    def _make_hook(self, idx: int):
+        scale = self.down_sample[idx]
+
+        def hook(module, input, output):
+            if self.detach:
+                output = output.detach()
+            if scale:
+                down_ratio = pow(2, scale)
+                output = F.max_pool2d(output, kernel_size=down_ratio, stride=down_ratio, ceil_mode=True)
+            self.features[idx] = output
+
+        return hook
@@ -4,7 +4,7 @@ Student model (1/n-CSRNet) in SKT.
 import numpy as np
 import torch.nn as nn
 import torch
-from torchvision import models
+from models.feature_capture import FeatureCapture
 
 channel_nums = [[32, 64, 128, 256],  # half
                 [21, 43, 85, 171],  # third
@@ -12,6 +12,9 @@ channel_nums = [[32, 64, 128, 256],  # half
                 [13, 26, 51, 102],  # fifth
                 ]
 
+# 1x1 conv transforms mapping student features to the teacher's channel numbers
+FEATURE_LAYERS = ['transform0_0', 'transform1_0', 'transform2_0', 'transform3_0', 'transform4_0', 'transform4_3']
+
 
 class CSRNet(nn.Module):
     def __init__(self, ratio: int = 4, transform: bool = True):
@@ -108,6 +111,13 @@ class CSRNet(nn.Module):
             return self.features
         return x
 
+    def feature_capture(self, layers: list = None, down_sample: list = None, detach: bool = False):
+        """
+        Capture intermediate features inside a with-block, hooks are removed on exit
+        """
+        layers = FEATURE_LAYERS if layers is None else layers
+        return FeatureCapture(self, layers, down_sample=down_sample, detach=detach)
+
     def _initialize_weights(self):
         for m in self.modules():
             if isinstance(m, nn.Conv2d):
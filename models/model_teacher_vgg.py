@@ -4,12 +4,15 @@ Teacher model in SKT
 import numpy as np
 import torch.nn as nn
 import torch
-from torchvision import models
 from utils import save_net, load_net, cal_para
+from models.feature_capture import FeatureCapture
 
 _frontend_feat = [64, 64, 'M', 128, 128, 'M', 256, 256, 256, 'M', 512, 512, 512]
 _backend_feat = [512, 512, 512, 256, 128, 64]
 
+# outputs matched against the student's transformed features
+FEATURE_LAYERS = ['frontend.1', 'frontend.4', 'frontend.9', 'frontend.16', 'backend.1', 'backend.7']
+
 
 class CSRNet(nn.Module):
     def __init__(self, pretrained: bool = False):
@@ -19,10 +22,11 @@ class CSRNet(nn.Module):
         self.frontend = _make_layers(_frontend_feat)
         self.backend = _make_layers(_backend_feat, in_channels=512, dilation=True)
         self.output_layer = nn.Conv2d(64, 1, kernel_size=(1, 1))
-        self.features = []
         if pretrained:
             print('load vgg pretrained model')
             self._initialize_weights(mode='normal')
+            # torchvision is only needed for the imagenet weights
+            from torchvision import models
             vgg = models.vgg16(pretrained)
             pretrain_keys = list(vgg.state_dict().keys())
             state_keys = list(self.frontend.state_dict().keys())
@@ -34,7 +38,6 @@ class CSRNet(nn.Module):
             self._initialize_weights(mode='kaiming')
 
     def forward(self, x):
-        self.features = []
         # frontend: VGG
         x = self.frontend(x)
         # backend: dilated convolution
@@ -56,19 +59,12 @@ class CSRNet(nn.Module):
                 nn.init.constant_(m.weight, 1)
                 nn.init.constant_(m.bias, 0)
 
-    def regist_hook(self):
-        self.features = []
-
-        def get(model, input, output):
-            # function will be automatically called each time, since the hook is injected
-            self.features.append(output.detach())
-
-        for name, module in self._modules['frontend']._modules.items():
-            if name in ['1', '4', '9', '16']:
-                self._modules['frontend']._modules[name].register_forward_hook(get)
-        for name, module in self._modules['backend']._modules.items():
-            if name in ['1', '7']:
-                self._modules['backend']._modules[name].register_forward_hook(get)
+    def feature_capture(self, layers: list = None, down_sample: list = None):
+        """
+        Capture intermediate features inside a with-block, hooks are removed on exit
+        """
+        layers = FEATURE_LAYERS if layers is None else layers
+        return FeatureCapture(self, layers, down_sample=down_sample, detach=True)
 
 
 def _make_layers(cfg: list, in_channels: int = 3, batch_norm: bool = False, dilation: bool = False):
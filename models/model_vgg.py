@@ -3,7 +3,6 @@ For training CSRNet teacher
 """
 import numpy as np
 import torch.nn as nn
-from torchvision import models
 
 _frontend_feat = [64, 64, 'M', 128, 128, 'M', 256, 256, 256, 'M', 512, 512, 512]
 _backend_feat = [512, 512, 512, 256, 128, 64]
@@ -23,6 +22,8 @@ class CSRNet(nn.Module):
         if pretrained:
             self._initialize_weights(mode='normal')
             
+            # torchvision is only needed for the imagenet weights
+            from torchvision import models
             vgg = models.vgg16(pretrained)
             pretrain_keys = list(vgg.state_dict().keys())
             state_keys = list(self.frontend.state_dict().keys())
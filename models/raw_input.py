@@ -0,0 +1,75 @@
+"""
+Fold the input preprocessing (BGR -> RGB, /255, ImageNet mean/std) into the first conv
+
+The folded model takes raw 0-255 BGR float input, so callers skip cvtColor, ToTensor and Normalize.
+conv(normalize(x)) = conv'(x) with
+    W'[:, c] = W[:, c] / (255 * std[c]),  b' = b - sum(W * mean / std),  input channels reversed for BGR
+Zero padding of the normalized image is padding with the mean colour of the raw image, the 3x3 / padding 1
+first conv only sees it on the outermost rows and columns, which get a fixed per edge / corner correction.
+"""
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from utils import IMAGENET_MEAN, IMAGENET_STD
+
+
+class RawInputConv(nn.Module):
+    def __init__(self, conv: nn.Conv2d, mean=IMAGENET_MEAN, std=IMAGENET_STD, bgr: bool = True):
+        super(RawInputConv, self).__init__()
+        if conv.kernel_size != (3, 3) or conv.stride != (1, 1) or conv.padding != (1, 1) or conv.dilation != (1, 1):
+            raise ValueError('only 3x3 convs with stride 1 and padding 1 can be folded')
+        mean = torch.tensor(mean, dtype=conv.weight.dtype, device=conv.weight.device)
+        std = torch.tensor(std, dtype=conv.weight.dtype, device=conv.weight.device)
+        weight = conv.weight.detach() / (255. * std).view(1, -1, 1, 1)
+        bias = conv.bias.detach() if conv.bias is not None else torch.zeros_like(weight[:, 0, 0, 0])
+        bias = bias - (conv.weight.detach() * (mean / std).view(1, -1, 1, 1)).sum(dim=(1, 2, 3))
+        raw_mean = 255. * mean
+        if bgr:
+            weight = weight.flip(1)
+            raw_mean = raw_mean.flip(0)
+
+        self.conv = nn.Conv2d(conv.in_channels, conv.out_channels, 3, padding=1)
+        self.conv.weight.data.copy_(weight)
+        self.conv.bias.data.copy_(bias)
+        # output of a 3x3 image that is all padding except its centre: row / column 0 is the top / left
+        # edge, 1 the interior (0), 2 the bottom / right edge
+        ring = raw_mean.view(1, -1, 1, 1).repeat(1, 1, 5, 5)
+        ring[:, :, 1:4, 1:4] = 0
+        self.register_buffer('border', F.conv2d(ring, weight)[0])
+        self.register_buffer('raw_mean', raw_mean)
+
+    def forward(self, x):
+        if x.shape[2] < 2 or x.shape[3] < 2:
+            # a single row or column touches both edges, pad explicitly
+            padded = self.raw_mean.view(1, -1, 1, 1).repeat(x.shape[0], 1, x.shape[2] + 2, x.shape[3] + 2)
+            padded[:, :, 1:-1, 1:-1] = x
+            return F.conv2d(padded, self.conv.weight, self.conv.bias)
+        y = self.conv(x)
+        b = self.border.unsqueeze(0)
+        y[:, :, 0, 1:-1] += b[:, :, 0, 1:2]
+        y[:, :, -1, 1:-1] += b[:, :, 2, 1:2]
+        y[:, :, 1:-1, 0] += b[:, :, 1:2, 0]
+        y[:, :, 1:-1, -1] += b[:, :, 1:2, 2]
+        y[:, :, 0, 0] += b[:, :, 0, 0]
+        y[:, :, 0, -1] += b[:, :, 0, 2]
+        y[:, :, -1, 0] += b[:, :, 2, 0]
+        y[:, :, -1, -1] += b[:, :, 2, 2]
+        return y
+
+
+def fold_input_normalization(model, mean=IMAGENET_MEAN, std=IMAGENET_STD, bgr: bool = True):
+    """
+    Replace the first conv of a CSRNet (frontend[0]) or 1/n-CSRNet (conv0_0[0]) by a RawInputConv in place,
+    the model then takes raw 0-255 BGR input and is marked with raw_input = True. Inference only, load the
+    checkpoint first.
+    """
+    if hasattr(model, 'frontend'):
+        parent = model.frontend
+    elif hasattr(model, 'conv0_0'):
+        parent = model.conv0_0
+    else:
+        raise NotImplementedError(type(model).__name__)
+    parent[0] = RawInputConv(parent[0], mean, std, bgr)
+    model.raw_input = True
+    return model
@@ -2,9 +2,11 @@ import os
 import random
 import torch
 import numpy as np
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 from PIL import Image
 from image import *
+from dataset_index import balance_workers
+from utils import IMAGENET_MEAN
 import torchvision.transforms.functional as F
 
 
@@ -23,6 +25,8 @@ class ListDataset(Dataset):
         if train and dataset == 'shanghai':
             root = root * 4
         if shuffle:
+            # a copy, the caller's list keeps its order
+            root = list(root)
             random.shuffle(root)
 
         self.nSamples = len(root)
@@ -54,3 +58,117 @@ class ListDataset(Dataset):
         if self.transform is not None:
             img = self.transform(img)
         return img, target
+
+
+class MultiCropDataset(IterableDataset):
+    """
+    Decode each training image once per epoch and yield `crops_per_image` random crops from it
+
+    Crops go through a mixing buffer of `buffer_size` samples so that crops of the same image
+    are spread over the epoch instead of landing in consecutive batches.
+    With raw=True the crops are uint8 tensors with their density at 1/8 (raw_crop), flip, scale jitter and
+    normalization are left to augmentation.BatchAugment on the batch. A fixed crop_size makes the crops
+    stack into batches larger than 1.
+    With a dataset index the images are split over the loader workers by size instead of round robin.
+    """
+
+    def __init__(self,
+                 root: list,
+                 transform=None,
+                 crops_per_image: int = 4,
+                 buffer_size: int = 32,
+                 shuffle: bool = True,
+                 seen: int = 0,
+                 raw: bool = False,
+                 index: dict = None,
+                 crop_size: tuple = None):
+        self.lines = list(root)
+        self.transform = transform
+        self.crops_per_image = crops_per_image
+        self.buffer_size = buffer_size
+        self.shuffle = shuffle
+        self.seen = seen
+        self.raw = raw
+        self.index = index
+        self.crop_size = crop_size
+
+    def __len__(self):
+        return len(self.lines) * self.crops_per_image
+
+    def _worker_lines(self) -> list:
+        worker_info = get_worker_info()
+        if worker_info is None:
+            return list(self.lines)
+        if self.index is not None:
+            # shards of similar total pixels from the dataset index
+            return balance_workers(self.lines, self.index, worker_info.num_workers)[worker_info.id]
+        return self.lines[worker_info.id::worker_info.num_workers]
+
+    def _crops(self, img_path: str):
+        img, target = load_shanghai_raw(img_path)
+        if self.raw:
+            for _ in range(self.crops_per_image):
+                yield raw_crop(img, target, self.crop_size)
+            return
+
+        for _ in range(self.crops_per_image):
+            crop_img, crop_target = make_sample(*random_crop_flip(img, target))
+            if self.transform is not None:
+                crop_img = self.transform(crop_img)
+            yield crop_img, crop_target
+
+    def __iter__(self):
+        lines = self._worker_lines()
+        if self.shuffle:
+            random.shuffle(lines)
+
+        buffer = []
+        for img_path in lines:
+            for sample in self._crops(img_path):
+                if not self.shuffle:
+                    yield sample
+                elif len(buffer) < self.buffer_size:
+                    buffer.append(sample)
+                else:
+                    idx = random.randrange(len(buffer))
+                    yield buffer[idx]
+                    buffer[idx] = sample
+
+        random.shuffle(buffer)
+        for sample in buffer:
+            yield sample
+
+
+def raw_crop(img, target, crop_size: tuple = None):
+    """
+    Random crop as a uint8 (3, h, w) RGB tensor and its float (1, h/8, w/8) density, without normalization
+
+    The crop ratio is drawn as in image.random_crop_flip, or the crop is crop_size (height, width) rounded up,
+    in whole output cells so a flip of the batch keeps image and density aligned. Images smaller than
+    crop_size are padded with the mean colour and zero density. Only the crop's density is rendered, at 1/8.
+    """
+    width, height = img.size
+    if crop_size is None:
+        crop_ratio = random.uniform(0.5, 1.0)
+        crop_h = max(int(crop_ratio * height) // 8, 1) * 8
+        crop_w = max(int(crop_ratio * width) // 8, 1) * 8
+    else:
+        crop_h, crop_w = (-(-int(size) // 8) * 8 for size in crop_size)
+    dx = random.randint(0, max(width - crop_w, 0))
+    dy = random.randint(0, max(height - crop_h, 0))
+
+    crop = np.array(img.crop((dx, dy, min(dx + crop_w, width), min(dy + crop_h, height))), dtype=np.uint8)
+    if crop.shape[:2] != (crop_h, crop_w):
+        padded = np.empty((crop_h, crop_w, 3), dtype=np.uint8)
+        padded[:] = np.round(255. * np.asarray(IMAGENET_MEAN))
+        padded[:crop.shape[0], :crop.shape[1]] = crop
+        crop = padded
+    if isinstance(target, PointDensity):
+        target = target.crop(dx, dy, crop_w, crop_h).render(3)
+    else:
+        target = target[dy:dy + crop_h, dx:dx + crop_w]
+        target = np.pad(target, ((0, crop_h - target.shape[0]), (0, crop_w - target.shape[1])))
+        target = reshape_target(np.ascontiguousarray(target), 3)
+    img = torch.from_numpy(crop).permute(2, 0, 1).contiguous()
+    target = torch.from_numpy(np.ascontiguousarray(target, dtype=np.float32)).unsqueeze(0)
+    return img, target
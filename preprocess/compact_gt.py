@@ -0,0 +1,144 @@
+"""
+Convert existing ground-truth-h5 density maps to the compact format read by image.load_gt
+
+With the head annotations available a file keeps only the points and one gaussian sigma per point
+(same sigmas as the GT generation scripts), the loader renders the density crop it needs at the
+target resolution. Without annotations, or with --fp16, the dense map is rewritten as chunked,
+compressed float16. The original dense file is kept next to it as <name>.h5.dense unless --no_keep.
+"""
+import argparse
+import glob
+import os
+
+import h5py
+import numpy as np
+import scipy.io as io
+import scipy.spatial
+
+parser = argparse.ArgumentParser(description='Compact ground truth')
+parser.add_argument('--root', '-r', type=str, default='/home/cv/AI_Data/ShanghaiTech/ShanghaiTech',
+                    help='Dataset root path')
+parser.add_argument('--dataset', '-d', type=str, default='shanghai',
+                    help='shanghai/ucf')
+parser.add_argument('--fp16', action='store_true',
+                    help='keep dense maps, stored as compressed float16')
+parser.add_argument('--no_keep', action='store_true',
+                    help='do not keep the original dense file as <name>.h5.dense')
+parser.add_argument('--dry_run', action='store_true',
+                    help='only report the counts and sizes, nothing is replaced')
+
+
+def find_gt_files(root: str, dataset: str) -> list:
+    if dataset == 'ucf':
+        return sorted(glob.glob(os.path.join(root, 'Train', '*.h5')) + glob.glob(os.path.join(root, 'Test', '*.h5')))
+    return sorted(glob.glob(os.path.join(root, 'part_*', '*_data', 'ground-truth-h5', '*.h5')))
+
+
+def annotation_path(h5_path: str, dataset: str) -> str:
+    if dataset == 'ucf':
+        return h5_path.replace('.h5', '_ann.mat')
+    return h5_path.replace('ground-truth-h5', 'ground-truth').replace('IMG_', 'GT_IMG_').replace('.h5', '.mat')
+
+
+def read_points(mat_path: str, dataset: str, shape: tuple):
+    """
+    Head positions as pixel centres, same filtering and de-duplication as the GT scripts
+    """
+    mat = io.loadmat(mat_path)
+    if dataset == 'ucf':
+        gt = mat['annPoints']
+    else:
+        gt = mat["image_info"][0, 0][0, 0][0]
+    gt = np.asarray(gt, dtype=np.float64).reshape(-1, 2).astype(np.int64)
+    keep = (gt[:, 1] < shape[0]) & (gt[:, 0] < shape[1]) & (gt[:, 0] >= 0) & (gt[:, 1] >= 0)
+    gt = np.unique(gt[keep], axis=0)
+    return gt.astype(np.float32) + 0.5
+
+
+def compute_sigmas(points, shape: tuple, mode: str):
+    """
+    adaptive: 0.1 * sum of the 3 nearest neighbours (ShanghaiTech part A)
+    fixed: 15 (ShanghaiTech part B)
+    nearest: nearest neighbour capped at 30 (UCF-QNRF)
+    """
+    n = len(points)
+    if n == 0:
+        return np.zeros(0, dtype=np.float32)
+    if mode == 'fixed':
+        return np.full(n, 15, dtype=np.float32)
+    if n == 1:
+        return np.array([np.average(np.array(shape)) / 2. / 2.], dtype=np.float32)
+
+    tree = scipy.spatial.KDTree(points.copy(), leafsize=2048)
+    if mode == 'nearest':
+        distances, _ = tree.query(points, k=2)
+        return np.minimum(distances[:, 1], 30).astype(np.float32)
+
+    k = min(4, n)
+    distances, _ = tree.query(points, k=k)
+    # fewer than 3 neighbours: scale the mean so it matches 0.1 * sum of 3
+    return (distances[:, 1:].mean(axis=1) * 0.3).astype(np.float32)
+
+
+def write_points(h5_path: str, points, sigmas, shape: tuple):
+    with h5py.File(h5_path, 'w') as hf:
+        hf.create_dataset('points', data=points, compression='gzip')
+        hf.create_dataset('sigmas', data=sigmas, compression='gzip')
+        hf.attrs['height'] = shape[0]
+        hf.attrs['width'] = shape[1]
+
+
+def write_fp16(h5_path: str, density):
+    with h5py.File(h5_path, 'w') as hf:
+        hf.create_dataset('density', data=density.astype(np.float16), chunks=True, shuffle=True,
+                          compression='gzip')
+
+
+def replace_gt(h5_path: str, tmp_path: str, keep: bool, dry_run: bool) -> int:
+    """
+    Move the converted tmp_path over h5_path, returns its size
+    """
+    size = os.path.getsize(tmp_path)
+    if dry_run:
+        os.remove(tmp_path)
+        return size
+    backup_path = h5_path + '.dense'
+    # a re-run never overwrites the first backup
+    if keep and not os.path.exists(backup_path):
+        os.replace(h5_path, backup_path)
+    os.replace(tmp_path, h5_path)
+    return size
+
+
+def convert(h5_path: str, dataset: str, fp16: bool, keep: bool, dry_run: bool):
+    with h5py.File(h5_path, 'r') as f:
+        if 'points' in f:
+            print('skip (already compact):', h5_path)
+            return
+        density = np.asarray(f['density'], dtype=np.float32)
+
+    old_size = os.path.getsize(h5_path)
+    tmp_path = h5_path + '.tmp'
+    mat_path = annotation_path(h5_path, dataset)
+    if fp16 or not os.path.exists(mat_path):
+        write_fp16(tmp_path, density)
+        print('fp16: {} count {:.2f} size {} -> {}'.format(h5_path, density.sum(), old_size,
+                                                           replace_gt(h5_path, tmp_path, keep, dry_run)))
+        return
+
+    if dataset == 'ucf':
+        mode = 'nearest'
+    else:
+        mode = 'fixed' if 'part_B' in h5_path else 'adaptive'
+    points = read_points(mat_path, dataset, density.shape)
+    sigmas = compute_sigmas(points, density.shape, mode)
+    write_points(tmp_path, points, sigmas, density.shape)
+    print('points: {} count {:.2f} (dense {:.2f}) size {} -> {}'.format(h5_path, len(points), density.sum(), old_size,
+                                                                        replace_gt(h5_path, tmp_path, keep, dry_run)))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    for gt_path in find_gt_files(args.root, args.dataset):
+        convert(gt_path, args.dataset, args.fp16, not args.no_keep, args.dry_run)
+    print('Finish!')
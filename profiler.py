@@ -0,0 +1,210 @@
+"""
+Opt-in per-phase profiler for the training step
+
+with profiler.phase('teacher_forward'):
+    teacher_output = teacher(img)
+profiler.step()
+
+Every phase gets its total / mean time and its peak memory: the peak allocated CUDA memory on cuda devices,
+the growth of the process' resident memory high-water mark on cpu. Time inside a step that is not covered
+by a phase is reported as 'other'. On cuda every phase boundary synchronizes the device so the time lands
+in the phase that queued the kernels, which slows training a little, hence opt-in.
+
+The steps in [window_start, window_start + window_steps) are also recorded as a Chrome trace
+(chrome://tracing or https://ui.perfetto.dev) with one event per phase and a memory counter.
+"""
+import json
+import os
+import resource
+import time
+from collections import OrderedDict
+
+
+class _NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase(object):
+    def __init__(self, profiler, name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start, self.mem_start = self.profiler._begin()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.profiler._end(self.name, self.start, self.mem_start)
+        return False
+
+
+class StepProfiler(object):
+    def __init__(self, enabled: bool = True, device='cpu', window_start: int = 20, window_steps: int = 10,
+                 trace_path: str = ''):
+        """
+        :param trace_path: Chrome trace json written when the window is over, no trace when empty
+        """
+        self.enabled = enabled
+        self.cuda = str(device).startswith('cuda')
+        self.window_start = window_start
+        self.window_steps = window_steps
+        self.trace_path = trace_path
+        self.steps = 0
+        self.step_seconds = 0.
+        self.phases = OrderedDict()
+        self.events = []
+        self.trace_written = False
+        self._pid = os.getpid()
+        self._origin = time.perf_counter()
+        self._step_start = None
+        self._step_phase_seconds = 0.
+
+    def phase(self, name: str):
+        """
+        Context manager timing one phase of the current step
+        """
+        if not self.enabled:
+            return _NULL_PHASE
+        return _Phase(self, name)
+
+    def wrap(self, iterable, name: str = 'data'):
+        """
+        Iterate over iterable timing every next() as phase name, e.g. the data loader
+        """
+        # time between loops (validation, checkpoints) is no part of a step
+        self._step_start = None
+        self._step_phase_seconds = 0.
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def step(self):
+        """
+        End of a training step
+        """
+        if not self.enabled:
+            return
+        self._sync()
+        now = time.perf_counter()
+        if self._step_start is not None:
+            seconds = now - self._step_start
+            self.step_seconds += seconds
+            other = max(seconds - self._step_phase_seconds, 0.)
+            self._stats('other')['seconds'] += other
+            self._stats('other')['count'] += 1
+            if self._in_window():
+                self.events.append(self._event('step {}'.format(self.steps), self._step_start, seconds))
+            self.steps += 1
+        if self.steps >= self.window_start + self.window_steps:
+            self.write_trace()
+        # the next step starts now, data loading included
+        self._step_start = now
+        self._step_phase_seconds = 0.
+
+    def summary(self) -> str:
+        if not self.enabled or not self.steps:
+            return ''
+        lines = ['{:<16} {:>10} {:>10} {:>7} {:>12}'.format('phase', 'total(s)', 'ms/step', 'share',
+                                                            'peak_mem(MB)')]
+        for name, stats in self.phases.items():
+            lines.append('{:<16} {:>10.3f} {:>10.2f} {:>6.1f}% {:>12.1f}'.format(
+                name, stats['seconds'], 1000. * stats['seconds'] / self.steps,
+                100. * stats['seconds'] / max(self.step_seconds, 1e-12), stats['peak_mem'] / 2 ** 20))
+        lines.append('{:<16} {:>10.3f} {:>10.2f}  over {} steps'.format(
+            'step', self.step_seconds, 1000. * self.step_seconds / self.steps, self.steps))
+        return '\n'.join(lines)
+
+    def as_dict(self) -> dict:
+        return {'steps': self.steps, 'step_seconds': self.step_seconds,
+                'phases': {name: dict(stats) for name, stats in self.phases.items()}}
+
+    def write_trace(self):
+        if self.trace_written or not self.trace_path or not self.events:
+            return
+        trace = {'traceEvents': self.events, 'displayTimeUnit': 'ms', 'otherData': self.as_dict()}
+        tmp = self.trace_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(trace, f)
+        os.replace(tmp, self.trace_path)
+        self.trace_written = True
+        self.events = []
+
+    def close(self):
+        """
+        Write the trace of a window cut short by the end of training
+        """
+        if self.enabled:
+            self.write_trace()
+
+    def _in_window(self) -> bool:
+        return bool(self.trace_path) and not self.trace_written and \
+            self.window_start <= self.steps < self.window_start + self.window_steps
+
+    def _sync(self):
+        if self.cuda:
+            import torch
+            torch.cuda.synchronize()
+
+    def _memory(self) -> int:
+        if self.cuda:
+            import torch
+            return torch.cuda.max_memory_allocated()
+        # ru_maxrss is in KB on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _current_memory(self) -> int:
+        if self.cuda:
+            import torch
+            return torch.cuda.memory_allocated()
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):
+            return self._memory()
+
+    def _begin(self) -> tuple:
+        self._sync()
+        if self.cuda:
+            import torch
+            torch.cuda.reset_peak_memory_stats()
+        start = time.perf_counter()
+        if self._step_start is None:
+            self._step_start = start
+        return start, self._memory()
+
+    def _end(self, name: str, start: float, mem_start: int):
+        self._sync()
+        seconds = time.perf_counter() - start
+        stats = self._stats(name)
+        stats['seconds'] += seconds
+        stats['count'] += 1
+        # cuda: peak allocated inside the phase, cpu: growth of the high-water mark
+        peak = self._memory() if self.cuda else self._memory() - mem_start
+        stats['peak_mem'] = max(stats['peak_mem'], peak)
+        self._step_phase_seconds += seconds
+        if self._in_window():
+            self.events.append(self._event(name, start, seconds))
+            self.events.append({'name': 'memory', 'ph': 'C', 'pid': self._pid, 'tid': 0,
+                                'ts': 1e6 * (start + seconds - self._origin),
+                                'args': {'MB': self._current_memory() / 2 ** 20}})
+
+    def _stats(self, name: str) -> dict:
+        if name not in self.phases:
+            self.phases[name] = {'seconds': 0., 'count': 0, 'peak_mem': 0}
+        return self.phases[name]
+
+    def _event(self, name: str, start: float, seconds: float) -> dict:
+        return {'name': name, 'ph': 'X', 'pid': self._pid, 'tid': 0,
+                'ts': 1e6 * (start - self._origin), 'dur': 1e6 * seconds}
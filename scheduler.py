@@ -0,0 +1,216 @@
+"""
+Weighted fair scheduling of frames from many cameras onto one model
+
+Every camera has its own queue. Frames get a virtual finish tag (start + 1 / weight, start-time fair
+queueing) and the worker always serves the smallest tag, so a busy camera only gets its weighted share.
+Frames older than the camera's max_age are dropped before inference and a full queue drops its oldest
+frame, so backlog stays bounded. Cameras idle for idle_ttl with an empty queue are forgotten and at most
+max_cameras are kept, the least recently active idle one makes room for a new camera. The worker packs
+frames of the same size from different cameras into one batch.
+"""
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+import numpy as np
+
+from inference import CvImgType, run_frames
+
+
+class FrameDropped(Exception):
+    pass
+
+
+class _Frame(object):
+    __slots__ = ('camera_id', 'img', 'enqueue_time', 'finish_tag', 'future')
+
+    def __init__(self, camera_id, img, enqueue_time, finish_tag):
+        self.camera_id = camera_id
+        self.img = img
+        self.enqueue_time = enqueue_time
+        self.finish_tag = finish_tag
+        self.future = Future()
+
+
+class _Camera(object):
+    def __init__(self, weight: float, max_age: float, max_queue: int):
+        self.weight = weight
+        self.max_age = max_age
+        self.queue = deque()
+        self.max_queue = max_queue
+        self.last_active = time.time()
+        self.last_finish = 0.
+        self.submitted = 0
+        self.processed = 0
+        self.dropped = 0
+        self.latencies = deque(maxlen=1000)
+
+
+class FairScheduler(object):
+    def __init__(self, model, batch_size: int = 8, max_age: float = 1.0, max_queue: int = 8, device='cpu',
+                 idle_ttl: float = 300., max_cameras: int = 1024):
+        """
+        :param batch_size: max frames per forward pass
+        :param max_age: default seconds a frame may wait before it is dropped
+        :param max_queue: default frames queued per camera
+        :param idle_ttl: seconds without frames after which a camera with an empty queue is forgotten
+        :param max_cameras: most cameras kept, new cameras raise FrameDropped when all of them have queued frames
+        """
+        self.model = model
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.max_queue = max_queue
+        self.device = device
+        self.idle_ttl = idle_ttl
+        self.max_cameras = max_cameras
+        self.cameras = OrderedDict()
+        self.virtual_time = 0.
+        self.cond = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def register(self, camera_id: str, weight: float = 1.0, max_age: float = None, max_queue: int = None):
+        with self.cond:
+            camera = self.cameras.get(camera_id)
+            if camera is None:
+                self._make_room(time.time())
+                camera = _Camera(weight, max_age or self.max_age, max_queue or self.max_queue)
+                self.cameras[camera_id] = camera
+            else:
+                camera.weight = weight
+                camera.max_age = max_age or camera.max_age
+                camera.max_queue = max_queue or camera.max_queue
+            return camera
+
+    def submit(self, camera_id: str, img: CvImgType) -> Future:
+        """
+        Queue a BGR frame, the future resolves to the count or raises FrameDropped,
+        raises FrameDropped itself when a new camera does not fit in max_cameras
+        """
+        with self.cond:
+            camera = self.cameras.get(camera_id) or self.register(camera_id)
+            camera.last_active = time.time()
+            self.cameras.move_to_end(camera_id)
+            start = max(self.virtual_time, camera.last_finish)
+            camera.last_finish = start + 1. / camera.weight
+            frame = _Frame(camera_id, img, time.time(), camera.last_finish)
+            camera.queue.append(frame)
+            camera.submitted += 1
+            while len(camera.queue) > camera.max_queue:
+                self._drop(camera, camera.queue.popleft(), 'queue full')
+            self.cond.notify()
+        return frame.future
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+
+    def stats(self) -> dict:
+        with self.cond:
+            result = {}
+            for camera_id, camera in self.cameras.items():
+                latencies = np.array(camera.latencies) if camera.latencies else np.zeros(1)
+                result[camera_id] = {
+                    'weight': camera.weight,
+                    'queued': len(camera.queue),
+                    'submitted': camera.submitted,
+                    'processed': camera.processed,
+                    'dropped': camera.dropped,
+                    'latency_avg': float(latencies.mean()),
+                    'latency_p50': float(np.percentile(latencies, 50)),
+                    'latency_p95': float(np.percentile(latencies, 95)),
+                }
+            return result
+
+    def _drop(self, camera: _Camera, frame: _Frame, reason: str):
+        camera.dropped += 1
+        frame.future.set_exception(FrameDropped(reason))
+
+    def _drop_stale(self, now: float):
+        for camera in self.cameras.values():
+            while camera.queue and now - camera.queue[0].enqueue_time > camera.max_age:
+                self._drop(camera, camera.queue.popleft(), 'deadline exceeded')
+
+    def _evict_idle(self, now: float):
+        for camera_id, camera in list(self.cameras.items()):
+            if not camera.queue and now - camera.last_active > self.idle_ttl:
+                del self.cameras[camera_id]
+
+    def _make_room(self, now: float):
+        """
+        Room for one more camera, the least recently active camera with an empty queue goes first
+        """
+        self._evict_idle(now)
+        if len(self.cameras) < self.max_cameras:
+            return
+        for camera_id, camera in self.cameras.items():
+            if not camera.queue:
+                del self.cameras[camera_id]
+                return
+        raise FrameDropped('too many cameras')
+
+    def _next_batch(self) -> list:
+        """
+        Smallest finish tag first, then the next smallest tags of frames with the same size
+        """
+        batch = []
+        while len(batch) < self.batch_size:
+            best = None
+            for camera in self.cameras.values():
+                if not camera.queue:
+                    continue
+                head = camera.queue[0]
+                if batch and head.img.shape != batch[0].img.shape:
+                    continue
+                if best is None or head.finish_tag < best.queue[0].finish_tag:
+                    best = camera
+            if best is None:
+                break
+            frame = best.queue.popleft()
+            self.virtual_time = max(self.virtual_time, frame.finish_tag - 1. / best.weight)
+            batch.append(frame)
+        return batch
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while self.running and not any(camera.queue for camera in self.cameras.values()):
+                    self.cond.wait()
+                if not self.running:
+                    return
+                now = time.time()
+                self._drop_stale(now)
+                self._evict_idle(now)
+                batch = self._next_batch()
+            if not batch:
+                continue
+
+            try:
+                density = run_frames(self.model, [frame.img for frame in batch], self.device)
+                counts = density.sum(dim=(1, 2, 3)).tolist()
+            except Exception as e:
+                for frame in batch:
+                    frame.future.set_exception(e)
+                continue
+
+            done = time.time()
+            with self.cond:
+                for frame, count in zip(batch, counts):
+                    camera = self.cameras.get(frame.camera_id)
+                    if camera is None:
+                        # forgotten while the batch ran
+                        continue
+                    camera.processed += 1
+                    camera.last_active = done
+                    camera.latencies.append(done - frame.enqueue_time)
+            for frame, count in zip(batch, counts):
+                frame.future.set_result(count)
@@ -1,22 +1,31 @@
 import os
+import math
 import argparse
 import time
 import json
 import base64
+import binascii
+from concurrent.futures import TimeoutError as FutureTimeout
+from multiprocessing.pool import ThreadPool
 
 import cv2
 import torch
 import numpy as np
 from werkzeug.utils import secure_filename
-from models.model_vgg import CSRNet as CSRNet_vgg
-from models.model_student_vgg import CSRNet as CSRNet_student
-from torch.autograd import Variable
-from torchvision import transforms
 
-from flask import Flask, jsonify, request, redirect, render_template
-from flask import Flask
+from flask import Flask, Response, g, jsonify, request, redirect, render_template
 
 from utils import cal_para, crop_img_patches, get_use_time, base64_to_cvimage, get_result
+from utils import bytes_to_cvimage, jpeg_size
+from camera_session import SessionStore
+from scheduler import FairScheduler, FrameDropped
+from inference import count_rois, count_cascade, count_images, input_batch, run_density, run_frames
+from buckets import ResolutionBuckets, run_bucketed
+from tta import TestTimeAugmentation, run_tta
+from model_registry import ModelRegistry
+from autotune import load_tuned_config
+from density_output import encode_density, find_peaks
+from metrics import REGISTRY, REQUESTS, REQUEST_SECONDS, IN_FLIGHT, STAGE_SECONDS, INPUT_PIXELS, MODEL_INFO
 import shutil
 
 parser = argparse.ArgumentParser(description='PyTorch CSRNet')
@@ -36,8 +45,63 @@ parser.add_argument('--batch', default=1, type=int,
                     help='batch size')
 parser.add_argument('--gpu', metavar='GPU', default='0', type=str,
                     help='GPU id to use.')
-
-args = parser.parse_args()
+parser.add_argument('--tile_size', default=128, type=int,
+                    help='tile size of incremental camera sessions')
+parser.add_argument('--tile_threshold', default=6.0, type=float,
+                    help='mean gray level difference that marks a camera tile as changed')
+parser.add_argument('--sched_batch', default=8, type=int,
+                    help='max frames per batch of the multi-camera scheduler')
+parser.add_argument('--sched_max_age', default=1.0, type=float,
+                    help='seconds a scheduled frame may wait before it is dropped')
+parser.add_argument('--sched_max_queue', default=8, type=int,
+                    help='frames queued per camera before the oldest is dropped')
+parser.add_argument('--sched_timeout', default=10.0, type=float,
+                    help='seconds a scheduled request waits for its count beyond --sched_max_age before 503')
+parser.add_argument('--sched_idle_ttl', default=300., type=float,
+                    help='seconds without frames after which the scheduler forgets a camera')
+parser.add_argument('--sched_max_cameras', default=1024, type=int,
+                    help='most cameras the scheduler keeps, new cameras get 503 beyond it')
+parser.add_argument('--max_upload_mb', default=32, type=int,
+                    help='largest accepted request body, larger uploads get 413')
+parser.add_argument('--max_pixels', default=50000000, type=int,
+                    help='largest accepted decoded image size in pixels')
+parser.add_argument('--max_batch_images', default=64, type=int,
+                    help='most images accepted by one /get_people_num_batch call')
+parser.add_argument('--max_batch_pixels', default=100000000, type=int,
+                    help='total decoded pixels accepted by one /get_people_num_batch call')
+parser.add_argument('--batch_forward', default=8, type=int,
+                    help='max images per forward pass of /get_people_num_batch')
+parser.add_argument('--batch_bucket', default=1, type=int,
+                    help='1 only batches equal sizes (same counts as /get_people_num), >1 pads sizes up to a '
+                         'multiple of this to batch more images, which changes counts near the border')
+parser.add_argument('--decode_threads', default=4, type=int,
+                    help='threads decoding the images of a batch request')
+parser.add_argument('--max_density_cells', default=65536, type=int,
+                    help='most density map cells returned per image, larger maps are sum pooled')
+parser.add_argument('--max_points', default=2000, type=int,
+                    help='most head locations returned per image')
+parser.add_argument('--models', default='', type=str,
+                    help='json file {name: spec} of extra models loaded at startup, see model_registry.py')
+parser.add_argument('--admin_token', default='', type=str,
+                    help='token required in the X-Admin-Token header of /admin endpoints, without one /admin only '
+                         'answers requests from localhost')
+parser.add_argument('--buckets', default='', type=str,
+                    help='input resolution buckets, e.g. 576x864,768x1024, precompiled and warmed up at startup')
+parser.add_argument('--bucket_mode', default='pad', choices=['pad', 'resize'],
+                    help='pad images to the smallest bucket they fit in or resize them to the closest one')
+parser.add_argument('--bucket_eager', action='store_true',
+                    help='only warm up the bucket shapes on the eager model, no traced graphs')
+parser.add_argument('--tuned_config', default='', type=str,
+                    help='autotune.py output, its backend, threads and batch size replace the defaults')
+parser.add_argument('--tta', action='store_true',
+                    help='test-time augmentation for /get_people_num and /upload, the flip (and --tta_scales) '
+                         'runs in the same batch, requests can switch it with "tta"')
+parser.add_argument('--tta_scales', default='', type=str,
+                    help='extra tta scales, e.g. 0.75,1.25')
+parser.add_argument('--tta_merge', default='mean', choices=['mean', 'median'],
+                    help='count of the tta views')
+parser.add_argument('--port', default=24433, type=int,
+                    help='port to listen on')
 
 Path = str
 CvImgType = np.ndarray
@@ -45,70 +109,478 @@ CUDA_AVAILABLE = torch.cuda.is_available()
 
 app = Flask(__name__)
 
-args.seed = time.time()
-
-if CUDA_AVAILABLE:
-    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
-    torch.cuda.manual_seed(int(args.seed))
-
-if args.version == 'vgg':
-    print('VGG')
-    model = CSRNet_vgg(pretrained=False)
-    cal_para(model)
-
-elif args.version == 'quarter_vgg':
-    print('quarter_VGG')
-    model = CSRNet_student(ratio=4, transform=args.transform)
-    cal_para(model)  # including 1x1conv transform layer that can be removed
-else:
-    raise NotImplementedError()
-
-model = model.cuda() if CUDA_AVAILABLE else model
-
-if args.checkpoint:
-    if os.path.isfile(args.checkpoint):
-        print("=> loading checkpoint '{}'".format(args.checkpoint))
-        checkpoint = torch.load(args.checkpoint)
-
-        if args.transform is False:
-            # remove 1x1 conv para
-            for k in checkpoint['state_dict'].keys():
-                if k[:9] == 'transform':
-                    del checkpoint['state_dict'][k]
-
-        model.load_state_dict(checkpoint['state_dict'])
-        print("=> loaded checkpoint '{}' (epoch {})"
-              .format(args.checkpoint, checkpoint['epoch']))
-    else:
+# set by create_app, nothing is loaded at import time
+args = None
+registry = None
+buckets = None
+tta = None
+camera_sessions = None
+scheduler = None
+decode_pool = None
+
+_model_info_labels = {}
+
+
+def _update_model_info(name: str, model, info: dict):
+    old = _model_info_labels.pop(name, None)
+    if old is not None:
+        MODEL_INFO.remove(**old)
+    if model is not None:
+        spec = info['spec']
+        _model_info_labels[name] = dict(name=name, version=spec.get('format', spec.get('version', 'quarter_vgg')),
+                                        checkpoint=spec.get('checkpoint'), epoch=info['epoch'])
+    for labels in _model_info_labels.values():
+        MODEL_INFO.set(int(labels['name'] == registry.default), **labels)
+
+
+def _follow_default(name: str, model, info: dict):
+    # camera sessions and the scheduler keep state per model, they always run the default one
+    if model is not None and name == registry.default:
+        scheduler.model = model
+        camera_sessions.reset(model)
+
+
+def create_app(app_args) -> Flask:
+    """
+    Load the models, start the scheduler and configure the app for parsed server arguments
+    """
+    global args, registry, buckets, tta, camera_sessions, scheduler, decode_pool
+    args = app_args
+    args.seed = time.time()
+
+    if CUDA_AVAILABLE:
+        os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+        torch.cuda.manual_seed(int(args.seed))
+
+    tuned = None
+    if args.tuned_config:
+        # before anything runs on the model, the inter-op pool can only be sized once
+        tuned = load_tuned_config(args.tuned_config)
+        args.sched_batch = args.batch_forward = int(tuned['batch'])
+        print("=> tuned config '{}': {} threads {} interop {} batch {}".format(
+            args.tuned_config, tuned['backend'], tuned['threads'], tuned['interop_threads'], tuned['batch']))
+
+    buckets = ResolutionBuckets.parse(args.buckets, args.bucket_mode) if args.buckets else None
+    tta = TestTimeAugmentation.parse(args.tta_scales, merge=args.tta_merge)
+    # every bucket of every model is compiled and run once before app.run accepts requests
+    registry = ModelRegistry(device='cuda' if CUDA_AVAILABLE else 'cpu', buckets=buckets,
+                             compile_buckets=not args.bucket_eager)
+    registry.on_swap(_update_model_info)
+
+    default_spec = {'version': args.version, 'ratio': 4, 'transform': args.transform, 'checkpoint': args.checkpoint}
+    if tuned is not None:
+        if args.checkpoint != parser.get_default('checkpoint') or args.version != parser.get_default('version'):
+            print("=> warning: --checkpoint and --version are ignored, the model of '{}' is used".format(
+                args.tuned_config))
+        default_spec = tuned['spec']
+    elif args.checkpoint and not os.path.isfile(args.checkpoint):
         print("=> no checkpoint found at '{}'".format(args.checkpoint))
+        default_spec['checkpoint'] = None
+    print("=> loading model 'default' {}".format(default_spec))
+    info = registry.load('default', default_spec)
+    print("=> loaded model 'default' (epoch {})".format(info['epoch']))
+    cal_para(registry.get())  # including 1x1conv transform layer that can be removed
+    if args.models:
+        with open(args.models) as f:
+            for name, spec in json.load(f).items():
+                info = registry.load(name, spec)
+                print("=> loaded model '{}' (epoch {}, warm-up {}s)".format(name, info['epoch'],
+                                                                          info['warmup_seconds']))
+
+    camera_sessions = SessionStore(registry.get(), tile_size=args.tile_size, threshold=args.tile_threshold,
+                                   device='cuda' if CUDA_AVAILABLE else 'cpu')
+    scheduler = FairScheduler(registry.get(), batch_size=args.sched_batch, max_age=args.sched_max_age,
+                              max_queue=args.sched_max_queue, device='cuda' if CUDA_AVAILABLE else 'cpu',
+                              idle_ttl=args.sched_idle_ttl, max_cameras=args.sched_max_cameras)
+    scheduler.start()
+    registry.on_swap(_follow_default)
+    # cv2.imdecode releases the GIL, so the images of a batch request decode in parallel
+    decode_pool = ThreadPool(args.decode_threads)
+
+    app.config['JSON_AS_ASCII'] = False
+    # werkzeug rejects larger bodies before reading them, multipart files spill to disk
+    app.config['MAX_CONTENT_LENGTH'] = args.max_upload_mb * 1024 * 1024
+    return app
+
+
+class _BadRequest(Exception):
+    pass
+
+
+def _number_param(params: dict, name: str, default, cast=float, minimum=None):
+    """
+    Numeric request parameter, form and query values are strings, _BadRequest when it is no number or
+    below minimum
+    """
+    try:
+        value = cast(params.get(name, default))
+    except (TypeError, ValueError):
+        raise _BadRequest('{} must be {}'.format(name, 'an integer' if cast is int else 'a number'))
+    if value != value:
+        raise _BadRequest('{} must be a number'.format(name))
+    if minimum is not None and value < minimum:
+        raise _BadRequest('{} must be at least {}'.format(name, minimum))
+    return value
+
+
+def _decode_upload(data, max_side: int) -> CvImgType:
+    size = jpeg_size(data)
+    if size is not None and size[0] * size[1] > args.max_pixels:
+        raise _BadRequest('image too large: {}x{}'.format(size[1], size[0]))
+    with STAGE_SECONDS.time(stage='decode'):
+        img = bytes_to_cvimage(data, max_side)
+    if img is None:
+        raise _BadRequest('can not decode image')
+    if img.shape[0] * img.shape[1] > args.max_pixels:
+        raise _BadRequest('image too large: {}x{}'.format(img.shape[1], img.shape[0]))
+    INPUT_PIXELS.observe(img.shape[0] * img.shape[1])
+    return img
+
+
+def _read_request_image():
+    """
+    Image and parameters of a request, the image is one of
+    JSON body {"image": base64, ...}
+    raw image/* or application/octet-stream body, parameters in the query string
+    multipart/form-data with an 'image' or 'file' part, parameters in the other form fields
+    raw and multipart bodies are decoded from the request buffer without base64
+    """
+    mimetype = request.mimetype
+    with STAGE_SECONDS.time(stage='parse'):
+        if mimetype.startswith('image/') or mimetype == 'application/octet-stream':
+            params = request.args.to_dict()
+            data = request.get_data(cache=False)
+        elif mimetype == 'multipart/form-data':
+            params = request.form.to_dict()
+            upload = request.files.get('image') or request.files.get('file')
+            if upload is None:
+                raise _BadRequest('no image part')
+            data = upload.read()
+        else:
+            params = request.get_json(silent=True) or {}
+            if 'image' not in params:
+                raise _BadRequest('no image')
+            data = params['image']
+    if isinstance(data, str):
+        with STAGE_SECONDS.time(stage='base64'):
+            try:
+                data = base64.b64decode(data)
+            except binascii.Error:
+                raise _BadRequest('image is not base64')
+
+    if 'rois' in params:
+        params['rois'] = _parse_rois(params['rois'])
+    return _decode_upload(data, _number_param(params, 'max_side', 0, int, minimum=0)), params
+
+
+def _parse_rois(rois) -> list:
+    """
+    Polygons [[[x, y], ...], ...] of the 'rois' parameter, each with at least 3 points
+    """
+    # form and query parameters are strings
+    if isinstance(rois, str):
+        try:
+            rois = json.loads(rois)
+        except ValueError:
+            raise _BadRequest('rois is not valid json')
+    if not isinstance(rois, list):
+        raise _BadRequest('rois must be a list of polygons')
+    for polygon in rois:
+        if not isinstance(polygon, list) or len(polygon) < 3 or not all(_is_point(p) for p in polygon):
+            raise _BadRequest('every roi must be a list of at least 3 [x, y] points')
+    return rois
+
+
+def _is_point(point) -> bool:
+    return isinstance(point, list) and len(point) == 2 and all(
+        isinstance(v, (int, float)) and not isinstance(v, bool) and math.isfinite(v) for v in point)
+
+
+@app.errorhandler(_BadRequest)
+def _bad_request(e):
+    return get_result(400, str(e), 0), 400
+
+
+@app.errorhandler(413)
+def _too_large(e):
+    return get_result(413, 'request body larger than {} MB'.format(args.max_upload_mb), 0), 413
+
+
+def _endpoint() -> str:
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+@app.before_request
+def _track_request():
+    g.request_start = time.perf_counter()
+    IN_FLIGHT.inc(endpoint=_endpoint())
+
+
+@app.after_request
+def _count_request(response):
+    REQUESTS.inc(endpoint=_endpoint(), code=response.status_code)
+    REQUEST_SECONDS.observe(time.perf_counter() - g.request_start, endpoint=_endpoint())
+    return response
+
+
+@app.teardown_request
+def _untrack_request(exc):
+    if exc is not None:
+        REQUESTS.inc(endpoint=_endpoint(), code=500)
+    IN_FLIGHT.dec(endpoint=_endpoint())
+
+
+@app.route('/metrics', methods=['GET'])
+def _metrics():
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
 
 
-@get_use_time
 @app.route('/get_people_num', methods=['POST'])
+@get_use_time
 def _get_people_num():
-    params = request.json if request.method == "POST" else request.args
-    print(type(params['image']))
-    input_data = base64_to_cvimage(params["image"])
-
-    transform = transforms.Compose([transforms.ToTensor(),
-                                    transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                                         std=[0.229, 0.224, 0.225])])
-    if input_data.shape[2] != 3:
-        img = cv2.cvtColor(input_data, cv2.COLOR_GRAY2RGB)
+    input_data, params = _read_request_image()
+    model = _pick_model(params)
+
+    if params.get('rois'):
+        # only the roi bounding boxes plus the receptive field are computed
+        with STAGE_SECONDS.time(stage='forward'):
+            roi_counts = count_rois(model, input_data, params['rois'], device='cuda' if CUDA_AVAILABLE else 'cpu')
+        return get_result(200, 'Success', int(sum(roi_counts)), roi_scores=[round(c, 2) for c in roi_counts])
+    if params.get('mode') == 'cascade':
+        # full resolution only where the downscaled pass finds crowds
+        with STAGE_SECONDS.time(stage='forward'):
+            result = count_cascade(model, input_data, threshold=_number_param(params, 'threshold', 0.01),
+                                   device='cuda' if CUDA_AVAILABLE else 'cpu')
+        return get_result(200, 'Success', int(result['count']), path=result['path'], regions=result['regions'])
+
+    if str(params.get('tta', args.tta)).lower() in ('1', 'true'):
+        # all views in one batch, the map is the merged density on the image's cells
+        with STAGE_SECONDS.time(stage='forward'):
+            output, _ = run_tta(model, input_data, tta, device='cuda' if CUDA_AVAILABLE else 'cpu')
+            score = int(output.data.sum())
+    elif buckets is not None:
+        # one of the precompiled shapes, input preparation included in the forward stage
+        with STAGE_SECONDS.time(stage='forward'):
+            output = run_bucketed(model, input_data, buckets, device='cuda' if CUDA_AVAILABLE else 'cpu')
+            score = int(output.data.sum())
     else:
-        img = cv2.cvtColor(input_data, cv2.COLOR_BGR2RGB)
-
-    img = transform(img)
-    img = torch.unsqueeze(img, 0)
+        start = time.perf_counter()
+        # folded models take the BGR uint8 frame as is, copied once into a pooled float buffer
+        with input_batch(model, [input_data], device='cuda' if CUDA_AVAILABLE else 'cpu') as img:
+            STAGE_SECONDS.observe(time.perf_counter() - start, stage='input')
+            with STAGE_SECONDS.time(stage='forward'):
+                output = run_density(model, img)
+                score = int(output.data.sum())
+    with STAGE_SECONDS.time(stage='response'):
+        ret_data = get_result(200, 'Success', score, **_density_extras(output[0, 0], params))
+    return ret_data
 
-    model.eval()
-    img = img.cuda() if CUDA_AVAILABLE else img
-    img = Variable(img)
 
-    with torch.no_grad():
-        output = model(img)
-    ret_data = get_result(200, 'Success', int(output.data.sum()))
-    return ret_data
+def _density_extras(density, params: dict) -> dict:
+    """
+    Optional density map ('density': png16/png8/sparse) and head locations ('points': true) of a response,
+    request sizes are capped by --max_density_cells and --max_points
+    """
+    extras = {}
+    if params.get('density'):
+        max_cells = min(_number_param(params, 'max_cells', args.max_density_cells, int, minimum=1),
+                        args.max_density_cells)
+        threshold = _number_param(params, 'density_threshold', 0.001, minimum=0)
+        try:
+            extras['density'] = encode_density(density.cpu().numpy(), params['density'], max_cells=max_cells,
+                                               threshold=threshold)
+        except ValueError as e:
+            raise _BadRequest(str(e))
+    if str(params.get('points', '')).lower() in ('1', 'true'):
+        max_points = min(_number_param(params, 'max_points', args.max_points, int, minimum=0), args.max_points)
+        threshold = _number_param(params, 'point_threshold', 0.05, minimum=0)
+        extras['points'] = find_peaks(density, threshold=threshold, max_points=max_points)
+    return extras
+
+
+def _pick_model(params: dict):
+    """
+    Model named by the 'model' parameter, the default model without it
+    """
+    try:
+        return registry.get(params.get('model'))
+    except KeyError:
+        raise _BadRequest('unknown model: {}'.format(params.get('model')))
+
+
+def _read_request_images():
+    """
+    Encoded images and parameters of a batch request, either
+    JSON body {"images": [base64, ...], ...}
+    multipart/form-data with 'images' parts (or any file parts in order), parameters in the other form fields
+    """
+    if request.mimetype == 'multipart/form-data':
+        params = request.form.to_dict()
+        uploads = request.files.getlist('images') or list(request.files.values())
+        items = [upload.read() for upload in uploads]
+    else:
+        params = request.get_json(silent=True) or {}
+        items = params.get('images')
+        if not isinstance(items, list):
+            raise _BadRequest('no images')
+    if len(items) > args.max_batch_images:
+        raise _BadRequest('too many images: {} > {}'.format(len(items), args.max_batch_images))
+    return items, params
+
+
+def _decode_batch_item(item, max_side: int):
+    """
+    Decoded image or the error message of one batch item
+    """
+    try:
+        data = base64.b64decode(item, validate=True) if isinstance(item, str) else item
+        return _decode_upload(data, max_side), None
+    except (_BadRequest, binascii.Error, TypeError) as e:
+        return None, str(e) or 'can not decode image'
+
+
+@app.route('/get_people_num_batch', methods=['POST'])
+def _get_people_num_batch():
+    """
+    Count a list of images in one call, results follow the input order with a code per image
+    """
+    with STAGE_SECONDS.time(stage='parse'):
+        items, params = _read_request_images()
+    max_side = _number_param(params, 'max_side', 0, int, minimum=0)
+    model = _pick_model(params)
+    decoded = decode_pool.starmap(_decode_batch_item, [(item, max_side) for item in items])
+
+    results = [None] * len(items)
+    images, positions = [], []
+    pixels = 0
+    for i, (img, error) in enumerate(decoded):
+        if img is not None:
+            if pixels + img.shape[0] * img.shape[1] > args.max_batch_pixels:
+                img, error = None, 'pixel budget of {} exceeded'.format(args.max_batch_pixels)
+            else:
+                pixels += img.shape[0] * img.shape[1]
+        if img is None:
+            results[i] = {'code': 400, 'message': error, 'score': 0}
+            continue
+        images.append(img)
+        positions.append(i)
+    # drop the references so rejected images are freed before inference
+    del decoded
+
+    with STAGE_SECONDS.time(stage='forward'):
+        counts = count_images(model, images, device='cuda' if CUDA_AVAILABLE else 'cpu',
+                              batch_size=args.batch_forward, bucket=args.batch_bucket)
+    for i, count in zip(positions, counts):
+        results[i] = {'code': 200, 'message': 'Success', 'score': int(count)}
+    return get_result(200, 'Success', sum(r['score'] for r in results), results=results)
+
+
+@app.route('/camera_people_num', methods=['POST'])
+def _camera_people_num():
+    """
+    Incremental counting for a static camera, only tiles changed since the last frame are recomputed
+    """
+    input_data, params = _read_request_image()
+    if 'camera_id' not in params:
+        raise _BadRequest('no camera_id')
+    ret = camera_sessions.get(str(params["camera_id"])).update(input_data)
+    return get_result(200, 'Success', int(ret['count']),
+                      recomputed_tiles=ret['recomputed_tiles'], total_tiles=ret['total_tiles'])
+
+
+@app.route('/scheduled_people_num', methods=['POST'])
+def _scheduled_people_num():
+    """
+    Counting through the multi-camera fair scheduler, optional 'weight' sets the camera's share
+    """
+    input_data, params = _read_request_image()
+    if 'camera_id' not in params:
+        raise _BadRequest('no camera_id')
+    camera_id = str(params["camera_id"])
+    weight = _number_param(params, 'weight', 0.) if 'weight' in params else None
+    if weight is not None and not 0 < weight < float('inf'):
+        raise _BadRequest('weight must be a positive number')
+    try:
+        if weight is not None:
+            scheduler.register(camera_id, weight=weight)
+        count = scheduler.submit(camera_id, input_data).result(timeout=args.sched_max_age + args.sched_timeout)
+    except FrameDropped as e:
+        return get_result(503, 'Dropped: {}'.format(e), 0)
+    except FutureTimeout:
+        return get_result(503, 'Timeout', 0)
+    return get_result(200, 'Success', int(count))
+
+
+@app.route('/scheduler_stats', methods=['GET'])
+def _scheduler_stats():
+    return jsonify(scheduler.stats())
+
+
+class _Forbidden(Exception):
+    pass
+
+
+LOCAL_ADDRS = ('127.0.0.1', '::1', '::ffff:127.0.0.1')
+
+
+def _check_admin():
+    """
+    The X-Admin-Token header has to match --admin_token, without a token only localhost is let in
+    """
+    if args.admin_token:
+        if request.headers.get('X-Admin-Token') != args.admin_token:
+            raise _Forbidden()
+    elif request.remote_addr not in LOCAL_ADDRS:
+        raise _Forbidden()
+
+
+@app.errorhandler(_Forbidden)
+def _forbidden(e):
+    return get_result(403, 'Forbidden', 0), 403
+
+
+@app.route('/admin/models', methods=['GET'])
+def _list_models():
+    _check_admin()
+    return jsonify(registry.describe())
+
+
+@app.route('/admin/models/<name>', methods=['POST'])
+def _load_model(name: str):
+    """
+    Load (or reload) a model from the JSON spec body, it takes the name only after loading and warm-up,
+    'default': true also moves the default traffic to it
+    """
+    _check_admin()
+    spec = request.get_json(silent=True) or {}
+    make_default = bool(spec.pop('default', False))
+    try:
+        info = registry.load(name, spec, make_default=make_default)
+    except (FileNotFoundError, KeyError, NotImplementedError, RuntimeError, ValueError) as e:
+        return get_result(400, 'can not load model: {}'.format(e), 0), 400
+    return jsonify(info)
+
+
+@app.route('/admin/models/<name>', methods=['DELETE'])
+def _unload_model(name: str):
+    _check_admin()
+    try:
+        registry.unload(name)
+    except KeyError:
+        return get_result(404, 'unknown model: {}'.format(name), 0), 404
+    except ValueError as e:
+        return get_result(400, str(e), 0), 400
+    return jsonify(registry.describe())
+
+
+@app.route('/admin/models/<name>/default', methods=['POST'])
+def _set_default_model(name: str):
+    _check_admin()
+    try:
+        registry.set_default(name)
+    except KeyError:
+        return get_result(404, 'unknown model: {}'.format(name), 0), 404
+    return jsonify(registry.describe())
 
 
 _allowed_extensions = ['png', 'PNG', 'jpg', 'JPG', 'jpeg']
@@ -155,26 +627,21 @@ def upload():
 
 
 def _read_download_img(img: str) -> int:
-    im = cv2.imread(img)
-    transform = transforms.Compose([transforms.ToTensor(),
-                                    transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                                         std=[0.229, 0.224, 0.225])])
-    if im.shape[2] != 3:
-        im = cv2.cvtColor(im, cv2.COLOR_GRAY2RGB)
+    device = 'cuda' if CUDA_AVAILABLE else 'cpu'
+    if args.tta:
+        output, _ = run_tta(registry.get(), cv2.imread(img), tta, device=device)
+    elif buckets is not None:
+        output = run_bucketed(registry.get(), cv2.imread(img), buckets, device=device)
     else:
-        im = cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
+        output = run_frames(registry.get(), [cv2.imread(img)], device=device)
+    return int(output.data.sum())
 
-    im = transform(im)
-    im = torch.unsqueeze(im, 0)
 
-    model.eval()
-    im = im.cuda() if CUDA_AVAILABLE else im
-    im = Variable(im)
 
-    with torch.no_grad():
-        output = model(im)
-    return int(output.data.sum())
+def main():
+    app_args = parser.parse_args()
+    create_app(app_args).run(host='0.0.0.0', port=app_args.port, debug=True, use_reloader=False)
 
 
-app.config['JSON_AS_ASCII'] = False
-app.run(host='0.0.0.0', port=24433, debug=True, use_reloader=False)
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,8 @@ import scipy
 import scipy.spatial
 import cv2
 
+from image import load_density
+
 parser = argparse.ArgumentParser(description='Files path')
 parser.add_argument('-r', '--root', default='/home/cv/AI_Data/ShanghaiTech//ShanghaiTech', type=str,
                     help='Root path')
@@ -39,17 +41,16 @@ cnt = 1
 for mat_file, h5_file, img_file in zip(mat_set_path, h5_set_path, img_set_path):
     print(f'img:{img_file}\nmat:{img_file}\nh5:{h5_file}')
     cnt += 1
-    with h5py.File(h5_file, 'r') as f:
-        mat = io.loadmat(mat_file)
-        # print(mat['image_info'].dtype)
-        # print(mat['image_info'][0, 0])
-        density_img = f['density'][:]
-        print(density_img.sum())
-        img = plt.imread(img_file)
-        plt.subplot(1, 2, 1)
-        plt.imshow(img)
-
-        plt.subplot(1, 2, 2)
-        plt.imshow(density_img)
-
-        plt.show()
+    mat = io.loadmat(mat_file)
+    # print(mat['image_info'].dtype)
+    # print(mat['image_info'][0, 0])
+    density_img = load_density(h5_file)
+    print(density_img.sum())
+    img = plt.imread(img_file)
+    plt.subplot(1, 2, 1)
+    plt.imshow(img)
+
+    plt.subplot(1, 2, 2)
+    plt.imshow(density_img)
+
+    plt.show()
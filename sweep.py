@@ -0,0 +1,396 @@
+"""
+Sweep of the distillation weights lamb_fsp, lamb_cos and the learning rate as concurrent short runs
+
+Every trial trains the student on the same fixed set of train crops. The crops are decoded once into a cache
+directory together with the teacher's output and features on them (memory mapped .npy files, the page cache
+is shared by all trials and the teacher never runs during the sweep), the val images are decoded once as well.
+The cache is rebuilt only when the teacher, the json lists or the crop settings change.
+
+Trials run in their own processes with a fixed number of torch threads. After --grace epochs a trial whose
+best val MAE is worse than the median best MAE of the other trials at the same epoch is stopped. Each finished
+trial is added to <out>/report.json, ranked by best val MAE.
+
+python sweep.py -tc CSRNet_models_weights/partA_teacher.pth.tar --lamb_fsp 0 0.5 1 --lamb_cos 0 0.5 1 --lr 1e-4 4e-4
+python sweep.py -tc CSRNet_models_weights/partA_teacher.pth.tar --search random --trials 24 --parallel 4
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import math
+import os
+import random
+import statistics
+import time
+from multiprocessing import Manager, Pool
+
+import cv2
+import numpy as np
+import torch
+import torch.nn as nn
+
+from dataset_index import gt_path_for
+from image import PointDensity, load_gt, reshape_target
+from inference import run_frames, to_input_batch
+from models import build_model, load_checkpoint
+from models.distillation import distillation_loss
+from models.model_teacher_vgg import CSRNet as CSRNet_teacher
+from utils import IMAGENET_MEAN
+
+CACHE_VERSION = 1
+
+parser = argparse.ArgumentParser(description='CSRNet-SKT distillation sweep')
+parser.add_argument('--train_json', metavar='TRAIN', default='./preprocess/A_train.json',
+                    help='path to train json')
+parser.add_argument('--val_json', metavar='VAL', default='./preprocess/A_val.json',
+                    help='path to val json')
+parser.add_argument('--teacher_ckpt', '-tc', default='./CSRNet_models_weights/partA_teacher.pth.tar', type=str,
+                    help='teacher checkpoint')
+parser.add_argument('--student_ckpt', '-sc', default='', type=str,
+                    help='student weights every trial starts from, a fresh init when empty')
+parser.add_argument('--lamb_fsp', '-laf', type=float, nargs='+', default=[0., 0.5, 1.],
+                    help='dense fsp loss weights (grid) or their range (random)')
+parser.add_argument('--lamb_cos', '-lac', type=float, nargs='+', default=[0., 0.5, 1.],
+                    help='cos loss weights (grid) or their range (random)')
+parser.add_argument('--lr', type=float, nargs='+', default=[1e-4, 4e-4],
+                    help='learning rates (grid) or their range (random, log uniform)')
+parser.add_argument('--search', choices=['grid', 'random'], default='grid',
+                    help='every combination or --trials random draws')
+parser.add_argument('--trials', type=int, default=16,
+                    help='number of random search trials')
+parser.add_argument('--epochs', type=int, default=5,
+                    help='epochs per trial, one epoch is one pass over the cached crops')
+parser.add_argument('--samples', type=int, default=200,
+                    help='fixed train crops shared by the trials')
+parser.add_argument('--crop_size', type=int, nargs=2, default=[256, 256],
+                    help='height and width of the train crops')
+parser.add_argument('--val_samples', type=int, default=0,
+                    help='val images used per epoch, 0 for all')
+parser.add_argument('--parallel', '-p', type=int, default=2,
+                    help='trials running at the same time')
+parser.add_argument('--threads', type=int, default=0,
+                    help='torch threads per trial, 0 splits the cpu cores between the parallel trials')
+parser.add_argument('--grace', type=int, default=2,
+                    help='epochs every trial runs before it can be stopped early')
+parser.add_argument('--min_trials', type=int, default=3,
+                    help='other trials that must have reached an epoch before the median rule applies')
+parser.add_argument('--seed', type=int, default=0,
+                    help='seed of the crops, the student init and the sample order, the same for every trial')
+parser.add_argument('--cache', default='./sweep_cache', type=str,
+                    help='directory of the decoded data and teacher output cache')
+parser.add_argument('--out', metavar='OUTPUT', type=str, default='./sweep',
+                    help='path to output')
+
+# per trial process, set by _init_worker
+_args = None
+_meta = None
+_history = None
+_lock = None
+
+
+def make_trials(args) -> list:
+    """
+    Hyper parameters of every trial, a grid over the given values or random draws from their ranges
+    """
+    if args.search == 'grid':
+        return [{'lamb_fsp': f, 'lamb_cos': c, 'lr': lr}
+                for f, c, lr in itertools.product(args.lamb_fsp, args.lamb_cos, args.lr)]
+    rng = random.Random(args.seed)
+    trials = []
+    for _ in range(args.trials):
+        trials.append({'lamb_fsp': rng.uniform(min(args.lamb_fsp), max(args.lamb_fsp)),
+                       'lamb_cos': rng.uniform(min(args.lamb_cos), max(args.lamb_cos)),
+                       'lr': math.exp(rng.uniform(math.log(min(args.lr)), math.log(max(args.lr))))})
+    return trials
+
+
+def cache_key(args, train_list: list, val_list: list) -> str:
+    stat = os.stat(args.teacher_ckpt)
+    desc = {'version': CACHE_VERSION,
+            'teacher': [os.path.abspath(args.teacher_ckpt), stat.st_size, stat.st_mtime_ns],
+            'train': train_list, 'val': val_list, 'samples': args.samples, 'crop_size': args.crop_size,
+            'val_samples': args.val_samples, 'seed': args.seed}
+    return hashlib.sha1(json.dumps(desc, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _crop(img, target, dx: int, dy: int, crop_h: int, crop_w: int, flip: bool):
+    """
+    crop_h x crop_w crop of a BGR image and its 1/8 density, images smaller than the crop are padded
+    with the mean colour (zero after normalization) and zero density
+    """
+    height, width = img.shape[:2]
+    pad_h, pad_w = max(crop_h - height, 0), max(crop_w - width, 0)
+    if pad_h or pad_w:
+        mean = [255. * m for m in reversed(IMAGENET_MEAN)]
+        img = cv2.copyMakeBorder(img, 0, pad_h, 0, pad_w, cv2.BORDER_CONSTANT, value=mean)
+        if not isinstance(target, PointDensity):
+            target = np.pad(target, ((0, pad_h), (0, pad_w)))
+
+    img = img[dy:dy + crop_h, dx:dx + crop_w]
+    if isinstance(target, PointDensity):
+        target = target.crop(dx, dy, crop_w, crop_h)
+        target = (target.fliplr() if flip else target).render(3)
+    else:
+        target = target[dy:dy + crop_h, dx:dx + crop_w]
+        target = reshape_target(np.ascontiguousarray(np.fliplr(target) if flip else target), 3)
+    if flip:
+        img = img[:, ::-1]
+    return np.ascontiguousarray(img), target
+
+
+def _build_train_cache(args, train_list: list) -> int:
+    """
+    Decode the fixed crops (each image once), returns the number of samples
+    """
+    crop_h, crop_w = args.crop_size
+    rng = random.Random(args.seed)
+    sources = list(train_list)
+    rng.shuffle(sources)
+    samples = {}
+    for i in range(args.samples):
+        samples.setdefault(sources[i % len(sources)], []).append(i)
+
+    images = np.lib.format.open_memmap(os.path.join(args.cache, 'train_img.npy'), mode='w+', dtype=np.uint8,
+                                       shape=(args.samples, crop_h, crop_w, 3))
+    targets = None
+    for img_path, indices in samples.items():
+        img = cv2.imread(img_path)
+        if img is None:
+            raise FileNotFoundError("can not read image '{}'".format(img_path))
+        target = load_gt(gt_path_for(img_path))
+        height, width = img.shape[:2]
+        for i in indices:
+            dx = rng.randint(0, max(width - crop_w, 0))
+            dy = rng.randint(0, max(height - crop_h, 0))
+            images[i], density = _crop(img, target, dx, dy, crop_h, crop_w, rng.random() > 0.8)
+            if targets is None:
+                targets = np.lib.format.open_memmap(os.path.join(args.cache, 'train_target.npy'), mode='w+',
+                                                    dtype=np.float32, shape=(args.samples, 1) + density.shape)
+            targets[i, 0] = density
+    images.flush()
+    targets.flush()
+    return args.samples
+
+
+def _build_teacher_cache(args, batch_size: int = 4) -> list:
+    """
+    Teacher output and captured features of every cached crop, features are stored as float16.
+    Returns the file names, output last.
+    """
+    teacher = CSRNet_teacher()
+    load_checkpoint(teacher, args.teacher_ckpt)
+    teacher.eval()
+    images = np.load(os.path.join(args.cache, 'train_img.npy'), mmap_mode='r')
+    names = None
+    arrays = None
+    with teacher.feature_capture() as capture:
+        for start in range(0, len(images), batch_size):
+            batch = to_input_batch(list(images[start:start + batch_size]))
+            with torch.no_grad():
+                output = teacher(batch)
+            features = capture.features + [output]
+            if arrays is None:
+                names = ['teacher_feat{}.npy'.format(i) for i in range(len(features) - 1)] + ['teacher_out.npy']
+                arrays = [np.lib.format.open_memmap(os.path.join(args.cache, name), mode='w+',
+                                                    dtype=np.float32 if name == 'teacher_out.npy' else np.float16,
+                                                    shape=(len(images),) + tuple(f.shape[1:]))
+                          for name, f in zip(names, features)]
+            for array, feature in zip(arrays, features):
+                array[start:start + len(batch)] = feature.numpy()
+    for array in arrays:
+        array.flush()
+    return names
+
+
+def _build_val_cache(args, val_list: list) -> tuple:
+    """
+    Val images as one flat uint8 file, returns (layout [(offset, shape), ...], counts)
+    """
+    if args.val_samples:
+        val_list = val_list[:args.val_samples]
+    layout = []
+    counts = []
+    offset = 0
+    with open(os.path.join(args.cache, 'val.bin'), 'wb') as f:
+        for img_path in val_list:
+            img = cv2.imread(img_path)
+            if img is None:
+                raise FileNotFoundError("can not read image '{}'".format(img_path))
+            f.write(img.tobytes())
+            layout.append((offset, list(img.shape)))
+            offset += img.nbytes
+            counts.append(float(load_gt(gt_path_for(img_path)).sum()))
+    return layout, counts
+
+
+def build_cache(args) -> dict:
+    """
+    Decoded train crops, teacher outputs and val images in args.cache, reused while its key matches
+    """
+    with open(args.train_json, 'r') as outfile:
+        train_list = json.load(outfile)
+    with open(args.val_json, 'r') as outfile:
+        val_list = json.load(outfile)
+    key = cache_key(args, train_list, val_list)
+    meta_path = os.path.join(args.cache, 'meta.json')
+    if os.path.isfile(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get('key') == key:
+            print('=> using cache {}'.format(args.cache))
+            return meta
+
+    os.makedirs(args.cache, exist_ok=True)
+    start = time.time()
+    samples = _build_train_cache(args, train_list)
+    print('=> decoded {} train crops in {:.1f}s'.format(samples, time.time() - start))
+    start = time.time()
+    teacher_files = _build_teacher_cache(args)
+    print('=> cached teacher outputs in {:.1f}s'.format(time.time() - start))
+    val_layout, val_counts = _build_val_cache(args, val_list)
+
+    meta = {'key': key, 'samples': samples, 'teacher_files': teacher_files,
+            'val_layout': val_layout, 'val_counts': val_counts}
+    # written last, an interrupted build is rebuilt next time
+    tmp = meta_path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp, meta_path)
+    return meta
+
+
+def _init_worker(args, meta: dict, history, lock, threads: int):
+    global _args, _meta, _history, _lock
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+    _args, _meta, _history, _lock = args, meta, history, lock
+
+
+def _open_cache(cache: str, meta: dict) -> tuple:
+    images = np.load(os.path.join(cache, 'train_img.npy'), mmap_mode='r')
+    targets = np.load(os.path.join(cache, 'train_target.npy'), mmap_mode='r')
+    teacher = [np.load(os.path.join(cache, name), mmap_mode='r') for name in meta['teacher_files']]
+    data = np.memmap(os.path.join(cache, 'val.bin'), dtype=np.uint8, mode='r')
+    val_frames = [data[offset:offset + int(np.prod(shape))].reshape(shape) for offset, shape in meta['val_layout']]
+    return images, targets, teacher, val_frames
+
+
+def _should_stop(name: str, epoch: int, best_mae: float) -> bool:
+    """
+    Median stopping rule: record this trial's best MAE at epoch, True when it is worse than the median of the
+    other trials that reached the epoch
+    """
+    with _lock:
+        curve = _history.get(name, [])
+        _history[name] = curve + [best_mae]
+        others = [c[epoch] for n, c in _history.items() if n != name and len(c) > epoch]
+    if epoch + 1 < _args.grace or len(others) < _args.min_trials:
+        return False
+    return best_mae > statistics.median(others)
+
+
+def validate(model, frames: list, counts: list) -> tuple:
+    model.eval()
+    abs_sum = 0.
+    sq_sum = 0.
+    for frame, count in zip(frames, counts):
+        error = float(run_frames(model, [frame]).sum()) - count
+        abs_sum += abs(error)
+        sq_sum += error ** 2
+    return abs_sum / len(counts), math.sqrt(sq_sum / len(counts))
+
+
+def run_trial(trial: dict) -> dict:
+    start = time.time()
+    images, targets, teacher, val_frames = _open_cache(_args.cache, _meta)
+    torch.manual_seed(_args.seed)
+    student = build_model('quarter_vgg')
+    if _args.student_ckpt:
+        load_checkpoint(student, _args.student_ckpt)
+    criterion = nn.MSELoss(reduction='sum')
+    optimizer = torch.optim.Adam(student.parameters(), trial['lr'], weight_decay=5 * 1e-4)
+    rng = np.random.RandomState(_args.seed)
+
+    result = dict(trial, status='completed', val_mae=[], val_mse=[])
+    best_mae = float('inf')
+    for epoch in range(_args.epochs):
+        student.train()
+        for i in rng.permutation(len(images)):
+            img = to_input_batch([images[i]])
+            target = torch.from_numpy(np.array(targets[i:i + 1]))
+            teacher_features = [torch.from_numpy(t[i:i + 1].astype(np.float32)) for t in teacher]
+            loss = distillation_loss(student(img), teacher_features, target, criterion,
+                                     trial['lamb_fsp'], trial['lamb_cos'])[0]
+            if not math.isfinite(loss.item()):
+                result['status'] = 'diverged'
+                break
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+        if result['status'] == 'diverged':
+            break
+
+        mae, mse = validate(student, val_frames, _meta['val_counts'])
+        result['val_mae'].append(round(mae, 4))
+        result['val_mse'].append(round(mse, 4))
+        best_mae = min(best_mae, mae)
+        if epoch + 1 < _args.epochs and _should_stop(trial['name'], epoch, best_mae):
+            result['status'] = 'stopped'
+            break
+
+    result['epochs'] = len(result['val_mae'])
+    result['best_mae'] = round(best_mae, 4) if result['val_mae'] else None
+    result['best_mse'] = min(result['val_mse']) if result['val_mse'] else None
+    result['seconds'] = round(time.time() - start, 1)
+    return result
+
+
+def write_report(path: str, args, results: list):
+    ranked = sorted(results, key=lambda r: (r['best_mae'] is None, r['best_mae'] or 0.))
+    report = {'search': args.search, 'epochs': args.epochs, 'samples': args.samples, 'crop_size': args.crop_size,
+              'trials': ranked}
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp, path)
+    return ranked
+
+
+def main(args):
+    meta = build_cache(args)
+    trials = make_trials(args)
+    for i, trial in enumerate(trials):
+        trial['name'] = 'trial{}'.format(i)
+    os.makedirs(args.out, exist_ok=True)
+    report_path = os.path.join(args.out, 'report.json')
+
+    parallel = max(1, min(args.parallel, len(trials)))
+    threads = args.threads or max(1, (os.cpu_count() or 1) // parallel)
+    print('=> {} trials, {} at a time with {} threads each'.format(len(trials), parallel, threads))
+    results = []
+    with Manager() as manager:
+        history = manager.dict()
+        lock = manager.Lock()
+        # a fresh process per trial, nothing of one run's allocator or thread pools leaks into the next
+        with Pool(parallel, initializer=_init_worker, initargs=(args, meta, history, lock, threads),
+                  maxtasksperchild=1) as pool:
+            for result in pool.imap_unordered(run_trial, trials):
+                results.append(result)
+                print('{name} lamb_fsp {lamb_fsp:.4g} lamb_cos {lamb_cos:.4g} lr {lr:.4g}: {status} after {epochs} '
+                      'epochs, best MAE {best_mae} ({seconds}s)'.format(**result))
+                write_report(report_path, args, results)
+
+    ranked = write_report(report_path, args, results)
+    print('{:<4} {:<8} {:>9} {:>9} {:>10} {:>10} {:>10}'.format('rank', 'trial', 'lamb_fsp', 'lamb_cos', 'lr',
+                                                               'MAE', 'status'))
+    for rank, r in enumerate(ranked, 1):
+        print('{:<4} {:<8} {:>9.4g} {:>9.4g} {:>10.4g} {:>10} {:>10}'.format(
+            rank, r['name'], r['lamb_fsp'], r['lamb_cos'], r['lr'], str(r['best_mae']), r['status']))
+    print('report written to {}'.format(report_path))
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -5,18 +5,22 @@ import json
 import time
 
 import cv2
-import h5py
 import numpy as np
-from PIL import Image
-from matplotlib import pyplot as plt
 import torch
 from torch.utils.data import DataLoader
 from torch.autograd import Variable
 from torchvision import datasets, transforms
 
 import mydataset
+import dataset_index
+from image import load_density
+from autotune import load_tuned_config
+from inference import count_rois, count_cascade, run_frames
+from model_registry import load_model
+from tta import TestTimeAugmentation, run_tta
 from models.model_vgg import CSRNet as CSRNet_vgg
 from models.model_student_vgg import CSRNet as CSRNet_student
+from models.raw_input import fold_input_normalization
 from utils import save_checkpoint
 from utils import cal_para, crop_img_patches, get_use_time
 
@@ -39,8 +43,23 @@ parser.add_argument('--batch', default=1, type=int,
                     help='batch size')
 parser.add_argument('--gpu', metavar='GPU', default='0', type=str,
                     help='GPU id to use.')
-
-args = parser.parse_args()
+parser.add_argument('--use_index', action='store_true',
+                    help='skip images changed since dataset_index.py indexed the test json, largest first')
+parser.add_argument('--roi', type=str, default='',
+                    help='roi polygons for --img, json [[[x, y], ...], ...] or a json file with it')
+parser.add_argument('--cascade', action='store_true',
+                    help='coarse-to-fine inference for --img, full resolution only where crowded')
+parser.add_argument('--cascade_threshold', default=0.01, type=float,
+                    help='coarse density per 8x8 cell above which a region is re-run at full resolution')
+parser.add_argument('--tuned_config', type=str, default='',
+                    help='autotune.py output, its model, backend and threads replace --checkpoint and --version '
+                         '(not for UCF)')
+parser.add_argument('--tta', action='store_true',
+                    help='shanghai and single images also run flipped (and --tta_scales) in the same batch')
+parser.add_argument('--tta_scales', type=str, default='',
+                    help='extra tta scales, e.g. 0.75,1.25')
+parser.add_argument('--tta_merge', default='mean', choices=['mean', 'median'],
+                    help='count of the tta views')
 
 # Type Config
 Path = str
@@ -59,6 +78,52 @@ def main(args):
         os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
         torch.cuda.manual_seed(int(args.seed))
 
+    if args.tuned_config:
+        model = load_tuned_model(args)
+    else:
+        model = load_checkpoint_model(args)
+
+    if args.dataset == 'UCF':
+        test_ucf(model)
+    elif args.dataset == 'Shanghai':
+        test_shanghai(model)
+    else:
+        img_path = args.img
+        if os.path.exists(args.img) is False:
+            print(f'img path:{args.img} is error ')
+            exit(0)
+        if args.roi:
+            polygons = load_polygons(args.roi)
+            img = cv2.imread(img_path)
+            model.eval()
+            roi_counts = count_rois(model, img, polygons, device='cuda' if CUDA_AVAILABLE else 'cpu')
+            ret = int(sum(roi_counts))
+            for polygon, count in zip(polygons, roi_counts):
+                polygon = np.asarray(polygon, dtype=np.int32).reshape(-1, 2)
+                print(f'roi:{polygon.tolist()} people num:{count:.2f}')
+                cv2.polylines(img, [polygon], True, (0, 255, 0), 2)
+                cv2.putText(img, '{:.0f}'.format(count), tuple(int(v) for v in polygon[0]),
+                            cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 1)
+        elif args.cascade:
+            img = cv2.imread(img_path)
+            model.eval()
+            result = count_cascade(model, img, threshold=args.cascade_threshold,
+                                   device='cuda' if CUDA_AVAILABLE else 'cpu')
+            print(f"path:{result['path']} regions:{result['regions']}")
+            ret = int(result['count'])
+        else:
+            ret = run_model(img_path, model)
+            img = cv2.imread(img_path)
+        cv2.putText(img, 'people num:{}'.format(ret), (20, 20), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 1)
+        cv2.imshow('img', img)
+        cv2.imwrite('out.jpg', img)
+        cv2.waitKey(0)
+
+
+def load_checkpoint_model(args):
+    """
+    --version model with the --checkpoint weights, folded for raw BGR input except on UCF
+    """
     if args.version == 'vgg':
         print('VGG')
         model = CSRNet_vgg(pretrained=False)
@@ -90,32 +155,41 @@ def main(args):
             print("=> no checkpoint found at '{}'".format(args.checkpoint))
             exit(0)
 
+    model.eval()
+    if args.dataset != 'UCF':
+        # shanghai and single images run on raw BGR frames, UCF crops normalized tensors into patches
+        fold_input_normalization(model)
+    return model
+
+
+def load_tuned_model(args):
+    """
+    Model, threads and backend of an autotune.py config, it replaces --checkpoint and --version
+    """
     if args.dataset == 'UCF':
-        test_ucf(model)
-    elif args.dataset == 'Shanghai':
-        test_shanghai(model)
-    else:
-        img_path = args.img
-        if os.path.exists(args.img) is False:
-            print(f'img path:{args.img} is error ')
-            exit(0)
-        ret = run_model(img_path, model)
-        img = cv2.imread(img_path)
-        cv2.putText(img, 'people num:{}'.format(ret), (20, 20), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 1)
-        cv2.imshow('img', img)
-        cv2.imwrite('out.jpg', img)
-        cv2.waitKey(0)
+        # the tuned model may take raw BGR frames, UCF crops normalized tensors into patches
+        parser.error('--tuned_config can not be used with the UCF dataset')
+    if args.checkpoint != parser.get_default('checkpoint') or args.version != parser.get_default('version'):
+        print("=> warning: --checkpoint and --version are ignored, the model of '{}' is used".format(
+            args.tuned_config))
+    tuned = load_tuned_config(args.tuned_config)
+    print("=> tuned config '{}': {} threads {}".format(args.tuned_config, tuned['backend'], tuned['threads']))
+    model, _ = load_model(tuned['spec'], device='cuda' if CUDA_AVAILABLE else 'cpu')
+    return model
 
 
 def test_shanghai(model):
+    # only needed to draw the results
+    from matplotlib import pyplot as plt
+
     print('begin test')
 
     with open(args.test_json, 'r') as outfile:
         test_list = json.load(outfile)
+    if args.use_index:
+        index = dataset_index.load_index(dataset_index.index_path_for(args.test_json))
+        test_list = dataset_index.sort_by_size(dataset_index.filter_stale(test_list, index), index)
 
-    transform = transforms.Compose([transforms.ToTensor(),
-                                    transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                                         std=[0.229, 0.224, 0.225])])
     h5_set = []
     for test_item in test_list:
         h5_set.append(test_item.replace('images', 'ground-truth-h5').replace('jpg', 'h5'))
@@ -124,53 +198,43 @@ def test_shanghai(model):
     mse = 0
 
     for i, (h5_item, img_item) in enumerate(zip(h5_set, test_list)):
-        with h5py.File(h5_item, 'r') as f:
-            density_img = f['density'][:]
-
-            img = Image.open(img_item).convert('RGB')
-            img = transform(img)
-            img = torch.unsqueeze(img, 0)
-
-            model.eval()
-            img = img.cuda() if CUDA_AVAILABLE else img
-            img = Variable(img)
-
-            with torch.no_grad():
-                output = model(img)
-
-            plt.text(x=10,  # 文本x轴坐标
-                     y=60,  # 文本y轴坐标
-                     s='model output:{}'.format(int(output.data.sum())),  # 文本内容
-                     ha='left',  # x=2.2是文字的左端位置，可选'center', 'right', 'left'
-                     va='baseline',  # y=8是文字的低端位置，可选'center', 'top', 'bottom', 'baseline', 'center_baseline'
-                     fontdict=dict(fontsize=12,
-                                   color='r',
-                                   family='monospace',
-                                   weight='bold',
-                                   )  # 字体属性设置
-                     )
-            mae += abs(float(output.data.sum()) - float(density_img.sum()))
-            mse += (float(output.data.sum()) - float(density_img.sum())) ** 2
-
-            # show and save image
-            img = plt.imread(img_item)
-            plt.imshow(img)
-            plt.imshow(density_img, alpha=0.4, cmap='rainbow')  # alpha设置透明度, cmap可以选择颜色
-            plt.text(x=10,  # 文本x轴坐标
-                     y=30,  # 文本y轴坐标
-                     s='target:{}'.format(int(density_img.sum())),  # 文本内容
-                     ha='left',  # x=2.2是文字的左端位置，可选'center', 'right', 'left'
-                     va='baseline',  # y=8是文字的低端位置，可选'center', 'top', 'bottom', 'baseline', 'center_baseline'
-                     fontdict=dict(fontsize=12,
-                                   color='r',
-                                   family='monospace',
-                                   weight='bold',
-                                   )  # 字体属性设置
-                     )
-            print(f'idx:{i} | MAE:{mae} | MSE:{mse}')
-            # plt.savefig("./img_out/part_B/{}.jpg".format(i))
-            # plt.show()
-            # plt.cla()
+        density_img = load_density(h5_item)
+
+        output = run_image(model, cv2.imread(img_item))
+
+        plt.text(x=10,  # 文本x轴坐标
+                 y=60,  # 文本y轴坐标
+                 s='model output:{}'.format(int(output.data.sum())),  # 文本内容
+                 ha='left',  # x=2.2是文字的左端位置，可选'center', 'right', 'left'
+                 va='baseline',  # y=8是文字的低端位置，可选'center', 'top', 'bottom', 'baseline', 'center_baseline'
+                 fontdict=dict(fontsize=12,
+                               color='r',
+                               family='monospace',
+                               weight='bold',
+                               )  # 字体属性设置
+                 )
+        mae += abs(float(output.data.sum()) - float(density_img.sum()))
+        mse += (float(output.data.sum()) - float(density_img.sum())) ** 2
+
+        # show and save image
+        img = plt.imread(img_item)
+        plt.imshow(img)
+        plt.imshow(density_img, alpha=0.4, cmap='rainbow')  # alpha设置透明度, cmap可以选择颜色
+        plt.text(x=10,  # 文本x轴坐标
+                 y=30,  # 文本y轴坐标
+                 s='target:{}'.format(int(density_img.sum())),  # 文本内容
+                 ha='left',  # x=2.2是文字的左端位置，可选'center', 'right', 'left'
+                 va='baseline',  # y=8是文字的低端位置，可选'center', 'top', 'bottom', 'baseline', 'center_baseline'
+                 fontdict=dict(fontsize=12,
+                               color='r',
+                               family='monospace',
+                               weight='bold',
+                               )  # 字体属性设置
+                 )
+        print(f'idx:{i} | MAE:{mae} | MSE:{mse}')
+        # plt.savefig("./img_out/part_B/{}.jpg".format(i))
+        # plt.show()
+        # plt.cla()
 
     N = len(test_list)
     mae = mae / N
@@ -217,34 +281,35 @@ def test_ucf(model):
     return mae, mse
 
 
+def load_polygons(roi: str) -> list:
+    if os.path.isfile(roi):
+        with open(roi, 'r') as f:
+            return json.load(f)
+    return json.loads(roi)
+
+
 @get_use_time
 def run_model(img: [Path, CvImg], model) -> int:
-    transform = transforms.Compose([
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                             std=[0.229, 0.224, 0.225])])
+    """
+    Count a BGR image or image path, the model may be folded (raw input) or not
+    """
     if isinstance(img, Path):
         img = cv2.imread(img)
-        if img.shape[2] != 3:
-            img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
-        else:
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-
-    elif isinstance(img, CvImg):
-        img = img
-
-    img = transform(img)
-    img = torch.unsqueeze(img, 0)
-
-    model.eval()
-    img = img.cuda() if CUDA_AVAILABLE else img
-    img = Variable(img)
+    output = run_image(model, img)
+    return int(output.data.sum())
 
-    with torch.no_grad():
-        output = model(img)
 
-    return int(output.data.sum())
+def run_image(model, img: CvImg):
+    """
+    Density of a BGR image, merged over the flipped / rescaled views with --tta
+    """
+    device = 'cuda' if CUDA_AVAILABLE else 'cpu'
+    if args.tta:
+        tta = TestTimeAugmentation.parse(args.tta_scales, merge=args.tta_merge)
+        return run_tta(model, img, tta, device=device)[0]
+    return run_frames(model, [img], device=device)
 
 
 if __name__ == '__main__':
+    args = parser.parse_args()
     main(args)
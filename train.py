@@ -13,10 +13,14 @@ from torch.autograd import Variable
 from torchvision import datasets, transforms
 
 import mydataset
+import dataset_index
+from augmentation import BatchAugment
 from models.model_teacher_vgg import CSRNet as CSRNet_teacher
 from models.model_student_vgg import CSRNet as CSRNet_student
-from models.distillation import cosine_similarity, scale_process, cal_dense_fsp
-from utils import save_checkpoint, cal_para
+from models.distillation import distillation_loss
+from checkpoint import AsyncCheckpointer
+from profiler import StepProfiler
+from utils import cal_para
 from utils import AverageMeter
 
 parser = argparse.ArgumentParser(description='CSRNet-SKT distillation')
@@ -45,10 +49,24 @@ parser.add_argument('--out', metavar='OUTPUT', type=str, default='./save',
                     help='path to output')
 parser.add_argument('--use_gpu', '-ug', type=bool, default=False,
                     help='use gpu training ot not')
-
-args = parser.parse_args()
-
-CUDA = True if args.use_gpu and torch.cuda.is_available() else False
+parser.add_argument('--crops_per_image', '-k', type=int, default=4,
+                    help='random crops taken from each decoded train image per epoch')
+parser.add_argument('--shuffle_buffer', type=int, default=32,
+                    help='number of crops mixed before yielding a train sample')
+parser.add_argument('--tensor_augment', action='store_true',
+                    help='crop, flip and normalize batched uint8 tensors on the train device')
+parser.add_argument('--crop_size', type=int, nargs=2, default=None,
+                    help='fixed crop height and width with --tensor_augment, smaller images are padded')
+parser.add_argument('--batch', type=int, default=1,
+                    help='train batch size, above 1 needs --tensor_augment and --crop_size so the crops stack')
+parser.add_argument('--scale_jitter', type=float, nargs=2, default=None,
+                    help='min and max random rescale used with --tensor_augment')
+parser.add_argument('--use_index', action='store_true',
+                    help='use the dataset_index.py index of each json to skip stale images and order by size')
+parser.add_argument('--profile', action='store_true',
+                    help='time every phase of the train step and write a chrome trace to <out>/train_trace.json')
+parser.add_argument('--profile_window', type=int, nargs=2, default=[20, 10],
+                    help='first step and number of steps recorded in the trace')
 
 
 def main(args):
@@ -62,7 +80,9 @@ def main(args):
     mae_best_prec1 = 1e6
     mse_best_prec1 = 1e6
 
-    args.batch_size = 1  # args.batch
+    if args.batch > 1 and not (args.tensor_augment and args.crop_size):
+        parser.error('--batch above 1 needs --tensor_augment and --crop_size')
+    args.batch_size = args.batch
     args.momentum = 0.95
     args.decay = 5 * 1e-4
     args.start_epoch = 0
@@ -79,6 +99,16 @@ def main(args):
 
     print('===Read Train Test Val json file===')
 
+    args.train_index = None
+    if args.use_index:
+        args.train_index = dataset_index.load_index(dataset_index.index_path_for(args.train_json))
+        val_index = dataset_index.load_index(dataset_index.index_path_for(args.val_json))
+        test_index = dataset_index.load_index(dataset_index.index_path_for(args.test_json))
+        train_list = dataset_index.filter_stale(train_list, args.train_index)
+        val_list = dataset_index.sort_by_size(dataset_index.filter_stale(val_list, val_index), val_index)
+        test_list = dataset_index.sort_by_size(dataset_index.filter_stale(test_list, test_index), test_index)
+        print('===Indexed images train {} val {} test {}==='.format(len(train_list), len(val_list), len(test_list)))
+
     if CUDA:
         os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
         torch.cuda.manual_seed(int(args.seed))
@@ -87,8 +117,6 @@ def main(args):
     student = CSRNet_student(ratio=4)
     cal_para(student)  # include 1x1 conv transform parameters
 
-    teacher.regist_hook()  # use hook to get teacher's features
-
     # if torch.cuda.is_available() and args.use_gpu:
     if CUDA:
         teacher = teacher.cuda()
@@ -131,9 +159,16 @@ def main(args):
         else:
             print("=> no checkpoint found at '{}'".format(args.student_ckpt))
 
+    # the state is copied to memory at the end of an epoch and written while the next one trains
+    checkpointer = AsyncCheckpointer(args.out)
+    profiler = StepProfiler(args.profile, device='cuda' if CUDA else 'cpu',
+                            window_start=args.profile_window[0], window_steps=args.profile_window[1],
+                            trace_path=os.path.join(args.out, 'train_trace.json'))
     for epoch in range(args.start_epoch, args.epochs):
 
-        train(train_list, teacher, student, criterion, optimizer, epoch)
+        train(train_list, teacher, student, criterion, optimizer, epoch, profiler)
+        if args.profile:
+            print(profiler.summary())
         mae_prec1, mse_prec1 = val(val_list, student)
 
         mae_is_best = mae_prec1 < mae_best_prec1
@@ -141,20 +176,22 @@ def main(args):
         mse_is_best = mse_prec1 < mse_best_prec1
         mse_best_prec1 = min(mse_prec1, mse_best_prec1)
         print('Best val * MAE {mae:.3f} * MSE {mse:.3f}'.format(mae=mae_best_prec1, mse=mse_best_prec1))
-        save_checkpoint({
+        checkpointer.save({
             'epoch': epoch + 1,
             'arch': args.student_ckpt,
             'state_dict': student.state_dict(),
             'mae_best_prec1': mae_best_prec1,
             'mse_best_prec1': mse_best_prec1,
             'optimizer': optimizer.state_dict(),
-        }, mae_is_best, mse_is_best, args.out)
+        }, mae_is_best, mse_is_best)
 
         if mae_is_best or mse_is_best:
             test(test_list, student)
+    checkpointer.close()
+    profiler.close()
 
 
-def train(train_list: list, teacher, student, criterion, optimizer, epoch):
+def train(train_list: list, teacher, student, criterion, optimizer, epoch, profiler=None):
     losses_h = AverageMeter()
     losses_s = AverageMeter()
     losses_fsp = AverageMeter()
@@ -165,84 +202,79 @@ def train(train_list: list, teacher, student, criterion, optimizer, epoch):
     transform = transforms.Compose([transforms.ToTensor(),
                                     transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                                          std=[0.229, 0.224, 0.225])])
-    dataset = mydataset.ListDataset(train_list,
-                                    transform=transform,
-                                    train=True,
-                                    seen=student.seen)
+    # decode each image once and take several crops from it instead of repeating the list
+    dataset = mydataset.MultiCropDataset(train_list,
+                                         transform=None if args.tensor_augment else transform,
+                                         crops_per_image=args.crops_per_image,
+                                         buffer_size=args.shuffle_buffer,
+                                         seen=student.seen,
+                                         raw=args.tensor_augment,
+                                         index=args.train_index,
+                                         crop_size=args.crop_size)
+    # crops are taken in the dataset, only the crop's density is rendered
+    augment = BatchAugment(scale_jitter=args.scale_jitter, crop=False) if args.tensor_augment else None
 
     train_loader = DataLoader(dataset,
                               num_workers=args.workers,
-                              shuffle=True,
                               batch_size=args.batch_size)
     print('epoch %d, lr %.10f %s' % (epoch, args.lr, args.out))
 
+    profiler = profiler or StepProfiler(enabled=False)
     teacher.eval()
     student.train()
     end = time.time()
 
-    for i, (img, target) in enumerate(train_loader):
-        data_time.update(time.time() - end)
-
-        img = img.cuda() if CUDA else img
-        img = Variable(img)
-
-        target = target.type(torch.FloatTensor)
-        target = target.cuda() if CUDA else target
-        target = Variable(target)
-
-        with torch.no_grad():
-            teacher_output = teacher(img)
-            teacher.features.append(teacher_output)
-            teacher_fsp_features = [scale_process(teacher.features)]
-            teacher_fsp = cal_dense_fsp(teacher_fsp_features)
-
-        student_features = student(img)
-        student_output = student_features[-1]
-        student_fsp_features = [scale_process(student_features)]
-        student_fsp = cal_dense_fsp(student_fsp_features)
-
-        loss_h = criterion(student_output, target)
-        loss_s = criterion(student_output, teacher_output)
-
-        loss_fsp = torch.tensor([0.], dtype=torch.float).cuda()
-        if args.lamb_fsp:
-            loss_f = []
-            assert len(teacher_fsp) == len(student_fsp)
-            for t in range(len(teacher_fsp)):
-                loss_f.append(criterion(teacher_fsp[t], student_fsp[t]))
-            loss_fsp = sum(loss_f) * args.lamb_fsp
-
-        loss_cos = torch.tensor([0.], dtype=torch.float).cuda()
-        if args.lamb_cos:
-            loss_c = []
-            for t in range(len(student_features) - 1):
-                loss_c.append(cosine_similarity(student_features[t], teacher.features[t]))
-            loss_cos = sum(loss_c) * args.lamb_cos
-
-        loss = loss_h + loss_s + loss_fsp + loss_cos
-
-        losses_h.update(loss_h.item(), img.size(0))
-        losses_s.update(loss_s.item(), img.size(0))
-        losses_fsp.update(loss_fsp.item(), img.size(0))
-        losses_cos.update(loss_cos.item(), img.size(0))
-        optimizer.zero_grad()
-        torch.cuda.empty_cache()
-        loss.backward()
-        optimizer.step()
-        batch_time.update(time.time() - end)
-        end = time.time()
-        if i % args.print_freq == (args.print_freq - 1):
-            print('Epoch: [{0}][{1}/{2}]\t'
-                  'Time {batch_time.avg:.3f}  '
-                  'Data {data_time.avg:.3f}  '
-                  'Loss_h {loss_h.avg:.4f}  '
-                  'Loss_s {loss_s.avg:.4f}  '
-                  'Loss_fsp {loss_fsp.avg:.4f}  '
-                  'Loss_cos {loss_kl.avg:.4f}  '
-                .format(
-                epoch, i, len(train_loader), batch_time=batch_time,
-                data_time=data_time, loss_h=losses_h, loss_s=losses_s,
-                loss_fsp=losses_fsp, loss_kl=losses_cos))
+    # use hook to get teacher's features, one slot per layer, removed when the epoch ends
+    with teacher.feature_capture() as capture:
+        for i, (img, target) in enumerate(profiler.wrap(train_loader)):
+            data_time.update(time.time() - end)
+
+            with profiler.phase('h2d'):
+                img = img.cuda() if CUDA else img
+                img = Variable(img)
+
+                target = target.type(torch.FloatTensor)
+                target = target.cuda() if CUDA else target
+            if augment is not None:
+                with profiler.phase('augment'):
+                    img, target = augment(img, target)
+            target = Variable(target)
+
+            with profiler.phase('teacher_forward'), torch.no_grad():
+                teacher_output = teacher(img)
+                teacher_features = capture.features + [teacher_output]
+
+            with profiler.phase('student_forward'):
+                student_features = student(img)
+            loss, loss_h, loss_s, loss_fsp, loss_cos = distillation_loss(student_features, teacher_features, target,
+                                                                         criterion, args.lamb_fsp, args.lamb_cos,
+                                                                         profiler)
+
+            losses_h.update(loss_h.item(), img.size(0))
+            losses_s.update(loss_s.item(), img.size(0))
+            losses_fsp.update(loss_fsp.item(), img.size(0))
+            losses_cos.update(loss_cos.item(), img.size(0))
+            optimizer.zero_grad()
+            torch.cuda.empty_cache()
+            with profiler.phase('backward'):
+                loss.backward()
+            with profiler.phase('optimizer'):
+                optimizer.step()
+            profiler.step()
+            batch_time.update(time.time() - end)
+            end = time.time()
+            if i % args.print_freq == (args.print_freq - 1):
+                print('Epoch: [{0}][{1}/{2}]\t'
+                      'Time {batch_time.avg:.3f}  '
+                      'Data {data_time.avg:.3f}  '
+                      'Loss_h {loss_h.avg:.4f}  '
+                      'Loss_s {loss_s.avg:.4f}  '
+                      'Loss_fsp {loss_fsp.avg:.4f}  '
+                      'Loss_cos {loss_kl.avg:.4f}  '
+                    .format(
+                    epoch, i, len(train_loader), batch_time=batch_time,
+                    data_time=data_time, loss_h=losses_h, loss_s=losses_s,
+                    loss_fsp=losses_fsp, loss_kl=losses_cos))
 
 
 def val(val_list: list, model):
@@ -252,11 +284,13 @@ def val(val_list: list, model):
                                                          std=[0.229, 0.224, 0.225])])
     dataset = mydataset.ListDataset(val_list,
                                     transform=transform,
-                                    train=False)
+                                    train=False,
+                                    shuffle=False)
+    # full images of different sizes
     val_loader = DataLoader(dataset,
                             num_workers=args.workers,
                             shuffle=False,
-                            batch_size=args.batch_size)
+                            batch_size=1)
 
     model.eval()
 
@@ -293,11 +327,11 @@ def test(test_list: list, model):
                                     transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                                          std=[0.229, 0.224, 0.225]), ])
     dataset = mydataset.ListDataset(test_list,
-                                    transform=transform, train=False)
+                                    transform=transform, train=False, shuffle=False)
     test_loader = DataLoader(dataset,
                              num_workers=args.workers,
                              shuffle=False,
-                             batch_size=args.batch_size)
+                             batch_size=1)
 
     model.eval()
 
@@ -326,4 +360,6 @@ def test(test_list: list, model):
 
 
 if __name__ == '__main__':
+    args = parser.parse_args()
+    CUDA = True if args.use_gpu and torch.cuda.is_available() else False
     main(args)
@@ -0,0 +1,90 @@
+"""
+Batched test-time augmentation: the image, its horizontal flip and optional rescaled copies in one forward
+
+All views are padded (inference.padded_batch) to the largest of them and run as one batch.
+The flip is applied to the padded batch row over whole output cells, so flipping its density back lines the
+cells up with the original exactly. The density of a rescaled view is resampled to the cells of the original
+image with its sum kept, as in buckets.run_bucketed. The aligned maps are averaged cell by cell; the count is
+the mean or the median of the view counts, the merged map is scaled to it.
+"""
+import cv2
+import torch
+import torch.nn.functional as F
+
+from inference import OUTPUT_STRIDE, padded_batch, run_density
+
+
+class TestTimeAugmentation(object):
+    def __init__(self, scales: list = (), flip: bool = True, merge: str = 'mean'):
+        """
+        :param scales: extra views rescaled by these factors, 1 is the original and always included
+        """
+        if merge not in ('mean', 'median'):
+            raise ValueError('tta merge must be mean or median')
+        if any(scale <= 0 for scale in scales):
+            raise ValueError('tta scales must be positive')
+        self.scales = sorted({float(scale) for scale in scales} - {1.})
+        self.flip = flip
+        self.merge = merge
+
+    @classmethod
+    def parse(cls, scales: str = '', flip: bool = True, merge: str = 'mean'):
+        """
+        TTA from scales like '0.75,1.25'
+        """
+        return cls([float(scale) for scale in scales.split(',') if scale.strip()], flip, merge)
+
+    def views(self) -> list:
+        """
+        [(scale, flipped), ...], the original first
+        """
+        return [(1., False)] + ([(1., True)] if self.flip else []) + [(scale, False) for scale in self.scales]
+
+
+def _cells(length: int) -> int:
+    return -(-length // OUTPUT_STRIDE)
+
+
+def run_tta(model, img, tta: TestTimeAugmentation, device='cpu') -> tuple:
+    """
+    (density (1, 1, H/8, W/8), [count per view]) of a BGR image of height H and width W
+    """
+    height, width = img.shape[:2]
+    views = tta.views()
+    frames = []
+    for scale, _ in views:
+        if scale == 1.:
+            frames.append(img)
+        else:
+            size = (max(int(round(width * scale)), 1), max(int(round(height * scale)), 1))
+            frames.append(cv2.resize(img, size, interpolation=cv2.INTER_AREA if scale < 1. else cv2.INTER_LINEAR))
+    batch_h = _cells(max(frame.shape[0] for frame in frames)) * OUTPUT_STRIDE
+    batch_w = _cells(max(frame.shape[1] for frame in frames)) * OUTPUT_STRIDE
+    batch = padded_batch(model, frames, batch_h, batch_w, device)
+    for row, (_, flipped) in enumerate(views):
+        if flipped:
+            # mirrored over whole cells, the padding of the last cell moves to the left
+            cells_w = _cells(width) * OUTPUT_STRIDE
+            batch[row, :, :, :cells_w] = batch[row, :, :, :cells_w].flip(-1)
+    output = run_density(model, batch)
+
+    densities = []
+    for row, ((scale, flipped), frame) in enumerate(zip(views, frames)):
+        density = output[row:row + 1, :, :_cells(frame.shape[0]), :_cells(frame.shape[1])]
+        if flipped:
+            density = density.flip(-1)
+        if scale != 1.:
+            total = density.sum()
+            density = F.interpolate(density, size=(_cells(height), _cells(width)), mode='bilinear',
+                                    align_corners=False)
+            if density.sum() > 0:
+                density = density * (total / density.sum())
+        densities.append(density)
+    densities = torch.cat(densities)
+    counts = densities.sum(dim=(1, 2, 3))
+    density = densities.mean(dim=0, keepdim=True)
+    if tta.merge == 'median':
+        count = counts.quantile(0.5)
+        if density.sum() > 0:
+            density = density * (count / density.sum())
+    return density, counts.tolist()
@@ -2,14 +2,18 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from flask import jsonify
-import shutil
 import os
 import time
 import numpy as np
 import base64
+import functools
 import cv2
-import h5py
+
+from checkpoint import load_weights_file, save_weights_file, write_checkpoint
+
+# ImageNet statistics used by transforms.Normalize everywhere in this repo
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
 
 
 class AverageMeter(object):
@@ -32,12 +36,21 @@ class AverageMeter(object):
 
 
 def save_net(fname, net):
+    if fname.endswith('.weights'):
+        save_weights_file(net.state_dict(), fname)
+        return
+    import h5py
     with h5py.File(fname, 'w') as h5f:
         for k, v in net.state_dict().items():
             h5f.create_dataset(k, data=v.cpu().numpy())
 
 
 def load_net(fname, net):
+    if fname.endswith('.weights'):
+        # one memory mapped file instead of a dataset read per tensor
+        net.load_state_dict(load_weights_file(fname)[0])
+        return
+    import h5py
     with h5py.File(fname, 'r') as h5f:
         for k, v in net.state_dict().items():
             param = torch.from_numpy(np.asarray(h5f[k]))
@@ -45,12 +58,10 @@ def load_net(fname, net):
 
 
 def save_checkpoint(state, mae_is_best, mse_is_best, path, filename='checkpoint.pth.tar'):
-    torch.save(state, os.path.join(path, filename))
-    epoch = state['epoch']
-    if mae_is_best:
-        shutil.copyfile(os.path.join(path, filename), os.path.join(path, 'epoch' + str(epoch) + '_best_mae.pth.tar'))
-    if mse_is_best:
-        shutil.copyfile(os.path.join(path, filename), os.path.join(path, 'epoch' + str(epoch) + '_best_mse.pth.tar'))
+    """
+    Synchronous version of checkpoint.AsyncCheckpointer.save: atomic write, best epochs hardlinked
+    """
+    write_checkpoint(state, mae_is_best, mse_is_best, path, filename)
 
 
 def cal_para(net):
@@ -108,10 +119,61 @@ def image2base64(image_path: Path) -> str:
     return str(base64.b64encode(image), encoding='UTF-8')
 
 
-def base64_to_cvimage(base64_data: str) -> CvImgType:
+def base64_to_cvimage(base64_data: str, max_side: int = 0) -> CvImgType:
     imgData = base64.b64decode(base64_data)
-    nparr = np.fromstring(imgData, np.uint8)
-    img_np = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    return bytes_to_cvimage(imgData, max_side)
+
+
+def jpeg_size(data) -> tuple:
+    """
+    (height, width) from the SOF marker of a JPEG buffer without decoding it, None if not a JPEG
+    """
+    buf = memoryview(data)
+    if len(buf) < 4 or buf[0] != 0xFF or buf[1] != 0xD8:
+        return None
+    pos = 2
+    while pos + 9 < len(buf):
+        if buf[pos] != 0xFF:
+            return None
+        marker = buf[pos + 1]
+        if marker == 0xFF:
+            # fill byte
+            pos += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            pos += 2
+            continue
+        length = (buf[pos + 2] << 8) | buf[pos + 3]
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height = (buf[pos + 5] << 8) | buf[pos + 6]
+            width = (buf[pos + 7] << 8) | buf[pos + 8]
+            return height, width
+        pos += 2 + length
+    return None
+
+
+def bytes_to_cvimage(data, max_side: int = 0) -> CvImgType:
+    """
+    Decode an encoded image straight from a bytes-like buffer (no copy) to BGR
+
+    With max_side > 0 the image is shrunk so its longer side is at most max_side, JPEGs are then
+    decoded at 1/2, 1/4 or 1/8 resolution by libjpeg instead of decoding full size and resizing.
+    """
+    nparr = np.frombuffer(data, np.uint8)
+    flag = cv2.IMREAD_COLOR
+    if max_side:
+        size = jpeg_size(data)
+        if size is not None:
+            for reduce, reduced_flag in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                                         (2, cv2.IMREAD_REDUCED_COLOR_2)):
+                if max(size) // reduce >= max_side:
+                    flag = reduced_flag
+                    break
+    img_np = cv2.imdecode(nparr, flag)
+    if img_np is not None and max_side and max(img_np.shape[:2]) > max_side:
+        scale = max_side / max(img_np.shape[:2])
+        img_np = cv2.resize(img_np, (max(int(img_np.shape[1] * scale), 1), max(int(img_np.shape[0] * scale), 1)),
+                            interpolation=cv2.INTER_AREA)
     return img_np
 
 
@@ -122,6 +184,7 @@ def ndarray2base64(img_np: CvImgType):
 
 
 def get_use_time(func):
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
         t1 = time.time()
         res = func(*args, **kwargs)
@@ -137,12 +200,15 @@ def model2onnx():
 
 
 # 构建接口返回结果
-def get_result(code, message, score):
+def get_result(code, message, score, **extra):
+    # imported here so train.py and test.py do not load flask through utils
+    from flask import jsonify
     result = {
         "code": code,
         "message": message,
         "score": score,
     }
+    result.update(extra)
     print("Response data:", result)
     return jsonify(result)
 
@@ -0,0 +1,141 @@
+"""
+Count people in a video file or stream
+
+Decoding, inference and output run on separate threads connected by bounded queues: the decode thread
+grabs frames, keeps every `stride`-th one and packs them into raw float batches while the model runs
+on the previous batch, the writer thread appends the per-frame counts to a csv.
+
+python video_count.py --video input.mp4 --stride 5 --batch 8 --out counts.csv
+"""
+import argparse
+import queue
+import threading
+import time
+
+import cv2
+import torch
+
+from inference import to_raw_batch, run_density
+from models import build_model, load_checkpoint
+from models.raw_input import fold_input_normalization
+
+parser = argparse.ArgumentParser(description='CSRNet video counting')
+parser.add_argument('--video', '-i', type=str, default='0',
+                    help='video file, stream url or camera index')
+parser.add_argument('--checkpoint', '-c', metavar='CHECKPOINT', default='CSRNet_models_weights/partA_student.pth.tar',
+                    type=str,
+                    help='path to the checkpoint')
+parser.add_argument('--version', '-v', default='quarter_vgg', type=str,
+                    help='vgg/quarter_vgg')
+parser.add_argument('--stride', '-s', default=1, type=int,
+                    help='count every n-th frame')
+parser.add_argument('--batch', '-b', default=8, type=int,
+                    help='frames per forward pass')
+parser.add_argument('--queue', '-q', default=4, type=int,
+                    help='decoded batches buffered ahead of the model')
+parser.add_argument('--threads', '-t', default=0, type=int,
+                    help='torch intra-op threads, 0 keeps the torch default')
+parser.add_argument('--out', '-o', default='counts.csv', type=str,
+                    help='output csv: frame,time,count')
+
+CUDA_AVAILABLE = torch.cuda.is_available()
+
+
+def decode_worker(source, stride: int, batch_size: int, out_queue: queue.Queue, stop: threading.Event):
+    cap = cv2.VideoCapture(source)
+    if not cap.isOpened():
+        print('can not open video source: {}'.format(source))
+    frames, meta = [], []
+    frame_idx = -1
+    try:
+        while cap.isOpened() and not stop.is_set():
+            # grab() skips the frame without decoding it
+            if not cap.grab():
+                break
+            frame_idx += 1
+            if frame_idx % stride:
+                continue
+            ok, frame = cap.retrieve()
+            if not ok:
+                break
+            if frames and frame.shape != frames[0].shape:
+                out_queue.put((meta, to_raw_batch(frames)))
+                frames, meta = [], []
+            frames.append(frame)
+            meta.append((frame_idx, cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.))
+            if len(frames) == batch_size:
+                out_queue.put((meta, to_raw_batch(frames)))
+                frames, meta = [], []
+        if frames:
+            out_queue.put((meta, to_raw_batch(frames)))
+    finally:
+        cap.release()
+        out_queue.put(None)
+
+
+def write_worker(out_path: str, in_queue: queue.Queue):
+    with open(out_path, 'w') as f:
+        f.write('frame,time,count\n')
+        while True:
+            item = in_queue.get()
+            if item is None:
+                break
+            meta, counts = item
+            for (frame_idx, timestamp), count in zip(meta, counts):
+                f.write('{},{:.3f},{:.2f}\n'.format(frame_idx, timestamp, count))
+
+
+def main(args):
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    model = build_model(args.version)
+    epoch = load_checkpoint(model, args.checkpoint)
+    print("=> loaded checkpoint '{}' (epoch {})".format(args.checkpoint, epoch))
+    model.eval()
+    # BGR swap and normalization run inside the first conv, the decoder only converts to float
+    fold_input_normalization(model)
+    model = model.cuda() if CUDA_AVAILABLE else model
+
+    source = int(args.video) if args.video.isdigit() else args.video
+    frame_queue = queue.Queue(maxsize=args.queue)
+    result_queue = queue.Queue()
+    stop = threading.Event()
+    decoder = threading.Thread(target=decode_worker,
+                               args=(source, max(args.stride, 1), args.batch, frame_queue, stop), daemon=True)
+    writer = threading.Thread(target=write_worker, args=(args.out, result_queue), daemon=True)
+    decoder.start()
+    writer.start()
+
+    start = time.time()
+    frames = 0
+    video_time = 0.
+    try:
+        while True:
+            item = frame_queue.get()
+            if item is None:
+                break
+            meta, batch = item
+            batch = batch.cuda() if CUDA_AVAILABLE else batch
+            counts = run_density(model, batch).sum(dim=(1, 2, 3)).tolist()
+            result_queue.put((meta, counts))
+            frames += len(meta)
+            video_time = meta[-1][1]
+    except KeyboardInterrupt:
+        stop.set()
+        # unblock the decoder if it waits on a full queue
+        while frame_queue.get() is not None:
+            pass
+    result_queue.put(None)
+    writer.join()
+    decoder.join()
+
+    elapsed = time.time() - start
+    print('frames: {} time: {:.2f}s fps: {:.2f}'.format(frames, elapsed, frames / max(elapsed, 1e-6)))
+    if video_time > 0:
+        print('video time: {:.2f}s ({:.2f}x real time)'.format(video_time, video_time / max(elapsed, 1e-6)))
+    print('counts written to {}'.format(args.out))
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())